@@ -21,6 +21,7 @@
 import celery
 from app.config import Config
 from app.lib.log import log
+from app.lib.priority import DEFAULT_PRIORITY, PRIORITY_STEPS, PRIORITY_SEP
 
 app = celery.Celery("PackageRebuilder")
 
@@ -32,14 +33,25 @@ celery_app_conf = {
     ],
     "enable_utc": True,
     "timezone": "UTC",
+    # Consume higher priority lanes first: 'rebuild', 'rebuild:1', ..., 'rebuild:9'
+    "broker_transport_options": {
+        "priority_steps": PRIORITY_STEPS,
+        "sep": PRIORITY_SEP,
+        "queue_order_strategy": "priority",
+    },
+    "task_default_priority": DEFAULT_PRIORITY,
+    # Don't reserve lower priority tasks while higher priority ones are queued
+    "worker_prefetch_multiplier": 1,
     "task_routes": {
         "app.tasks.rebuilder.get": {"queue": "get"},
         "app.tasks.rebuilder.rebuild": {"queue": "rebuild"},
         "app.tasks.rebuilder.attest": {"queue": "attest"},
         "app.tasks.rebuilder.report": {"queue": "report"},
         "app.tasks.rebuilder.upload": {"queue": "upload"},
+        "app.tasks.rebuilder._upload_pending": {"queue": "upload"},
         "app.tasks.rebuilder._generate_results": {"queue": "report"},
         "app.tasks.rebuilder._metadata_to_db": {"queue": "get"},
+        "app.tasks.rebuilder._reconcile_inflight": {"queue": "get"},
     }
 }
 
@@ -26,8 +26,11 @@ DEFAULT_CONFIG = {
     "backend": os.environ.get('CELERY_RESULT_BACKEND', "mongodb://backend:27017"),
     "schedule_get": 1800,
     "schedule_generate_results": 300,
+    "schedule_upload_all": 86400,
     "max_retries": 2,
-    "snapshot": "http://snapshot.notset.fr"
+    "snapshot": "http://snapshot.notset.fr",
+    "priority-retry": -1,
+    "fast-lane-threshold": 0,
 }
 
 # Currently supported project
@@ -37,9 +40,27 @@ SUPPORTED_PROJECTS = ["qubesos", "debian", "fedora"]
 SECTION_OPTIONS = [
     "schedule_get", "snapshot", "in-toto-sign-key-fpr", "in-toto-sign-key-unreproducible-fpr",
     "repo-ssh-key", "repo-remote-ssh-host", "repo-remote-ssh-basedir", "dist",
-    "schedule_generate_results"
+    "schedule_generate_results", "priority-package-sets", "priority-repositories",
+    "priority-buildinfo-age", "priority-retry", "fast-lane-threshold", "schedule_upload_all",
+    "compress-log", "deb-cache", "deb-cache-size", "build-slots", "build-memory", "build-disk",
+    "build-job-memory", "build-slot-timeout"
 ]
 
+# Rebuild priority weights defined as space separated 'key:weight' values
+PRIORITY_WEIGHTS_OPTIONS = ["priority-package-sets", "priority-repositories",
+                            "priority-buildinfo-age"]
+
+# Boolean options (e.g. 'yes', 'no', 'true', 'false', '1', '0')
+BOOLEAN_OPTIONS = ["compress-log", "deb-cache"]
+
+
+def parse_weights(value):
+    weights = {}
+    for item in value.split():
+        key, weight = item.rsplit(':', 1)
+        weights[key] = int(weight)
+    return weights
+
 
 config = configparser.RawConfigParser(allow_no_value=False)
 
@@ -58,7 +79,10 @@ Config = {
     "common": {
         "schedule_get": config.get("common", "schedule_get", fallback=DEFAULT_CONFIG["schedule_get"]),
         "schedule_generate_results": config.get("common", "schedule_generate_results", fallback=DEFAULT_CONFIG["schedule_generate_results"]),
+        "schedule_upload_all": config.get("common", "schedule_upload_all", fallback=DEFAULT_CONFIG["schedule_upload_all"]),
         "snapshot": config.get("common", "snapshot", fallback=DEFAULT_CONFIG["snapshot"]),
+        "priority-retry": config.get("common", "priority-retry", fallback=DEFAULT_CONFIG["priority-retry"]),
+        "fast-lane-threshold": config.get("common", "fast-lane-threshold", fallback=DEFAULT_CONFIG["fast-lane-threshold"]),
     },
     "project": {}
 }
@@ -70,8 +94,15 @@ if "common" in config.sections():
             if option == "dist":
                 # fixme: allow dist in common like it was mostly before this refactor?
                 continue
-            if option in ("schedule_get", "schedule_generate_results"):
+            if option in ("schedule_get", "schedule_generate_results", "schedule_upload_all",
+                          "priority-retry", "fast-lane-threshold", "deb-cache-size",
+                          "build-slots", "build-memory", "build-disk", "build-job-memory",
+                          "build-slot-timeout"):
                 config_option = int(config_option)
+            if option in PRIORITY_WEIGHTS_OPTIONS:
+                config_option = parse_weights(config_option)
+            if option in BOOLEAN_OPTIONS:
+                config_option = config.BOOLEAN_STATES[config_option.lower()]
             Config["common"][option] = config_option
 
 for project in SUPPORTED_PROJECTS:
@@ -85,6 +116,13 @@ for project in SUPPORTED_PROJECTS:
             Config["project"][project].setdefault(option, {})
             if option == "dist":
                 config_option = config_option.replace(' ', '\n').splitlines()
-            if option in ("schedule_get", "schedule_generate_results"):
+            if option in ("schedule_get", "schedule_generate_results", "schedule_upload_all",
+                          "priority-retry", "fast-lane-threshold", "deb-cache-size",
+                          "build-slots", "build-memory", "build-disk", "build-job-memory",
+                          "build-slot-timeout"):
                 config_option = int(config_option)
+            if option in PRIORITY_WEIGHTS_OPTIONS and isinstance(config_option, str):
+                config_option = parse_weights(config_option)
+            if option in BOOLEAN_OPTIONS and isinstance(config_option, str):
+                config_option = config.BOOLEAN_STATES[config_option.lower()]
             Config["project"][project][option] = config_option
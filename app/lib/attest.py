@@ -24,16 +24,7 @@ import glob
 import shutil
 import tempfile
 
-try:
-    import koji
-except ImportError:
-    koji = None
-try:
-    import debian.debian_support
-    import debian.deb822
-except ImportError:
-    debian = None
-
+from app.lib.common import get_buildinfo_fields
 from app.lib.exceptions import RebuilderExceptionAttest
 from app.lib.log import log
 from app.lib.rebuild import getRebuilder
@@ -101,8 +92,8 @@ class BaseAttester:
 
 
 def process_attestation(package, gpg_sign_keyid, files, reproducible, **kwargs):
-    with open(package.buildinfos["new"]) as fd:
-        parsed_buildinfo = debian.deb822.BuildInfo(fd)
+    with open(package.buildinfos["new"], "rb") as fd:
+        parsed_buildinfo = get_buildinfo_fields(fd, ["Binary"])
     # if parsed_buildinfo.get_version()._BaseVersion__epoch:
     #     package.epoch = parsed_buildinfo.get_version()._BaseVersion__epoch
 
@@ -135,7 +126,7 @@ def process_attestation(package, gpg_sign_keyid, files, reproducible, **kwargs):
     os.chdir(os.path.join(outputdir, "../../"))
     if not package.files:
         package.files = {}
-    for binpkg in parsed_buildinfo.get_binary():
+    for binpkg in parsed_buildinfo.get("Binary", "").split():
         package.files.setdefault(key, [])
         if binpkg in files_names:
             package.files[key].append(binpkg)
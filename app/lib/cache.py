@@ -0,0 +1,558 @@
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2021 Frédéric Pierret (fepitre) <frederic.pierret@qubes-os.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+import requests
+
+from app.lib.log import log
+
+DEFAULT_CACHE_DIR = "/var/lib/rebuilder/cache"
+# Seconds after which the size of a store is computed again from its
+# content, e.g. to account for entries added by other processes
+LRU_RESCAN_INTERVAL = 300
+
+
+def write_file_atomic(path, content):
+    # Readers on other workers must never see a partially written file
+    mode = "wb" if isinstance(content, bytes) else "w"
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, mode) as f:
+            f.write(content)
+        os.replace(tmp, path)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class HTTPCache:
+    # Parsed content per URL as {url: (validators, parsed)}. Shared by every
+    # instance so that long-lived workers skip parsing unchanged resources.
+    _parsed = {}
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, session=None, timeout=60):
+        self.cache_dir = f"{cache_dir}/http" if cache_dir else None
+        self.session = session or requests.Session()
+        self.timeout = timeout
+        if self.cache_dir:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+            except OSError as e:
+                log.error(f"Cannot create HTTP cache directory {self.cache_dir}: {str(e)}")
+                self.cache_dir = None
+
+    def _get_paths(self, url):
+        digest = hashlib.sha256(url.encode("utf8")).hexdigest()
+        return f"{self.cache_dir}/{digest}", f"{self.cache_dir}/{digest}.json"
+
+    def _load(self, url):
+        if not self.cache_dir:
+            return None, None
+        body_path, meta_path = self._get_paths(url)
+        if not os.path.exists(body_path) or not os.path.exists(meta_path):
+            return None, None
+        try:
+            with open(meta_path) as fd:
+                meta = json.loads(fd.read())
+        except (OSError, ValueError):
+            return None, None
+        if meta.get("url") != url:
+            return None, None
+        return body_path, meta
+
+    def _store(self, url, resp):
+        if not self.cache_dir:
+            return
+        body_path, meta_path = self._get_paths(url)
+        meta = {
+            "url": url,
+            "etag": resp.headers.get("ETag", None),
+            "last-modified": resp.headers.get("Last-Modified", None),
+        }
+        try:
+            write_file_atomic(body_path, resp.content)
+            write_file_atomic(meta_path, json.dumps(meta))
+        except OSError as e:
+            log.error(f"Cannot store {url} in HTTP cache: {str(e)}")
+
+    def _drop(self, url):
+        self._parsed.pop(url, None)
+        if not self.cache_dir:
+            return
+        for path in self._get_paths(url):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                log.error(f"Cannot remove {path} from HTTP cache: {str(e)}")
+
+    @staticmethod
+    def _read(body_path):
+        with open(body_path, "rb") as fd:
+            return fd.read()
+
+    def get(self, url, parser=None):
+        """
+        Return the content of url as text, or parser(text) if provided.
+
+        The cached copy is revalidated with If-None-Match/If-Modified-Since
+        so an unchanged resource costs a single 304 round trip. If the
+        remote cannot be reached or fails, the cached copy is used. It is
+        dropped if the resource is gone. Returns None if no content is
+        available.
+        """
+        body_path, meta = self._load(url)
+        headers = {"Accept-Encoding": "gzip"}
+        if meta:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last-modified"):
+                headers["If-Modified-Since"] = meta["last-modified"]
+
+        content = None
+        try:
+            resp = self.session.get(url, headers=headers, timeout=self.timeout)
+            if resp.status_code == 304 and body_path:
+                log.debug(f"{url}: not modified")
+            elif resp.ok:
+                self._store(url, resp)
+                meta = {
+                    "etag": resp.headers.get("ETag", None),
+                    "last-modified": resp.headers.get("Last-Modified", None),
+                }
+                content = resp.content
+            elif resp.status_code in (404, 410):
+                self._drop(url)
+                return None
+            elif body_path:
+                log.warning(f"Failed to get {url} ({resp.status_code}), using cached copy")
+            else:
+                return None
+        except requests.exceptions.RequestException as e:
+            if not body_path:
+                raise
+            log.error(f"Failed to get {url}, using cached copy: {str(e)}")
+
+        validators = (meta.get("etag"), meta.get("last-modified"))
+        if not any(validators):
+            validators = None
+        cached = self._parsed.get(url, None)
+        if validators and cached and cached[0] == validators:
+            return cached[1]
+
+        if content is None:
+            content = self._read(body_path)
+        result = content.decode("utf8")
+        if parser:
+            result = parser(result)
+        if validators:
+            self._parsed[url] = (validators, result)
+        return result
+
+
+class ListSnapshot:
+    """
+    Persisted set of entries (e.g. buildinfo URLs) processed by the last run.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        entries = set()
+        if self.exists():
+            with open(self.path) as fd:
+                entries = set(line.rstrip('\n') for line in fd if line.strip())
+        return entries
+
+    def diff(self, entries):
+        previous = self.load()
+        entries = set(entries)
+        return entries - previous, previous - entries
+
+    def save(self, entries):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        write_file_atomic(self.path, "".join(f"{entry}\n" for entry in sorted(entries)))
+
+
+class ListingSnapshot:
+    """
+    Persisted remote listing {path: (size, mtime)} of the last run.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        listing = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as fd:
+                    listing = {f: tuple(stats) for f, stats in json.loads(fd.read()).items()}
+            except (OSError, ValueError) as e:
+                log.error(f"Cannot load listing {self.path}: {str(e)}")
+        return listing
+
+    def diff(self, listing):
+        # Changed files are reported as added
+        previous = self.load()
+        added = {f for f, stats in listing.items() if previous.get(f, None) != stats}
+        removed = previous.keys() - listing.keys()
+        return added, removed
+
+    def save(self, listing):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        write_file_atomic(self.path, json.dumps(listing))
+
+
+class BuildinfoIndex:
+    """
+    Persistent index of metadata parsed from remote buildinfo files keyed by
+    URL and by the size and modification time given by the repository
+    listing. A buildinfo is downloaded again only if one of them changed.
+    """
+    FIELDS = ("name", "epoch", "version", "architecture", "build_arch")
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.conn = sqlite3.connect(self.path)
+        except (OSError, sqlite3.Error) as e:
+            log.error(f"Cannot open buildinfo index {self.path}: {str(e)}")
+            self.conn = sqlite3.connect(":memory:")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS buildinfos ("
+            "url TEXT PRIMARY KEY, size INTEGER, mtime TEXT, name TEXT, epoch TEXT, "
+            "version TEXT, architecture TEXT, build_arch TEXT)"
+        )
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def get(self, url, size=None, mtime=None):
+        row = self.conn.execute(
+            f"SELECT size, mtime, {', '.join(self.FIELDS)} FROM buildinfos WHERE url = ?",
+            (url,)
+        ).fetchone()
+        if not row or (row[0], row[1]) != (size, mtime):
+            return None
+        return dict(zip(self.FIELDS, row[2:]))
+
+    def get_mtime(self, url):
+        row = self.conn.execute("SELECT mtime FROM buildinfos WHERE url = ?", (url,)).fetchone()
+        return row[0] if row else None
+
+    def delete(self, urls):
+        self.conn.executemany("DELETE FROM buildinfos WHERE url = ?", ((url,) for url in urls))
+
+    def set(self, url, size=None, mtime=None, **fields):
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO buildinfos (url, size, mtime, {', '.join(self.FIELDS)}) "
+            f"VALUES (?, ?, ?, {', '.join('?' * len(self.FIELDS))})",
+            (url, size, mtime) + tuple(fields.get(f, None) for f in self.FIELDS)
+        )
+
+
+class RepositorySnapshot:
+    """
+    Versioned snapshot of the packages of a repository, published by the
+    getter and read by the reporter. It is stored as tab separated text,
+    read through mmap without loading the whole file in memory first:
+
+        rebuilder-snapshot <format> <generation> <timestamp>
+        <package set 1>\t...\t<package set N>
+        <field 1>\t...\t<field M>\t<package sets bitmask>
+    """
+    MAGIC = b"rebuilder-snapshot"
+    FORMAT = 1
+
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _read_header(self, fd):
+        header = fd.readline().split()
+        if len(header) != 4 or header[0] != self.MAGIC:
+            raise ValueError(f"Invalid repository snapshot {self.path}")
+        if int(header[1]) != self.FORMAT:
+            raise ValueError(f"Unsupported repository snapshot format {int(header[1])}")
+        return int(header[2]), int(header[3])
+
+    def get_generation(self):
+        if not self.exists():
+            return 0
+        try:
+            with open(self.path, "rb") as fd:
+                generation, _ = self._read_header(fd)
+        except (OSError, ValueError):
+            generation = 0
+        return generation
+
+    def save(self, package_sets, records):
+        """
+        Publish records given as (fields, package set indexes) and return the
+        generation of the new snapshot.
+        """
+        generation = self.get_generation() + 1
+        lines = [
+            f"{self.MAGIC.decode()} {self.FORMAT} {generation} {int(time.time())}\n",
+            "\t".join(package_sets) + "\n"
+        ]
+        for fields, indexes in records:
+            mask = sum(1 << idx for idx in indexes)
+            lines.append("\t".join(f or "" for f in fields) + f"\t{mask:x}\n")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        write_file_atomic(self.path, "".join(lines))
+        return generation
+
+    def load(self):
+        """
+        Return (generation, timestamp, package sets, records) where records
+        are (fields, package set indexes). Missing fields are None.
+        """
+        with open(self.path, "rb") as fd, \
+                mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            generation, timestamp = self._read_header(mm)
+            package_sets = mm.readline().decode("utf8").rstrip("\n").split("\t")
+            records = []
+            for line in iter(mm.readline, b""):
+                *fields, mask = line.decode("utf8").rstrip("\n").split("\t")
+                mask = int(mask, 16)
+                indexes = tuple(idx for idx in range(len(package_sets)) if mask >> idx & 1)
+                records.append((tuple(f or None for f in fields), indexes))
+        return generation, timestamp, package_sets, records
+
+
+class LRUStore:
+    """
+    Directory of entries (files or directories) addressed by key. Once their
+    total size exceeds budget bytes, the least recently used entries are
+    removed. Using an entry updates its modification time.
+    """
+    # Total size of entries per store path as {path: (size, scan time)}.
+    # Shared by every instance so that the store is only scanned once over
+    # budget or once the size is outdated.
+    _sizes = {}
+    _sizes_lock = threading.Lock()
+
+    def __init__(self, path, budget=None):
+        self.path = path
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def get_path(self, key):
+        return f"{self.path}/{key[:2]}/{key}"
+
+    @staticmethod
+    def get_size(path):
+        if not os.path.isdir(path):
+            return os.lstat(path).st_size
+        size = 0
+        for root, _, files in os.walk(path):
+            size += sum(os.lstat(os.path.join(root, f)).st_size for f in files)
+        return size
+
+    def entries(self):
+        """
+        Return entries as (mtime, size, path), least recently used first.
+        """
+        entries = []
+        for subdir in os.scandir(self.path):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    entries.append((entry.stat(follow_symlinks=False).st_mtime,
+                                    self.get_size(entry.path), entry.path))
+                except FileNotFoundError:
+                    # removed by another worker
+                    continue
+        return sorted(entries)
+
+    def get(self, key):
+        path = self.get_path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def put(self, key, src):
+        """
+        Move src into the store as key and return its new path.
+        """
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.rename(src, path)
+        except OSError:
+            # stored meanwhile by another worker
+            if not os.path.exists(path):
+                raise
+            if os.path.isdir(src):
+                shutil.rmtree(src)
+            else:
+                os.remove(src)
+        else:
+            if self.budget and self.add_size(self.get_size(path)):
+                self.evict()
+        return path
+
+    def add_size(self, size):
+        """
+        Account size bytes added to the store. Return True if the store
+        needs to be scanned: it is over budget or its size is outdated.
+        """
+        with self._sizes_lock:
+            known = self._sizes.get(self.path, None)
+            if not known or time.monotonic() - known[1] > LRU_RESCAN_INTERVAL:
+                return True
+            self._sizes[self.path] = (known[0] + size, known[1])
+            return known[0] + size > self.budget
+
+    def evict(self):
+        if not self.budget:
+            return []
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        evicted = []
+        for _, size, path in entries:
+            if total <= self.budget:
+                break
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted.append(path)
+        with self._sizes_lock:
+            self._sizes[self.path] = (total, time.monotonic())
+        if evicted:
+            log.debug(f"{self.path}: {len(evicted)} entries evicted")
+        return evicted
+
+    def stats(self):
+        entries = self.entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(entries),
+            "size": sum(size for _, size, _ in entries),
+        }
+
+
+class ResolverCache:
+    """
+    Persistent cache of snapshot service answers (e.g. the timestamps of a
+    binary package version) keyed by query URL with the package name,
+    version and architecture it is about. Answers about a given version do
+    not change so they are never revalidated. SHA256 of archive files given
+    by snapshot Packages indexes are kept by file name.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        except (OSError, sqlite3.Error) as e:
+            log.error(f"Cannot open resolver cache {self.path}: {str(e)}")
+            self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        with self.lock:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS queries ("
+                "url TEXT PRIMARY KEY, name TEXT, version TEXT, arch TEXT, "
+                "content_type TEXT, content BLOB)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS checksums (filename TEXT PRIMARY KEY, sha256 TEXT)"
+            )
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def get(self, url):
+        """
+        Return (content type, content) or None.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT content_type, content FROM queries WHERE url = ?", (url,)
+            ).fetchone()
+        return (row[0], bytes(row[1])) if row else None
+
+    def set(self, url, content_type, content, name=None, version=None, arch=None):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO queries (url, name, version, arch, content_type, content) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (url, name, version, arch, content_type, content)
+            )
+            self.conn.commit()
+
+    def get_checksum(self, filename):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT sha256 FROM checksums WHERE filename = ?", (filename,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_checksums(self, checksums):
+        """
+        Store (file name, sha256) items.
+        """
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO checksums (filename, sha256) VALUES (?, ?)", checksums
+            )
+            self.conn.commit()
@@ -18,16 +18,13 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import collections
+import errno
+import functools
 import os
-
-try:
-    import koji
-except ImportError:
-    koji = None
-try:
-    import debian.debian_support
-except ImportError:
-    debian = None
+import re
+import shutil
+import sys
 
 DEBIAN = {
     "buster": "10",
@@ -65,28 +62,150 @@ def get_project(distribution):
         return "debian"
 
 
+# Parsed buildinfo file name. For Debian, 'arch' is a tuple of architectures
+# (e.g. ('amd64', 'source')). For RPM, 'version' is version-release.
+BuildinfoName = collections.namedtuple(
+    "BuildinfoName", ["name", "epoch", "version", "arch", "release"])
+
+# [epoch:]name-version-release.arch
+RPM_NVRA_RE = re.compile(r"(?:(?P<epoch>\d+):)?(?P<name>.+)-(?P<version>[^-]+)-"
+                         r"(?P<release>[^-]+)\.(?P<arch>[^.]+)")
+# name_[epoch:]version_arch
+DEB_BUILDINFO_RE = re.compile(r"(?P<name>[^_/]*)_(?P<version>[^_/]*)_(?P<arch>[^_/]*?)"
+                              r"(?:\.buildinfo)?")
+
+
+# Results are cached per path: the same buildinfos are parsed on every
+# run and mostly share names and architectures which are interned.
+@functools.lru_cache(maxsize=65536)
+def _parse_rpm_buildinfo_path(buildinfo):
+    bn = buildinfo[buildinfo.rfind('/') + 1:].replace('.buildinfo', '').replace('-buildinfo', '')
+    parsed = RPM_NVRA_RE.fullmatch(bn)
+    if parsed is None:
+        return None
+    name, version, release, arch = parsed.group("name", "version", "release", "arch")
+    return BuildinfoName(
+        sys.intern(name), parsed.group("epoch") or '', f"{version}-{release}", sys.intern(arch),
+        release
+    )
+
+
+@functools.lru_cache(maxsize=65536)
+def _parse_deb_buildinfo_path(buildinfo):
+    parsed = DEB_BUILDINFO_RE.fullmatch(buildinfo, buildinfo.rfind('/') + 1)
+    if parsed is None:
+        return None
+    name, version, arch = parsed.groups()
+    if not version:
+        return None
+    return BuildinfoName(
+        sys.intern(name), version.partition(':')[0] if ':' in version else None, version,
+        tuple(sys.intern(a) for a in arch.split('-')), None
+    )
+
+
+def parse_rpm_buildinfo_fnames(buildinfos):
+    """
+    Yield (buildinfo, BuildinfoName) for every parsable RPM buildinfo path or URL.
+    """
+    for buildinfo in buildinfos:
+        parsed_bn = _parse_rpm_buildinfo_path(buildinfo)
+        if parsed_bn is not None:
+            yield buildinfo, parsed_bn
+
+
+def parse_deb_buildinfo_fnames(buildinfos):
+    """
+    Yield (buildinfo, BuildinfoName) for every parsable Debian buildinfo path or URL.
+    """
+    for buildinfo in buildinfos:
+        parsed_bn = _parse_deb_buildinfo_path(buildinfo)
+        if parsed_bn is not None:
+            yield buildinfo, parsed_bn
+
+
 def parse_rpm_buildinfo_fname(buildinfo):
-    bn = os.path.basename(
-        buildinfo).replace('.buildinfo', '').replace('-buildinfo', '')
-    if not koji.check_NVRA(bn):
+    parsed_bn = _parse_rpm_buildinfo_path(buildinfo)
+    if not parsed_bn:
         return
-    parsed_bn = koji.parse_NVRA(bn)
     # TODO: use 'verrel' terminology even for Debian?
-    parsed_bn['version'] = '{}-{}'.format(
-        parsed_bn['version'], parsed_bn['release'])
-    return parsed_bn
+    return parsed_bn._asdict()
 
 
 def parse_deb_buildinfo_fname(buildinfo):
-    bn = os.path.basename(buildinfo)
-    parsed_tmp = bn.replace('.buildinfo', '').split('_')
-    parsed_bn = {}
-    if len(parsed_tmp) == 3:
-        if parsed_tmp[1] == "":
-            return
-        parsed_nv = debian.debian_support.NativeVersion(parsed_tmp[1])
-        parsed_bn['name'] = parsed_tmp[0]
-        parsed_bn['epoch'] = parsed_nv._BaseVersion__epoch
-        parsed_bn['version'] = parsed_nv._BaseVersion__full_version
-        parsed_bn['arch'] = parsed_tmp[2].split('-')
+    parsed_bn = _parse_deb_buildinfo_path(buildinfo)
+    if not parsed_bn:
+        return
+    parsed_bn = parsed_bn._asdict()
+    parsed_bn['arch'] = list(parsed_bn['arch'])
+    del parsed_bn['release']
     return parsed_bn
+
+
+def get_buildinfo_fields(buildinfo, fields):
+    """
+    Get header fields from buildinfo content given as bytes, str or file
+    object. Lines are read only until every requested field has been
+    found, so neither Installed-Build-Depends nor checksums are parsed.
+    Returns {field: value} for the fields found.
+    """
+    if isinstance(buildinfo, bytes):
+        buildinfo = buildinfo.decode("utf8")
+    if isinstance(buildinfo, str):
+        buildinfo = buildinfo.splitlines()
+
+    wanted = {f.lower(): f for f in fields}
+    result = {}
+    current = None
+    in_armor_header = False
+    for line in buildinfo:
+        if isinstance(line, bytes):
+            line = line.decode("utf8")
+        line = line.rstrip("\r\n")
+        if line.startswith("-----BEGIN PGP SIGNED MESSAGE-----"):
+            # skip armor headers like 'Hash: SHA256' up to first empty line
+            in_armor_header = True
+            continue
+        if in_armor_header:
+            in_armor_header = bool(line.strip())
+            continue
+        if line.startswith("-----BEGIN PGP SIGNATURE-----"):
+            break
+        if line[:1] in (" ", "\t"):
+            # continuation line of a multiline field
+            if current:
+                result[current] += f"\n{line.strip()}"
+            continue
+        # a new field means the previous value is complete
+        if len(result) == len(wanted):
+            break
+        key, sep, value = line.partition(":")
+        current = wanted.get(key.strip().lower(), None) if sep else None
+        if current:
+            result[current] = value.strip()
+    return result
+
+
+def move_path(src, dst):
+    """
+    Move file or directory src to dst by renaming it. It is copied only
+    if src and dst are not on the same filesystem.
+    Returns True if src has been renamed.
+    """
+    try:
+        os.rename(src, dst)
+        return True
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    # copy next to dst first so that dst appears atomically
+    tmp_dst = f"{os.path.dirname(dst) or '.'}/.{os.path.basename(dst)}.tmp"
+    if os.path.isdir(src):
+        shutil.copytree(src, tmp_dst, symlinks=True)
+        os.rename(tmp_dst, dst)
+        shutil.rmtree(src)
+    else:
+        shutil.copy2(src, tmp_dst)
+        os.rename(tmp_dst, dst)
+        os.remove(src)
+    return False
@@ -0,0 +1,134 @@
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2021 Frédéric Pierret (fepitre) <frederic.pierret@qubes-os.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Build duration model: the wall-time of every successful rebuild is
+# aggregated per source package name as an exponentially weighted moving
+# average. It is used to submit the longest rebuilds first, to route
+# short rebuilds to a fast lane and to estimate the time to drain queues.
+
+import heapq
+import statistics
+
+import pymongo
+
+DURATIONS_COLLECTION = "durations"
+# Expected duration in seconds when there is no history at all
+DEFAULT_BUILD_DURATION = 600
+# Weight of the latest build in the moving average
+DURATION_EWMA_ALPHA = 0.3
+
+FAST_REBUILD_QUEUE = "rebuild-fast"
+REBUILD_QUEUES = ["rebuild", FAST_REBUILD_QUEUE]
+
+_durations_collection_indexed = False
+
+
+def get_durations_collection(app):
+    global _durations_collection_indexed
+    col = app.backend.database[DURATIONS_COLLECTION]
+    if not _durations_collection_indexed:
+        col.create_index([("name", pymongo.ASCENDING)], unique=True)
+        _durations_collection_indexed = True
+    return col
+
+
+def record_build_duration(app, package):
+    if package.duration is None or package.status not in ("reproducible", "unreproducible"):
+        return
+    duration = float(package.duration)
+    # Atomic update of the moving average
+    get_durations_collection(app).update_one(
+        {"name": package.name},
+        [{"$set": {
+            "count": {"$add": [{"$ifNull": ["$count", 0]}, 1]},
+            "last": duration,
+            "duration": {"$cond": [
+                {"$eq": [{"$ifNull": ["$duration", None]}, None]},
+                duration,
+                {"$add": [{"$multiply": [DURATION_EWMA_ALPHA, duration]},
+                          {"$multiply": [1 - DURATION_EWMA_ALPHA, "$duration"]}]}
+            ]},
+        }}],
+        upsert=True
+    )
+
+
+def get_build_durations(app, names=None):
+    """
+    Return {name: expected duration in seconds} for given source names.
+    """
+    query = {"name": {"$in": list(names)}} if names is not None else {}
+    return {
+        doc["name"]: doc["duration"]
+        for doc in get_durations_collection(app).find(query, {"_id": 0, "name": 1, "duration": 1})
+    }
+
+
+class DurationModel:
+    def __init__(self, durations):
+        self.durations = durations
+        # Unknown packages are expected to be as long as a typical package
+        if durations:
+            self.default = statistics.median(durations.values())
+        else:
+            self.default = DEFAULT_BUILD_DURATION
+
+    def is_known(self, package):
+        return package.name in self.durations
+
+    def estimate(self, package):
+        return self.durations.get(package.name, self.default)
+
+    def is_fast(self, package, threshold):
+        # Only packages known to be short go to the fast lane
+        return bool(threshold) and self.is_known(package) and \
+            self.estimate(package) <= threshold
+
+    def sort_longest_first(self, packages, priorities=None, groups=None):
+        """
+        Sort packages by priority then by decreasing expected duration
+        (longest-processing-time first). Packages of the same group (e.g.
+        needing the same snapshot timestamp) are kept together, the group
+        having the longest package first.
+        """
+        priorities = priorities or {}
+        groups = groups or {}
+
+        def get_group(p):
+            return priorities.get(p, 0), groups.get(p, None) or p
+
+        group_durations = {}
+        for p in packages:
+            group = get_group(p)
+            group_durations[group] = max(group_durations.get(group, 0), self.estimate(p))
+        group_indexes = {group: idx for idx, group in enumerate(
+            sorted(group_durations, key=lambda g: (g[0], -group_durations[g])))}
+        return sorted(packages, key=lambda p: (group_indexes[get_group(p)], -self.estimate(p)))
+
+    def estimate_drain_time(self, packages, workers=1):
+        """
+        Return the expected time in seconds for workers to rebuild packages
+        if the longest ones are processed first.
+        """
+        durations = sorted((self.estimate(p) for p in packages), reverse=True)
+        loads = [0.0] * max(workers, 1)
+        for duration in durations:
+            heapq.heapreplace(loads, loads[0] + duration)
+        return max(loads)
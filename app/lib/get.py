@@ -17,30 +17,81 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
+import abc
+import collections.abc
+import datetime
+import email.utils
+import hashlib
 import os
 import re
 import requests
 import subprocess
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib3.util.retry import Retry
+
 try:
     import koji
 except ImportError:
     koji = None
 try:
     import debian.debian_support
-    import debian.deb822
 except ImportError:
     debian = None
 
-from packaging.version import parse as parse_version
+from app.lib.cache import DEFAULT_CACHE_DIR, HTTPCache, ListSnapshot, ListingSnapshot, \
+    BuildinfoIndex, RepositorySnapshot
 from app.lib.common import DEBIAN, DEBIAN_ARCHES, is_qubes, is_debian, is_fedora, get_project, \
-    parse_deb_buildinfo_fname, parse_rpm_buildinfo_fname
+    parse_deb_buildinfo_fnames, parse_rpm_buildinfo_fnames, get_buildinfo_fields
 from app.lib.exceptions import RebuilderExceptionDist, RebuilderExceptionGet
 from app.lib.log import log
+from app.lib.version import debian_version_key, rpm_version_key, get_latest_versions
+
+
+# Maximum number of concurrent connections per remote host
+DEFAULT_MAX_CONNECTIONS = 8
+
+
+def get_http_session(max_connections=DEFAULT_MAX_CONNECTIONS, retries=3):
+    # Keep-alive session allowing at most max_connections per host and
+    # retrying with exponential backoff on connection or server errors
+    session = requests.Session()
+    retry = Retry(
+        total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("HEAD", "GET")
+    )
+    adapter = requests.adapters.HTTPAdapter(
+        pool_maxsize=max_connections, pool_block=True, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def fetch_urls(urls, session=None, max_workers=DEFAULT_MAX_CONNECTIONS, timeout=60,
+               method="GET"):
+    """
+    Fetch urls concurrently and yield (url, response) as they complete.
+    Response is None if the request failed.
+    """
+    if session is None:
+        session = get_http_session(max_connections=max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(session.request, method, url, timeout=timeout, allow_redirects=True):
+                url for url in urls
+        }
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                resp = future.result()
+            except requests.exceptions.RequestException as e:
+                log.error(f"Failed to get {url}: {str(e)}")
+                resp = None
+            yield url, resp
 
 
 def getPackage(package_as_dict):
-    if not isinstance(package_as_dict, dict):
+    if not isinstance(package_as_dict, collections.abc.Mapping):
         raise RebuilderExceptionGet("Cannot parse input")
     distribution = package_as_dict.get("distribution", None)
     if not distribution:
@@ -56,37 +107,99 @@ def getPackage(package_as_dict):
     return package
 
 
-class Package(dict):
-    def __init__(self, name, epoch, version, arch, distribution, buildinfos,
-                 metadata=None, artifacts=None, status=None, log=None, diffoscope=None,
-                 retries=0, files=None):
-        dict.__init__(self, name=name, epoch=epoch, version=version, arch=arch,
-                      distribution=distribution, metadata=metadata, artifacts=artifacts,
-                      status=status, log=log, diffoscope=diffoscope, retries=retries,
-                      buildinfos=buildinfos, files=files)
+class Package(collections.abc.Mapping):
+    """
+    Package record exchanged between tasks.
 
-    def __getattr__(self, item):
-        return self[item]
+    Identity fields (name, epoch, version, arch and distribution) cannot be
+    changed once created, so the canonical key and hash are computed once and
+    packages can be stored in sets and used as dict keys. Item access and
+    dict(package) are supported for Celery serialization. Unknown fields are
+    kept apart in 'extra'.
+    """
+    IDENTITY_FIELDS = ("name", "epoch", "version", "arch", "distribution")
+    FIELDS = ("name", "epoch", "version", "arch", "distribution", "metadata", "artifacts",
+              "status", "log", "diffoscope", "retries", "buildinfos", "files", "duration",
+              "timestamps")
+    __slots__ = FIELDS + ("extra", "_str", "_key", "_hash")
+
+    def __init__(self, name, epoch, version, arch, distribution, buildinfos=None,
+                 metadata=None, artifacts=None, status=None, log=None, diffoscope=None,
+                 retries=0, files=None, duration=None, timestamps=None, **extra):
+        set_field = object.__setattr__
+        set_field(self, "name", name)
+        set_field(self, "epoch", epoch)
+        set_field(self, "version", version)
+        set_field(self, "arch", arch)
+        set_field(self, "distribution", distribution)
+        self.metadata = metadata
+        self.artifacts = artifacts
+        self.status = status
+        self.log = log
+        self.diffoscope = diffoscope
+        self.retries = retries
+        self.buildinfos = buildinfos
+        self.files = files
+        # build wall-time in seconds
+        self.duration = duration
+        # snapshot timestamps used by the last build, most used first
+        self.timestamps = timestamps
+        self.extra = extra or None
+        result = f"{name}-{version}.{arch}"
+        if epoch and epoch != 0:
+            result = f"{epoch}:{result}"
+        set_field(self, "_str", result)
+        set_field(self, "_key", f"{distribution}:{result}")
+        set_field(self, "_hash", hash(self._key))
 
     def __setattr__(self, key, value):
-        self[key] = value
+        if key in self.IDENTITY_FIELDS or key in ("_str", "_key", "_hash"):
+            raise AttributeError(f"Cannot change '{key}' of {self}")
+        object.__setattr__(self, key, value)
+
+    def __getitem__(self, item):
+        if item in self.FIELDS:
+            return getattr(self, item)
+        if self.extra and item in self.extra:
+            return self.extra[item]
+        raise KeyError(item)
+
+    def __setitem__(self, key, value):
+        if key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __iter__(self):
+        yield from self.FIELDS
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return len(self.FIELDS) + len(self.extra or ())
+
+    @property
+    def key(self):
+        return self._key
 
     def __repr__(self):
-        result = f"{self.name}-{self.version}.{self.arch}"
-        if self.epoch and self.epoch != 0:
-            result = f"{self.epoch}:{result}"
+        result = self._str
         if self.status:
             result = f"{result}={self.status}"
         return result
 
     def __str__(self):
-        result = f"{self.name}-{self.version}.{self.arch}"
-        if self.epoch and self.epoch != 0:
-            result = f"{self.epoch}:{result}"
-        return result
+        return self._str
 
     def __eq__(self, other):
-        return repr(self) == repr(other)
+        if not isinstance(other, Package):
+            return NotImplemented
+        return self._key == other._key
+
+    def __hash__(self):
+        return self._hash
 
     @classmethod
     def from_dict(cls, pkg):
@@ -100,16 +213,22 @@ class Package(dict):
 
 
 class DebianPackage(Package):
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
 
 class FedoraPackage(Package):
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
 
 class QubesPackage(Package):
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -124,12 +243,166 @@ class FedoraRepository:
         pass
 
 
-class DebianRepository:
+class BaseRepository(abc.ABC):
+    def __init__(self, **kwargs):
+        self.cache_dir = kwargs.get("cache_dir", DEFAULT_CACHE_DIR)
+        self.package_sets = ["full"]
+        self.packages = None
+        self.packages_to_rebuild = None
+        # buildinfos which appeared since the last saved run
+        self.updated_buildinfos = set()
+
+    @property
+    @abc.abstractmethod
+    def snapshot_name(self):
+        pass
+
+    @property
+    def snapshot(self):
+        return ListSnapshot(f"{self.cache_dir}/get/{self.snapshot_name}.list")
+
+    @abc.abstractmethod
+    def get_packages_to_rebuild(self, package_set=None):
+        pass
+
+    def get_updated_packages_to_rebuild(self, full=False):
+        """
+        Return packages to rebuild whose buildinfo was not processed by
+        the last saved run, i.e. new packages or new versions superseding
+        the previous ones. Every package is returned if no run was saved
+        or if full is set.
+        """
+        self.packages_to_rebuild = self.get_packages_to_rebuild()
+        snapshot = self.snapshot
+        if full or not snapshot.exists():
+            return self.packages_to_rebuild
+        added, removed = snapshot.diff(p.buildinfos["old"] for p in self.packages_to_rebuild)
+        self.updated_buildinfos = added
+        log.debug(f"{self.snapshot_name}: {len(added)} added and {len(removed)} removed "
+                  f"buildinfos since last run")
+        return [p for p in self.packages_to_rebuild if p.buildinfos["old"] in added]
+
+    def save_snapshot(self):
+        # Don't forget everything on a transient failure to get repository
+        if not self.packages_to_rebuild:
+            return
+        try:
+            self.snapshot.save(p.buildinfos["old"] for p in self.packages_to_rebuild)
+        except OSError as e:
+            log.error(f"Cannot save {self.snapshot_name} snapshot: {str(e)}")
+
+    def get_package_sets_membership(self):
+        """
+        Return {package: package sets} for packages to rebuild.
+        """
+        membership = {}
+        for package_set in self.package_sets:
+            for p in self.get_packages_to_rebuild(package_set):
+                membership.setdefault(p, []).append(package_set)
+        return membership
+
+    def get_package_repository(self, package):
+        """
+        Return the name of the repository providing package, if any.
+        """
+        return None
+
+    def fetch_buildinfo_dates(self, packages):
+        """
+        Get the modification dates of the buildinfos of packages needed
+        by get_buildinfo_date() if they are not known from the repository.
+        """
+        pass
+
+    def get_buildinfo_date(self, package):
+        """
+        Return the modification date of the buildinfo of package as a
+        datetime or None if unknown.
+        """
+        return None
+
+    def get_buildinfo_age(self, package):
+        """
+        Return the age in days of the buildinfo of package or None if
+        unknown. Buildinfos which appeared since the last run are new.
+        """
+        mtime = self.get_buildinfo_date(package)
+        if mtime:
+            now = datetime.datetime.now(mtime.tzinfo) if mtime.tzinfo \
+                else datetime.datetime.utcnow()
+            return max((now - mtime).days, 0)
+        if package.buildinfos["old"] in self.updated_buildinfos:
+            return 0
+        return None
+
+    def get_snapshot_group(self, package):
+        """
+        Return the snapshot day (e.g. '20210615') the build dependencies of
+        package most likely come from, or None if unknown. A package was
+        built from the archive of the day its buildinfo was published.
+        """
+        mtime = self.get_buildinfo_date(package)
+        return mtime.strftime("%Y%m%d") if mtime else None
+
+    @property
+    def repository_snapshot(self):
+        return RepositorySnapshot(f"{self.cache_dir}/snapshots/{self.snapshot_name}.snapshot")
+
+    def publish_snapshot(self):
+        """
+        Publish packages to rebuild with their package sets so that the
+        reporter does not need to get the repository again.
+        """
+        if not self.packages_to_rebuild:
+            return
+        membership = self.get_package_sets_membership()
+        set_indexes = {package_set: idx for idx, package_set in enumerate(self.package_sets)}
+        records = (
+            ((p.name, None if p.epoch is None else str(p.epoch), p.version, p.arch,
+              p.distribution, p.buildinfos["old"]),
+             [set_indexes[ps] for ps in membership.get(p, ())])
+            for p in self.packages_to_rebuild
+        )
+        try:
+            generation = self.repository_snapshot.save(self.package_sets, records)
+            log.debug(f"{self.snapshot_name}: published snapshot {generation}")
+        except OSError as e:
+            log.error(f"Cannot publish {self.snapshot_name} snapshot: {str(e)}")
+
+    def load_snapshot(self):
+        """
+        Return {package set: packages} from the last published snapshot or
+        None if there is none. The repository itself is never fetched.
+        """
+        try:
+            generation, timestamp, package_sets, records = self.repository_snapshot.load()
+        except (OSError, ValueError) as e:
+            log.error(f"Cannot load {self.snapshot_name} snapshot: {str(e)}")
+            return None
+        log.debug(f"{self.snapshot_name}: loaded snapshot {generation} published at {timestamp}")
+        packages = {package_set: [] for package_set in package_sets}
+        self.packages_to_rebuild = []
+        for (name, epoch, version, arch, distribution, buildinfo), indexes in records:
+            package = getPackage({
+                "name": name, "epoch": epoch, "version": version, "arch": arch,
+                "distribution": distribution, "buildinfos": {"old": buildinfo}
+            })
+            self.packages_to_rebuild.append(package)
+            for idx in indexes:
+                packages[package_sets[idx]].append(package)
+        return packages
+
+
+class DebianRepository(BaseRepository):
     def __init__(self, distribution, arch, package_sets, **kwargs):
+        super().__init__(**kwargs)
         self.distribution = distribution
         self.arch = DEBIAN_ARCHES.get(arch, arch)
         self.package_sets = package_sets
-        self.packages = None
+        # name -> package of latest packages
+        self.packages_by_name = {}
+        # package sets tuple -> package names in the union of these sets
+        self.package_set_names = {}
         try:
             if is_debian(self.distribution):
                 if debian is None:
@@ -144,16 +417,54 @@ class DebianRepository:
             "package_sets_baseurl", f"https://jenkins.debian.net/userContent/reproducible/"
                                     f"debian/pkg-sets/{self.distribution}")
         self.buildinfos_baseurl = kwargs.get("buildinfos_baseurl", "https://buildinfos.debian.net")
+        self.http_cache = HTTPCache(self.cache_dir)
+        self.max_connections = kwargs.get("max_connections", DEFAULT_MAX_CONNECTIONS)
+        # remote buildinfo -> 'Last-Modified' date
+        self.buildinfo_dates = {}
+
+    @property
+    def snapshot_name(self):
+        return f"{self.distribution}+{'+'.join(self.package_sets)}.{self.arch}"
+
+    def fetch_buildinfo_dates(self, packages):
+        # buildinfo pool does not change a published file: dates are kept
+        urls = {p.buildinfos["old"] for p in packages} - self.buildinfo_dates.keys()
+        with BuildinfoIndex(f"{self.cache_dir}/buildinfos.sqlite") as index:
+            for url in urls:
+                date = index.get_mtime(url)
+                if date:
+                    self.buildinfo_dates[url] = date
+            to_fetch = urls - self.buildinfo_dates.keys()
+            log.debug(f"{self.snapshot_name}: {len(urls) - len(to_fetch)} indexed and "
+                      f"{len(to_fetch)} new buildinfo dates")
+            for url, resp in fetch_urls(to_fetch, max_workers=self.max_connections,
+                                        method="HEAD"):
+                if resp is None or not resp.ok or not resp.headers.get("Last-Modified"):
+                    continue
+                self.buildinfo_dates[url] = resp.headers["Last-Modified"]
+                index.set(url, mtime=self.buildinfo_dates[url])
+
+    def get_buildinfo_date(self, package):
+        date = self.buildinfo_dates.get(package.buildinfos["old"], None)
+        try:
+            return email.utils.parsedate_to_datetime(date) if date else None
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def parse_package_set(content):
+        return frozenset(p.strip() for p in content.strip('\n').split('\n'))
+
+    def parse_buildinfo_pool(self, content):
+        return tuple(f"{self.buildinfos_baseurl}{buildinfo}"
+                     for buildinfo in content.rstrip('\n').split('\n'))
 
     def get_package_names_in_debian_set(self, pkgset_name):
         packages = []
         url = f"{self.package_sets_baseurl}/{pkgset_name}.pkgset"
         try:
-            resp = requests.get(url)
-            if resp.ok:
-                content = [p.strip() for p in resp.text.strip('\n').split('\n')]
-                packages = set(sorted(content))
-        except requests.exceptions.ConnectionError as e:
+            packages = self.http_cache.get(url, parser=self.parse_package_set) or []
+        except requests.exceptions.RequestException as e:
             log.error(f"Failed to get {pkgset_name}: {str(e)}")
         return packages
 
@@ -161,74 +472,74 @@ class DebianRepository:
         files = []
         url = f"{self.buildinfos_baseurl}/buildinfo-pool_{self.distribution}_{self.arch}.list"
         try:
-            resp = requests.get(url)
-            if not resp.ok:
-                return files
-        except requests.exceptions.ConnectionError:
-            return files
-
-        buildinfo_pool = resp.text.rstrip('\n').split('\n')
-        for buildinfo in buildinfo_pool:
-            files.append(f"{self.buildinfos_baseurl}{buildinfo}")
+            files = self.http_cache.get(url, parser=self.parse_buildinfo_pool) or []
+        except requests.exceptions.RequestException:
+            pass
         return files
 
     def get_packages(self):
-        packages = {}
-        latest_packages = []
-        for f in self.get_buildinfo_files():
-            parsed_bn = parse_deb_buildinfo_fname(f)
-            if not parsed_bn:
-                continue
-            if not packages.get(parsed_bn['name'], None):
-                packages[parsed_bn['name']] = []
-            # fixme: ignore buildinfo having e.g. amd64-source?
-            if len(parsed_bn['arch']) > 1:
-                continue
-            if parsed_bn['arch'][0] != self.arch:
-                continue
-            rebuild = DebianPackage(
-                name=parsed_bn['name'],
-                epoch=parsed_bn['epoch'],
-                version=parsed_bn['version'],
+        # fixme: ignore buildinfo having e.g. amd64-source?
+        arch = (self.arch,)
+        candidates = [
+            (f, parsed_bn) for f, parsed_bn in parse_deb_buildinfo_fnames(self.get_buildinfo_files())
+            if parsed_bn.arch == arch
+        ]
+        latest = get_latest_versions(
+            candidates, key=lambda c: (c[1].name, debian_version_key(c[1].version)))
+        latest_packages = [
+            DebianPackage(
+                name=parsed_bn.name,
+                epoch=parsed_bn.epoch,
+                version=parsed_bn.version,
                 arch=self.arch,
                 distribution=self.distribution,
                 buildinfos={"old": f}
             )
-            packages[parsed_bn['name']].append(rebuild)
-        for pkg in packages.keys():
-            packages[pkg].sort(key=lambda pkg: parse_version(pkg.version), reverse=True)
-            if packages[pkg]:
-                latest_packages.append(packages[pkg][0])
+            for f, parsed_bn in latest.values()
+        ]
         self.packages = latest_packages
+        self.packages_by_name = {p.name: p for p in self.packages}
         return self.packages
 
+    def get_package_names_in_debian_sets(self, package_sets):
+        package_sets = tuple(sorted(set(package_sets)))
+        if package_sets not in self.package_set_names:
+            names = set()
+            for pkgset_name in package_sets:
+                if (pkgset_name,) not in self.package_set_names:
+                    self.package_set_names[(pkgset_name,)] = \
+                        frozenset(self.get_package_names_in_debian_set(pkgset_name))
+                names.update(self.package_set_names[(pkgset_name,)])
+            self.package_set_names[package_sets] = frozenset(names)
+        return self.package_set_names[package_sets]
+
     def get_packages_to_rebuild(self, package_set=None):
         if not self.packages:
             self.packages = self.get_packages()
-        packages_to_rebuild = []
-        filtered_package_names = []
         if package_set:
             package_sets = [package_set]
         else:
             package_sets = self.package_sets
-        if "full" not in package_sets:
-            for pkgset_name in package_sets:
-                filtered_package_names += self.get_package_names_in_debian_set(pkgset_name)
-            filtered_package_names = sorted(set(filtered_package_names))
-            for package in self.packages:
-                if package.name in filtered_package_names:
-                    packages_to_rebuild.append(package)
-        else:
-            packages_to_rebuild = self.packages
-        return packages_to_rebuild
+        if "full" in package_sets:
+            return self.packages
+        names = self.get_package_names_in_debian_sets(package_sets)
+        return [self.packages_by_name[name]
+                for name in sorted(names & self.packages_by_name.keys())]
 
 
-class QubesRepository:
-    def __init__(self, qubes_dist, arch):
+class QubesRepository(BaseRepository):
+    def __init__(self, qubes_dist, arch, **kwargs):
+        super().__init__(**kwargs)
         self.qubes_dist = qubes_dist
         self.distribution = None
         self.arch = arch
-        self.packages = None
+        self.max_connections = kwargs.get("max_connections", DEFAULT_MAX_CONNECTIONS)
+        # remote buildinfo -> (size, mtime) from repository listing
+        self.buildinfo_stats = {}
+        # remote files removed since previous repository listing
+        self.removed_files = set()
+        # listings saved once they have been processed
+        self.pending_listings = {}
         try:
             # fixme: clarify package_set being dom0/vm and packages set being pre-defined list
             #  of packages elsewhere.
@@ -246,104 +557,199 @@ class QubesRepository:
             raise RebuilderExceptionGet(
                 f"Failed to parse dist repository: {str(e)}")
 
+    @property
+    def snapshot_name(self):
+        return f"{self.qubes_dist}.{self.arch}"
+
+    def get_package_repository(self, package):
+        # e.g. https://yum.qubes-os.org/r4.1/security-testing/vm/fc32/rpm/...
+        parts = package.buildinfos["old"].split("/")
+        if f"r{self.release}" in parts:
+            repository = parts[parts.index(f"r{self.release}") + 1]
+            if repository in ("current", "current-testing", "security-testing"):
+                return repository
+        return None
+
+    def get_buildinfo_date(self, package):
+        stats = self.buildinfo_stats.get(package.buildinfos["old"], None)
+        if not stats or not stats[1]:
+            return None
+        try:
+            return datetime.datetime.strptime(stats[1], "%Y/%m/%d %H:%M:%S")
+        except ValueError:
+            return None
+
     @staticmethod
-    def get_rsync_files(url):
-        files = []
+    def get_rsync_listing(url):
+        """
+        Return {path: (size, mtime)} for every file of the remote rsync url.
+        """
+        listing = {}
         cmd = [
             "rsync", "--list-only", "--recursive",
             "--exclude=all-versions", url
         ]
-        result = subprocess.check_output(cmd)
-        lines = result.decode('utf8').strip('\n').split('\n')
-        for line in lines:
-            line = line.split()
-            if line[0].startswith('d'):
-                continue
-            files.append(line[-1])
-        return files
+        # Parse output while rsync is still listing
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True) as proc:
+            for line in proc.stdout:
+                # e.g. '-rw-rw-r--         11,392 2020/12/23 14:57:05 deb/r4.1/vm/...'
+                fields = line.rstrip('\n').split(None, 4)
+                if len(fields) != 5 or fields[0].startswith('d'):
+                    continue
+                perms, size, date, time, path = fields
+                if perms.startswith('l'):
+                    path = path.split(' -> ', 1)[0]
+                listing[path] = (int(size.replace(',', '')), f"{date} {time}")
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        return listing
+
+    def get_rsync_files(self, url):
+        return list(self.get_rsync_listing(url))
+
+    def get_rsync_listings(self, urls):
+        """
+        List remote urls concurrently. Return {url: (listing, added, removed)}
+        where added and removed are files changed since the previous listing
+        processed for the same distribution and arch.
+        """
+        def get_listing(url):
+            listing = self.get_rsync_listing(url)
+            # e.g. bullseye amd64 and all share the same url
+            key = f"{self.qubes_dist}:{self.arch}:{url}"
+            digest = hashlib.sha256(key.encode("utf8")).hexdigest()
+            snapshot = ListingSnapshot(f"{self.cache_dir}/rsync/{digest}.json")
+            added, removed = snapshot.diff(listing)
+            self.pending_listings[url] = (snapshot, listing)
+            return listing, added, removed
+
+        with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+            return dict(zip(urls, executor.map(get_listing, urls)))
+
+    def save_listings(self):
+        """
+        Save listings once their changes have been processed.
+        """
+        for url, (snapshot, listing) in self.pending_listings.items():
+            try:
+                snapshot.save(listing)
+            except OSError as e:
+                log.error(f"Cannot save listing of {url}: {str(e)}")
+        self.pending_listings = {}
 
     def get_buildinfo_files(self):
         files = []
         qubes_rsync_baseurl = "rsync://ftp.qubes-os.org/qubes-mirror/repo"
+        if is_fedora(self.distribution):
+            # relative url -> remote url of files
+            urls = {
+                f"r{self.release}/{repo}/{self.package_set}/{self.distribution}":
+                    "https://yum.qubes-os.org"
+                for repo in ["current", "current-testing", "security-testing"]
+            }
+            baseurl = f"{qubes_rsync_baseurl}/yum"
+        elif is_debian(self.distribution):
+            urls = {f"r{self.release}/vm": "https://deb.qubes-os.org"}
+            baseurl = f"{qubes_rsync_baseurl}/deb"
+        else:
+            raise RebuilderExceptionGet(f"Unknown dist: {self.distribution}")
         try:
-            if is_fedora(self.distribution):
-                for repo in ["current", "current-testing", "security-testing"]:
-                    baseurl = f"{qubes_rsync_baseurl}/yum"
-                    relurl = f"r{self.release}/{repo}/{self.package_set}/{self.distribution}"
-                    url = f"{baseurl}/{relurl}/"
-                    # WIP: wait for Fedora to merge RPM PR
-                    remote_files = [os.path.join(relurl, f)
-                                    for f in self.get_rsync_files(url)
-                                    if f.endswith(".buildinfo") or
-                                    re.match(r".*-buildinfo.*\.rpm", f)]
-                    files += [os.path.join("https://yum.qubes-os.org", f)
-                              for f in remote_files]
-            elif is_debian(self.distribution):
-                baseurl = f"{qubes_rsync_baseurl}/deb"
-                relurl = f"r{self.release}/vm"
-                url = f"{baseurl}/{relurl}/"
-                files = [os.path.join(relurl, f)
-                         for f in self.get_rsync_files(url)
-                         if f.endswith(".buildinfo")]
-                files = [os.path.join("https://deb.qubes-os.org", f)
-                         for f in files]
-            else:
-                raise RebuilderExceptionGet(f"Unknown dist: {self.distribution}")
-        except (ValueError, FileNotFoundError) as e:
+            listings = self.get_rsync_listings([f"{baseurl}/{relurl}/" for relurl in urls])
+        except (ValueError, FileNotFoundError, subprocess.CalledProcessError) as e:
             raise RebuilderExceptionGet(f"Failed to sync repository: {str(e)}")
+
+        for relurl, remote_baseurl in urls.items():
+            listing, _, removed = listings[f"{baseurl}/{relurl}/"]
+            for f, stats in listing.items():
+                # WIP: wait for Fedora to merge RPM PR
+                if f.endswith(".buildinfo") or \
+                        (is_fedora(self.distribution) and re.match(r".*-buildinfo.*\.rpm", f)):
+                    remote_file = os.path.join(remote_baseurl, relurl, f)
+                    self.buildinfo_stats[remote_file] = stats
+                    files.append(remote_file)
+            self.removed_files.update(os.path.join(remote_baseurl, relurl, f) for f in removed)
         return files
 
-    def get_packages(self):
-        packages = {}
-        latest_packages = []
-        for f in self.get_buildinfo_files():
-            if is_fedora(self.distribution):
-                parsed_bn = parse_rpm_buildinfo_fname(f)
-                if not parsed_bn:
-                    continue
-                if parsed_bn['arch'] not in ("noarch", self.arch):
-                    continue
-            elif is_debian(self.distribution):
-                resp = requests.get(f)
-                if not resp.ok:
-                    continue
-                parsed_bn = parse_deb_buildinfo_fname(f)
-                if not parsed_bn:
-                    continue
-                # fixme: QubesOS does not distinguish "all" and "amd64" in buildinfo names
-                parsed_buildinfo = debian.deb822.BuildInfo(resp.content)
-                architecture = [arch for arch in parsed_buildinfo["Architecture"].split()
-                                if arch not in ("source", "all")]
-                if architecture:
-                    # fixme: cannot predict which binary arch will be built
-                    build_arch = "amd64"
-                elif "all" in parsed_buildinfo["Architecture"].split():
-                    build_arch = "all"
-                else:
-                    continue
-                # self.arch is the request arch to rebuild
-                self.arch = DEBIAN_ARCHES.get(self.arch, self.arch)
-                if self.arch != build_arch:
-                    continue
-                if '+deb{}u'.format(DEBIAN.get(self.distribution)) not in \
-                        parsed_buildinfo['version']:
+    @staticmethod
+    def parse_buildinfo_architecture(content):
+        parsed_buildinfo = get_buildinfo_fields(content, ["Architecture", "Version"])
+        # fixme: QubesOS does not distinguish "all" and "amd64" in buildinfo names
+        architecture = parsed_buildinfo.get("Architecture", "")
+        if [arch for arch in architecture.split() if arch not in ("source", "all")]:
+            # fixme: cannot predict which binary arch will be built
+            build_arch = "amd64"
+        elif "all" in architecture.split():
+            build_arch = "all"
+        else:
+            build_arch = None
+        return {
+            "version": parsed_buildinfo.get("Version", ""),
+            "architecture": architecture,
+            "build_arch": build_arch
+        }
+
+    def get_debian_buildinfo_candidates(self, buildinfos):
+        # self.arch is the request arch to rebuild
+        self.arch = DEBIAN_ARCHES.get(self.arch, self.arch)
+        with BuildinfoIndex(f"{self.cache_dir}/buildinfos.sqlite") as index:
+            fields = {}
+            for f in buildinfos.keys():
+                indexed = index.get(f, *self.buildinfo_stats.get(f, (None, None)))
+                if indexed:
+                    fields[f] = indexed
+            to_fetch = [f for f in buildinfos.keys() if f not in fields]
+            log.debug(f"{self.qubes_dist}: {len(fields)} indexed and {len(to_fetch)} "
+                      f"new buildinfos")
+            for f, resp in fetch_urls(to_fetch, max_workers=self.max_connections):
+                if resp is None or not resp.ok:
                     continue
-            else:
+                fields[f] = self.parse_buildinfo_architecture(resp.content)
+                fields[f].update(name=buildinfos[f].name, epoch=buildinfos[f].epoch)
+                index.set(f, *self.buildinfo_stats.get(f, (None, None)), **fields[f])
+            # forget buildinfos removed from repository
+            index.delete(self.removed_files)
+
+        for f, buildinfo_fields in fields.items():
+            if self.arch != buildinfo_fields["build_arch"]:
                 continue
-            if not packages.get(parsed_bn['name'], []):
-                packages[parsed_bn['name']] = []
-            rebuild = QubesPackage(
-                name=parsed_bn['name'],
-                epoch=parsed_bn['epoch'],
-                version=parsed_bn['version'],
+            if '+deb{}u'.format(DEBIAN.get(self.distribution)) not in \
+                    buildinfo_fields['version']:
+                continue
+            yield f, buildinfos[f]
+
+    def get_packages(self):
+        candidates = []
+        if is_fedora(self.distribution):
+            candidates = [
+                (f, parsed_bn)
+                for f, parsed_bn in parse_rpm_buildinfo_fnames(self.get_buildinfo_files())
+                if parsed_bn.arch in ("noarch", self.arch)
+            ]
+        elif is_debian(self.distribution):
+            # Architecture and version are only known from buildinfo content
+            buildinfos = dict(parse_deb_buildinfo_fnames(self.get_buildinfo_files()))
+            if buildinfos:
+                candidates = list(self.get_debian_buildinfo_candidates(buildinfos))
+        # buildinfo index is up to date with the listings
+        self.save_listings()
+        if is_fedora(self.distribution):
+            def version_key(c):
+                return c[1].name, rpm_version_key(c[1].version, c[1].epoch)
+        else:
+            def version_key(c):
+                return c[1].name, debian_version_key(c[1].version)
+        latest = get_latest_versions(candidates, key=version_key)
+        latest_packages = [
+            QubesPackage(
+                name=parsed_bn.name,
+                epoch=parsed_bn.epoch,
+                version=parsed_bn.version,
                 arch=self.arch,
                 distribution=self.qubes_dist,
                 buildinfos={"old": f},
             )
-            packages[parsed_bn['name']].append(rebuild)
-        for pkg in packages.keys():
-            packages[pkg].sort(key=lambda pkg: parse_version(pkg.version), reverse=True)
-            latest_packages.append(packages[pkg][0])
+            for f, parsed_bn in latest.values()
+        ]
         return latest_packages
 
     def get_packages_to_rebuild(self, package_set=None):
@@ -353,7 +759,7 @@ class QubesRepository:
 
 
 class RebuilderDist:
-    def __init__(self, dist):
+    def __init__(self, dist, **kwargs):
         try:
             # 'dist' is defined as:
             #   {distribution}+{package_set_1}+{package_set_2}+...+{package_set_N}.{arch}
@@ -380,11 +786,12 @@ class RebuilderDist:
             raise RebuilderExceptionDist(f"Cannot parse dist: {dist}.")
 
         if is_qubes(self.distribution):
-            self.repo = QubesRepository(self.distribution, self.arch)
+            self.repo = QubesRepository(self.distribution, self.arch, **kwargs)
         elif is_fedora(self.distribution):
             self.repo = FedoraRepository(self.distribution)
         elif is_debian(self.distribution):
-            self.repo = DebianRepository(self.distribution, self.arch, self.package_sets)
+            self.repo = DebianRepository(self.distribution, self.arch, self.package_sets,
+                                         **kwargs)
         else:
             raise RebuilderExceptionDist(f"Unsupported distribution: {dist}")
 
@@ -0,0 +1,71 @@
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2021 Frédéric Pierret (fepitre) <frederic.pierret@qubes-os.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Rebuild tasks are published with a priority used by the Redis broker to
+# store them into priority lanes: 'rebuild' (0) is consumed first, then
+# 'rebuild:1' and so on until 'rebuild:9'. A package gets the default
+# priority minus the sum of its configured weights, so a higher weight
+# means that the package is rebuilt sooner.
+
+from app.config import Config
+
+DEFAULT_PRIORITY = 5
+MIN_PRIORITY = 0
+MAX_PRIORITY = 9
+PRIORITY_STEPS = list(range(MIN_PRIORITY, MAX_PRIORITY + 1))
+PRIORITY_SEP = ":"
+
+
+def get_priority_weights(project):
+    options = Config["project"].get(project, {})
+    return {
+        "package-sets": options.get("priority-package-sets", {}),
+        "repositories": options.get("priority-repositories", {}),
+        # buildinfo age in days -> weight
+        "buildinfo-age": {
+            int(days): weight for days, weight in options.get("priority-buildinfo-age", {}).items()
+        },
+        "retry": options.get("priority-retry", Config["common"]["priority-retry"]),
+    }
+
+
+def clamp_priority(priority):
+    return min(max(priority, MIN_PRIORITY), MAX_PRIORITY)
+
+
+def get_rebuild_priority(weights, package_sets=(), repository=None, buildinfo_age=None,
+                         retries=0):
+    # Only the most important package set counts: a package being in
+    # several sets is not rebuilt sooner than the set it is the most
+    # important for.
+    score = max((weights["package-sets"].get(ps, 0) for ps in package_sets), default=0)
+    if repository:
+        score += weights["repositories"].get(repository, 0)
+    if buildinfo_age is not None:
+        for days in sorted(weights["buildinfo-age"]):
+            if buildinfo_age <= days:
+                score += weights["buildinfo-age"][days]
+                break
+    score += retries * weights["retry"]
+    return clamp_priority(DEFAULT_PRIORITY - score)
+
+
+def get_queue_lanes(queue_name):
+    return [queue_name] + [f"{queue_name}{PRIORITY_SEP}{pri}" for pri in PRIORITY_STEPS if pri]
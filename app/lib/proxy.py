@@ -0,0 +1,386 @@
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2021 Frédéric Pierret (fepitre) <frederic.pierret@qubes-os.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# HTTP proxy given to debrebuild for downloading build dependencies and
+# original binary packages. Downloaded .deb files are stored by SHA256 in
+# a cache shared by every rebuilder using the same cache directory. A file
+# is found again by its name: in a Debian archive, a package file name
+# always refers to the same content. A file is only stored once verified
+# against the checksums of the buildinfo being rebuilt or against the SHA256
+# given by a snapshot Packages index downloaded through the proxy. Files
+# which cannot be verified are not shared.
+#
+# Snapshot content does not change for a given timestamp: APT index files
+# of a timestamp are stored once for every build, and snapshot service
+# answers about a package version are kept in a persistent resolver cache.
+#
+# Only plain HTTP requests can be cached. HTTPS requests are tunneled to
+# their destination as is and nothing they download is cached.
+
+import bz2
+import collections
+import gzip
+import hashlib
+import http.server
+import lzma
+import os
+import re
+import selectors
+import socket
+import tempfile
+import threading
+import urllib.parse
+
+import requests
+
+from app.lib.cache import LRUStore, ResolverCache
+from app.lib.common import get_buildinfo_fields
+from app.lib.log import log
+
+PROXY_CHUNK_SIZE = 64 * 1024
+# Share of the cache budget given to APT index files, the rest is for .deb
+# files
+INDEX_BUDGET_SHARE = 0.2
+
+# e.g. http://snapshot.notset.fr/archive/debian/20210615T000000Z/dists/...
+SNAPSHOT_TIMESTAMP_RE = re.compile(r"/(\d{8}T\d{6}Z)/")
+# e.g. /mr/binary/bash/5.1-2+b3/binfiles
+SNAPSHOT_QUERY_RE = re.compile(r"/mr/[^/]+/(?P<name>[^/]+)/(?P<version>[^/]+)(/|$)")
+
+
+def parse_packages_index(content):
+    """
+    Yield (file name, sha256) of the packages of an APT Packages index,
+    possibly compressed. Nothing is yielded for other files.
+    """
+    try:
+        if content.startswith(b"\xfd7zXZ\x00"):
+            content = lzma.decompress(content)
+        elif content.startswith(b"\x1f\x8b"):
+            content = gzip.decompress(content)
+        elif content.startswith(b"BZh"):
+            content = bz2.decompress(content)
+    except (lzma.LZMAError, OSError, EOFError, ValueError):
+        return
+    if not content.startswith(b"Package: "):
+        return
+    filename = sha256 = None
+    for line in content.splitlines() + [b""]:
+        if not line:
+            if filename and sha256:
+                yield os.path.basename(filename), sha256
+            filename = sha256 = None
+        elif line.startswith(b"Filename: "):
+            filename = line[10:].strip().decode()
+        elif line.startswith(b"SHA256: "):
+            sha256 = line[8:].strip().decode()
+
+
+def parse_snapshot_query(url):
+    """
+    Return (name, version, arch) the snapshot service query url is about
+    or None if it does not refer to a package version.
+    """
+    url = urllib.parse.urlsplit(url)
+    query = urllib.parse.parse_qs(url.query)
+    parsed = SNAPSHOT_QUERY_RE.search(url.path)
+    if parsed:
+        name, version = parsed.group("name"), parsed.group("version")
+    else:
+        name, version = query.get("pkg", [None])[0], query.get("ver", [None])[0]
+    if not name or not version:
+        return None
+    return urllib.parse.unquote(name), urllib.parse.unquote(version), query.get("arch", [None])[0]
+
+
+class DebCache:
+    def __init__(self, cache_dir, budget=None):
+        index_budget = int(budget * INDEX_BUDGET_SHARE) if budget else None
+        self.store = LRUStore(f"{cache_dir}/debs/blobs",
+                              budget=budget - index_budget if budget else None)
+        self.names_dir = f"{cache_dir}/debs/names"
+        os.makedirs(self.names_dir, exist_ok=True)
+        # APT index files keyed by URL path which includes the timestamp
+        self.indexes = LRUStore(f"{cache_dir}/indexes", budget=index_budget)
+        self.resolver = ResolverCache(f"{cache_dir}/resolver.sqlite")
+        # {file name: sha256} from buildinfo files
+        self.checksums = {}
+        # snapshot timestamp -> number of .deb files it served
+        self.timestamps = collections.Counter()
+
+    def add_checksums(self, buildinfo):
+        fields = get_buildinfo_fields(buildinfo, ["Checksums-Sha256"])
+        for line in fields.get("Checksums-Sha256", "").splitlines():
+            if len(line.split()) == 3:
+                sha256, _, filename = line.split()
+                self.checksums[filename] = sha256
+
+    def add_index_checksums(self, path):
+        with open(path, "rb") as fd:
+            self.resolver.set_checksums(parse_packages_index(fd.read()))
+
+    def get_checksum(self, filename):
+        """
+        Return the expected sha256 of filename or None if it cannot be
+        verified.
+        """
+        return self.checksums.get(filename, None) or self.resolver.get_checksum(filename)
+
+    def get(self, filename):
+        """
+        Return the path of the cached filename or None.
+        """
+        link = f"{self.names_dir}/{filename}"
+        try:
+            sha256 = os.path.basename(os.readlink(link))
+        except OSError:
+            self.store.misses += 1
+            return None
+        if self.get_checksum(filename) not in (None, sha256):
+            log.error(f"{filename}: cached file does not match expected checksum")
+            self.store.misses += 1
+            return None
+        # None if evicted
+        return self.store.get(sha256)
+
+    def put(self, filename, src, sha256):
+        expected = self.get_checksum(filename)
+        if expected != sha256:
+            os.remove(src)
+            if not expected:
+                raise ValueError(f"{filename}: cannot be verified")
+            raise ValueError(f"{filename}: checksum mismatch ({sha256} != {expected})")
+        path = self.store.put(sha256, src)
+        tmp_link = f"{self.names_dir}/.{filename}.{threading.get_ident()}"
+        os.symlink(os.path.relpath(path, self.names_dir), tmp_link)
+        os.replace(tmp_link, f"{self.names_dir}/{filename}")
+        return path
+
+    def stats(self):
+        return self.store.stats()
+
+    def get_timestamps(self):
+        """
+        Return timestamps from the one serving the most .deb files.
+        """
+        return [timestamp for timestamp, _ in
+                sorted(self.timestamps.items(), key=lambda item: (-item[1], item[0]))]
+
+    def close(self):
+        self.resolver.close()
+
+
+class DebCacheProxyHandler(http.server.BaseHTTPRequestHandler):
+    # set by DebCacheProxy
+    cache = None
+    session = None
+    resolver_urls = ()
+    timeout = 60
+
+    def log_message(self, format, *args):
+        log.debug(f"proxy: {format % args}")
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.scheme != "http":
+            log.warning(f"proxy: {self.path}: only HTTP URLs are proxied")
+            self.send_error(501, "Only HTTP URLs are proxied")
+            return
+        filename = os.path.basename(url.path)
+        timestamp = SNAPSHOT_TIMESTAMP_RE.search(url.path)
+        if timestamp:
+            # indexes only tell that a timestamp is used
+            self.cache.timestamps[timestamp.group(1)] += int(filename.endswith(".deb"))
+        try:
+            if filename.endswith(".deb"):
+                self.send_deb(self.path, filename)
+            elif timestamp:
+                self.send_index(self.path, url.path)
+            elif self.path.startswith(self.resolver_urls) and parse_snapshot_query(self.path):
+                self.send_query(self.path)
+            else:
+                self.send_remote(self.path, filename)
+        except (requests.exceptions.RequestException, OSError, ValueError) as e:
+            log.error(f"proxy: {self.path}: {str(e)}")
+            self.send_error(502, str(e))
+
+    def do_CONNECT(self):
+        # HTTPS content cannot be cached
+        log.warning(f"proxy: {self.path}: HTTPS is tunneled, nothing is cached")
+        host, _, port = self.path.rpartition(":")
+        try:
+            remote = socket.create_connection((host, int(port)), timeout=self.timeout)
+        except (OSError, ValueError) as e:
+            self.send_error(502, str(e))
+            return
+        self.send_response(200, "Connection established")
+        self.end_headers()
+        self.close_connection = True
+        with remote, selectors.DefaultSelector() as selector:
+            selector.register(self.connection, selectors.EVENT_READ, remote)
+            selector.register(remote, selectors.EVENT_READ, self.connection)
+            while True:
+                events = selector.select(timeout=self.timeout)
+                if not events:
+                    # idle tunnel
+                    return
+                for key, _ in events:
+                    try:
+                        data = key.fileobj.recv(PROXY_CHUNK_SIZE)
+                        if data:
+                            key.data.sendall(data)
+                    except OSError:
+                        data = None
+                    if not data:
+                        return
+
+    def send_file(self, path, content_type="application/vnd.debian.binary-package"):
+        with open(path, "rb") as fd:
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(os.fstat(fd.fileno()).st_size))
+            self.end_headers()
+            self.wfile.flush()
+            self.connection.sendfile(fd)
+
+    def send_deb(self, url, filename):
+        path = self.cache.get(filename)
+        if not path:
+            if not self.cache.get_checksum(filename):
+                # not shared with other builds
+                log.debug(f"proxy: {filename} cannot be verified, not cached")
+                self.send_remote(url, filename)
+                return
+            path = self.download_deb(url, filename)
+            if not path:
+                return
+        self.send_file(path)
+
+    def download(self, url, store):
+        """
+        Download url into a temporary file of store and return its path
+        with its SHA256.
+        """
+        resp = self.session.get(url, stream=True, timeout=self.timeout)
+        if not resp.ok:
+            self.send_error(resp.status_code)
+            return None, None
+        digest = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=store.path, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in resp.iter_content(PROXY_CHUNK_SIZE):
+                    digest.update(chunk)
+                    f.write(chunk)
+        except (requests.exceptions.RequestException, OSError):
+            os.remove(tmp)
+            raise
+        return tmp, digest.hexdigest()
+
+    def download_deb(self, url, filename):
+        tmp, sha256 = self.download(url, self.cache.store)
+        if not tmp:
+            return None
+        try:
+            return self.cache.put(filename, tmp, sha256)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def send_index(self, url, path):
+        key = hashlib.sha256(path.encode("utf8")).hexdigest()
+        cached = self.cache.indexes.get(key)
+        if not cached:
+            tmp, _ = self.download(url, self.cache.indexes)
+            if not tmp:
+                return
+            # packages of the timestamp can be verified
+            self.cache.add_index_checksums(tmp)
+            cached = self.cache.indexes.put(key, tmp)
+        self.send_file(cached, content_type="application/octet-stream")
+
+    def send_query(self, url):
+        cached = self.cache.resolver.get(url)
+        if not cached:
+            resp = self.session.get(url, timeout=self.timeout)
+            if not resp.ok:
+                self.send_error(resp.status_code)
+                return
+            name, version, arch = parse_snapshot_query(url)
+            cached = (resp.headers.get("Content-Type", "application/json"), resp.content)
+            self.cache.resolver.set(url, *cached, name=name, version=version, arch=arch)
+        content_type, content = cached
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_remote(self, url, filename):
+        resp = self.session.get(url, timeout=self.timeout)
+        if filename.endswith(".buildinfo") and resp.ok:
+            self.cache.add_checksums(resp.content)
+        self.send_response(resp.status_code)
+        for header in ("Content-Type", "Last-Modified", "ETag"):
+            if header in resp.headers:
+                self.send_header(header, resp.headers[header])
+        self.send_header("Content-Length", str(len(resp.content)))
+        self.end_headers()
+        self.wfile.write(resp.content)
+
+
+class DebCacheProxy:
+    """
+    Local HTTP caching proxy for .deb files running in a background thread.
+    """
+    def __init__(self, cache_dir, budget=None, resolver_urls=(), host="127.0.0.1", port=0):
+        self.cache = DebCache(cache_dir, budget=budget)
+        handler = type("Handler", (DebCacheProxyHandler,), {
+            "cache": self.cache,
+            "session": requests.Session(),
+            # snapshot services whose answers are cached
+            "resolver_urls": tuple(resolver_urls),
+        })
+        self.server = http.server.ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread:
+            self.thread.join()
+        self.cache.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
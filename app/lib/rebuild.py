@@ -18,21 +18,38 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import contextlib
+import functools
+import gzip
+import importlib.util
+import logging
 import os
 import shutil
 import subprocess
+import sys
 import time
 import tempfile
-import glob
+import traceback
+
+import requests
 
 from app.config import Config
-from app.lib.common import is_qubes, is_debian, is_fedora
+from app.lib.common import is_qubes, is_debian, is_fedora, move_path, get_buildinfo_fields
 from app.lib.exceptions import RebuilderExceptionBuild
+from app.lib.log import log
+from app.lib.proxy import DebCacheProxy
+from app.lib.slots import BuildSlots, set_memory_ceiling
 
 
 # fixme: don't use wrapper but import directly Rebuilder functions
-#       from debrebuild and rpmreproduce
+#       from rpmreproduce
+
+# Size of build output read at once when a compressed log copy is written
+LOG_CHUNK_SIZE = 64 * 1024
 
+DEBREBUILD_PATH = "/opt/debrebuild/debrebuild.py"
+# Loaded debrebuild modules as {path: module}, None if it cannot be loaded
+_debrebuild_modules = {}
 
 def getRebuilder(distribution, **kwargs):
     if is_qubes(distribution):
@@ -44,6 +61,14 @@ def getRebuilder(distribution, **kwargs):
                 package_set=package_set,
                 snapshot_query_url=Config["project"].get("qubesos", {}).get('snapshot', None),
                 snapshot_mirror=Config["project"].get("qubesos", {}).get('snapshot', None),
+                compress_log=Config["project"].get("qubesos", {}).get('compress-log', False),
+                deb_cache=Config["project"].get("qubesos", {}).get('deb-cache', False),
+                deb_cache_size=Config["project"].get("qubesos", {}).get('deb-cache-size', None),
+                build_slots=Config["project"].get("qubesos", {}).get('build-slots', None),
+                build_memory=Config["project"].get("qubesos", {}).get('build-memory', None),
+                build_disk=Config["project"].get("qubesos", {}).get('build-disk', None),
+                build_job_memory=Config["project"].get("qubesos", {}).get('build-job-memory', None),
+                build_slot_timeout=Config["project"].get("qubesos", {}).get('build-slot-timeout', None),
                 **kwargs
             )
         elif is_fedora(distribution):
@@ -56,6 +81,14 @@ def getRebuilder(distribution, **kwargs):
         rebuilder = DebianRebuilder(
             snapshot_query_url=Config["project"].get("debian", {}).get('snapshot', None),
             snapshot_mirror=Config["project"].get("debian", {}).get('snapshot', None),
+            compress_log=Config["project"].get("debian", {}).get('compress-log', False),
+            deb_cache=Config["project"].get("debian", {}).get('deb-cache', False),
+            deb_cache_size=Config["project"].get("debian", {}).get('deb-cache-size', None),
+            build_slots=Config["project"].get("debian", {}).get('build-slots', None),
+            build_memory=Config["project"].get("debian", {}).get('build-memory', None),
+            build_disk=Config["project"].get("debian", {}).get('build-disk', None),
+            build_job_memory=Config["project"].get("debian", {}).get('build-job-memory', None),
+            build_slot_timeout=Config["project"].get("debian", {}).get('build-slot-timeout', None),
             **kwargs
         )
     else:
@@ -67,14 +100,147 @@ class BaseRebuilder:
     def __init__(self, **kwargs):
         self.sign_keyid = kwargs.get('sign_keyid', None)
         self.artifacts_dir = kwargs.get('artifacts_dir', "/var/lib/rebuilder/artifacts")
+        # write a gzip copy of the build log while building
+        self.compress_log = kwargs.get('compress_log', False)
 
-    @staticmethod
-    def gen_temp_dir(package):
+    def gen_temp_dir(self, package):
+        # build on the same filesystem than artifacts for publishing them by renaming
+        workdir = f"{self.artifacts_dir}/.build"
+        os.makedirs(workdir, exist_ok=True)
         tempdir = tempfile.mkdtemp(
             prefix=f"{package.name}-{package.version}",
+            dir=workdir
         )
         return tempdir
 
+    def run_logged(self, cmd, logfile, env=None, memory_limit=None):
+        """
+        Run cmd with its output written to logfile while it runs. With
+        memory_limit, the data segment size of every process of cmd is
+        limited.
+        """
+        preexec_fn = functools.partial(set_memory_ceiling, memory_limit) if memory_limit else None
+        with contextlib.ExitStack() as stack:
+            fd = stack.enter_context(open(logfile, 'wb'))
+            if not self.compress_log:
+                # the output goes straight from the process to the log file
+                return subprocess.run(cmd, stdout=fd, stderr=subprocess.STDOUT, env=env,
+                                      preexec_fn=preexec_fn)
+            gzfd = stack.enter_context(gzip.open(f"{logfile}.gz", 'wb'))
+            process = stack.enter_context(subprocess.Popen(
+                cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env,
+                preexec_fn=preexec_fn))
+            while True:
+                chunk = process.stdout.read1(LOG_CHUNK_SIZE)
+                if not chunk:
+                    break
+                fd.write(chunk)
+                # keep the log readable while building
+                fd.flush()
+                gzfd.write(chunk)
+            process.wait()
+            return subprocess.CompletedProcess(cmd, process.returncode)
+
+
+def load_debrebuild(path=DEBREBUILD_PATH):
+    """
+    Import debrebuild from path once per worker process. Return None if
+    it cannot be used in-process.
+    """
+    if path not in _debrebuild_modules:
+        module = None
+        try:
+            spec = importlib.util.spec_from_file_location("debrebuild", path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            if not callable(getattr(module, "main", None)):
+                log.error(f"Cannot find debrebuild entry point in {path}")
+                module = None
+        except (ImportError, OSError, SyntaxError) as e:
+            log.debug(f"Cannot load debrebuild from {path}: {str(e)}")
+            module = None
+        _debrebuild_modules[path] = module
+    return _debrebuild_modules[path]
+
+
+def get_stream_handlers(exclude=None):
+    """
+    Return (handler, fd) of the logging handlers writing to the standard
+    output or error of the process. Handlers of the exclude logger and of
+    its children are omitted.
+    """
+    loggers = [logging.getLogger()] + [
+        logger for name, logger in logging.Logger.manager.loggerDict.items()
+        if isinstance(logger, logging.Logger) and not (
+            exclude and (logger is exclude or name.startswith(f"{exclude.name}.")))
+    ]
+    handlers = []
+    for logger in loggers:
+        for handler in logger.handlers:
+            if not isinstance(handler, logging.StreamHandler):
+                continue
+            try:
+                fd = handler.stream.fileno()
+            except (AttributeError, OSError, ValueError):
+                continue
+            if fd in (1, 2) and handler not in [h for h, _ in handlers]:
+                handlers.append((handler, fd))
+    return handlers
+
+
+class RebuildResult:
+    """
+    Result of a debrebuild run: status, produced files with their SHA256
+    and timings in seconds of every phase.
+    """
+    STATUSES = {0: "reproducible", 2: "unreproducible"}
+
+    def __init__(self, returncode, cmd, in_process=False):
+        self.returncode = returncode
+        self.cmd = cmd
+        self.in_process = in_process
+        self.status = self.STATUSES.get(returncode, "failure")
+        self.files = {}
+        self.buildinfo = None
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def timing(self, phase):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timings[phase] = round(time.monotonic() - start, 1)
+
+    def collect(self, output, name):
+        """
+        Record files produced in output. Hashes are the ones recorded by
+        the build in the new buildinfo.
+        """
+        files = sorted(entry.name for entry in os.scandir(output) if entry.is_file())
+        for f in files:
+            if f.startswith(f"{name}_") and f.endswith(".buildinfo"):
+                self.buildinfo = f"{output}/{f}"
+                break
+        hashes = {}
+        if self.buildinfo:
+            with open(self.buildinfo, "rb") as fd:
+                checksums = get_buildinfo_fields(fd, ["Checksums-Sha256"])
+            for line in checksums.get("Checksums-Sha256", "").splitlines():
+                if len(line.split()) == 3:
+                    sha256, _, f = line.split()
+                    hashes[f] = sha256
+        self.files = {f: hashes.get(f, None) for f in files}
+
+    def to_dict(self):
+        return {
+            "status": self.status,
+            "returncode": self.returncode,
+            "in_process": self.in_process,
+            "files": self.files,
+            "timings": self.timings,
+        }
+
 
 class FedoraRebuilder:
     def __init__(self, **kwargs):
@@ -91,13 +257,130 @@ class DebianRebuilder(BaseRebuilder):
             'snapshot_query_url', 'http://snapshot.notset.fr')
         self.snapshot_mirror = kwargs.get(
             'snapshot_mirror', "http://snapshot.notset.fr")
+        # queried by debrebuild for '--use-metasnap'
+        self.metasnap_url = kwargs.get('metasnap_url', "http://metasnap.debian.net")
         self.extra_build_args = None
+        # shared by rebuilders using the same artifacts directory
+        self.cache_dir = kwargs.get('cache_dir', f"{self.artifacts_dir}/.cache")
+        # download build dependencies and original binaries through a caching proxy
+        self.deb_cache = kwargs.get('deb_cache', False)
+        self.deb_cache_size = kwargs.get('deb_cache_size', None)
+        self.debrebuild_path = kwargs.get('debrebuild_path', DEBREBUILD_PATH)
+        # run debrebuild in the worker process rather than in a new interpreter
+        self.in_process = kwargs.get('in_process', True)
+        # admit builds according to the resources of the host
+        build_slots = kwargs.get('build_slots', None)
+        self.build_slots = BuildSlots(
+            self.artifacts_dir,
+            build_slots,
+            memory=kwargs.get('build_memory', None),
+            disk=kwargs.get('build_disk', None),
+            job_memory=kwargs.get('build_job_memory', None),
+            timeout=kwargs.get('build_slot_timeout', None)
+        ) if build_slots else None
+
+    @staticmethod
+    def run_in_process(module, args, logfile, env=None, memory_limit=None):
+        """
+        Run debrebuild main() with args and return its exit code. It runs
+        in a child forked from the worker, which already imported it, so
+        that env, the build environment, and the redirections never change
+        the worker process, e.g. while its proxy thread or Celery heartbeat
+        run. Standard output and error, inherited by the build processes,
+        and debrebuild logging are sent to logfile. Worker logging keeps
+        going to the worker standard output and error. With memory_limit,
+        the data segment size of the child and of every build process is
+        limited.
+        """
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            returncode = 1
+            try:
+                if memory_limit:
+                    set_memory_ceiling(memory_limit)
+                returncode = DebianRebuilder._run_main(module, args, logfile, env)
+            finally:
+                # never go back to the worker code in the child
+                os._exit(returncode)
+        _, status = os.waitpid(pid, 0)
+        return os.waitstatus_to_exitcode(status)
+
+    @staticmethod
+    def _run_main(module, args, logfile, env=None):
+        if env is not None:
+            os.environ.clear()
+            os.environ.update(env)
+        debrebuild_logger = getattr(module, "logger", None)
+        if not isinstance(debrebuild_logger, logging.Logger):
+            debrebuild_logger = logging.getLogger(module.__name__)
+        saved_fds = os.dup(1), os.dup(2)
+        worker_streams = {
+            fd: open(saved_fd, 'w', buffering=1, closefd=False)
+            for fd, saved_fd in zip((1, 2), saved_fds)
+        }
+        # worker handlers write to the worker standard output and error,
+        # not to the build log
+        for worker_handler, worker_fd in get_stream_handlers(exclude=debrebuild_logger):
+            worker_handler.setStream(worker_streams[worker_fd])
+        with open(logfile, 'ab', buffering=0) as fd:
+            os.dup2(fd.fileno(), 1)
+            os.dup2(fd.fileno(), 2)
+        sys.stdout = sys.stderr = stream = open(1, 'w', buffering=1, closefd=False)
+        debrebuild_logger.addHandler(logging.StreamHandler(stream))
+        debrebuild_logger.propagate = False
+        try:
+            sys.argv = [module.__file__] + args
+            module.main()
+            returncode = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                returncode = e.code or 0
+            else:
+                stream.write(f"{e.code}\n")
+                returncode = 1
+        except Exception:
+            stream.write(traceback.format_exc())
+            returncode = 1
+        stream.flush()
+        for worker_stream in worker_streams.values():
+            worker_stream.flush()
+        return returncode
+
+    @staticmethod
+    def get_build_env(slot=None):
+        """
+        Return the environment of a build run with the resources of slot.
+        """
+        env = os.environ.copy()
+        if slot:
+            options = [opt for opt in env.get("DEB_BUILD_OPTIONS", "").split()
+                       if not opt.startswith("parallel=")]
+            env["DEB_BUILD_OPTIONS"] = " ".join(options + [f"parallel={slot.jobs}"])
+        return env
 
-    def debrebuild(self, tempdir, package):
-        # WIP: use internal Rebuilder class instead of wrapping through shell
-        build_cmd = [
-            "python3",
-            "/opt/debrebuild/debrebuild.py",
+    @staticmethod
+    def add_buildinfo_checksums(proxy, buildinfo):
+        """
+        Verify original binaries downloaded through proxy against the
+        checksums of buildinfo, a local path or an URL.
+        """
+        try:
+            if os.path.exists(buildinfo):
+                with open(buildinfo, "rb") as fd:
+                    content = fd.read()
+            else:
+                resp = requests.get(buildinfo, timeout=60)
+                resp.raise_for_status()
+                content = resp.content
+        except (OSError, requests.exceptions.RequestException) as e:
+            log.error(f"Cannot get checksums of {buildinfo}: {str(e)}")
+            return
+        proxy.cache.add_checksums(content)
+
+    def debrebuild(self, tempdir, package, logfile, slot=None):
+        build_args = [
             "--debug",
             "--use-metasnap",
             "--builder=mmdebstrap",
@@ -107,63 +390,104 @@ class DebianRebuilder(BaseRebuilder):
             "--build-options-nocheck"
         ]
         if self.sign_keyid:
-            build_cmd += ["--gpg-sign-keyid", self.sign_keyid]
+            build_args += ["--gpg-sign-keyid", self.sign_keyid]
         if self.extra_build_args:
-            build_cmd += self.extra_build_args
-        build_cmd += [package.buildinfos["old"]]
+            build_args += self.extra_build_args
 
-        # rebuild
-        env = os.environ.copy()
-        result = subprocess.run(build_cmd, stdout=subprocess.PIPE,
-                                stderr=subprocess.STDOUT, env=env)
-        return result, build_cmd
+        with contextlib.ExitStack() as stack:
+            proxy = None
+            if self.deb_cache:
+                proxy = stack.enter_context(DebCacheProxy(
+                    self.cache_dir,
+                    budget=self.deb_cache_size * 1024 * 1024 if self.deb_cache_size else None,
+                    # answers about a package version, e.g. its timestamps
+                    resolver_urls=[self.snapshot_query_url, self.metasnap_url]
+                ))
+                build_args += [f"--proxy={proxy.url}"]
+                self.add_buildinfo_checksums(proxy, package.buildinfos["old"])
+            build_args += [package.buildinfos["old"]]
+            build_cmd = ["python3", self.debrebuild_path] + build_args
 
-    def run(self, package):
+            env = self.get_build_env(slot)
+            memory_limit = slot.memory if slot else None
+
+            # rebuild
+            module = load_debrebuild(self.debrebuild_path) if self.in_process else None
+            start = time.monotonic()
+            if module:
+                returncode = self.run_in_process(module, build_args, logfile, env=env,
+                                                 memory_limit=memory_limit)
+                if self.compress_log:
+                    with open(logfile, 'rb') as fd, gzip.open(f"{logfile}.gz", 'wb') as gzfd:
+                        shutil.copyfileobj(fd, gzfd, LOG_CHUNK_SIZE)
+            else:
+                # fallback when debrebuild cannot be imported
+                returncode = self.run_logged(
+                    build_cmd, logfile, env=env, memory_limit=memory_limit
+                ).returncode
+            result = RebuildResult(returncode, build_cmd, in_process=bool(module))
+            result.timings["build"] = round(time.monotonic() - start, 1)
+
+            if proxy:
+                package["debcache"] = proxy.cache.stats()
+                # allow to group builds needing the same snapshot timestamps
+                package.timestamps = proxy.cache.get_timestamps()
+                log.debug(f"{package}: .deb cache {package['debcache']['hits']} hits, "
+                          f"{package['debcache']['misses']} misses")
+        return result
+
+    def run(self, package, log_callback=None):
         logfile = f"{package}-{str(int(time.time()))}.log"
+        tempdir = None
         try:
             tempdir = self.gen_temp_dir(package)
-            result, build_cmd = self.debrebuild(tempdir, package)
-
             logfile = f'{self.basedir}/{logfile}'
             os.makedirs(os.path.dirname(logfile), exist_ok=True)
-            with open(logfile, 'wb') as fd:
-                fd.write(result.stdout)
-
-            artifactsdir = os.path.join(self.basedir, os.path.basename(tempdir))
-            os.makedirs(artifactsdir)
-            for f in [os.path.join(tempdir, f)
-                      for f in os.listdir(tempdir)
-                      if os.path.isfile(os.path.join(tempdir, f))]:
-                shutil.copy2(f, artifactsdir)
-            if tempdir and os.path.exists(tempdir):
-                shutil.rmtree(tempdir)
-            package.artifacts = artifactsdir
+            # allow to follow the build log while building
+            if log_callback:
+                log_callback(logfile)
+
+            with contextlib.ExitStack() as stack:
+                # raise TimeoutError if no slot gets free
+                slot = stack.enter_context(self.build_slots.acquire()) if self.build_slots else None
+                start = time.monotonic()
+                result = self.debrebuild(tempdir, package, logfile, slot=slot)
+                package.duration = round(time.monotonic() - start, 1)
+            if slot:
+                package["slot"] = slot.to_dict()
+
+            with result.timing("publish"):
+                artifactsdir = os.path.join(self.basedir, os.path.basename(tempdir))
+                # mkdtemp creates a private directory
+                os.chmod(tempdir, 0o755)
+                if not move_path(tempdir, artifactsdir):
+                    log.debug(f"{package}: artifacts copied from {tempdir}: "
+                              f"not on the same filesystem")
+                package.artifacts = artifactsdir
+
+            with result.timing("collect"):
+                result.collect(package.artifacts, package.name)
 
             # This is for recording logfile entry into DB
             package.log = logfile
+            package.status = result.status
+            package["rebuild"] = result.to_dict()
 
-            if result.returncode in (0, 2):
-                buildinfo = glob.glob(f"{package.artifacts}/{package.name}*.buildinfo")
-                if not buildinfo:
+            if result.status in ("reproducible", "unreproducible"):
+                if not result.buildinfo:
                     raise RebuilderExceptionBuild(f"Cannot find buildinfo for {package}")
-                buildinfo = buildinfo[0]
-                package.buildinfos["new"] = buildinfo
-
-            if result.returncode == 0:
-                package.status = "reproducible"
-            elif result.returncode == 2:
-                package.status = "unreproducible"
+                package.buildinfos["new"] = result.buildinfo
             else:
-                package.status = "failure"
-
-            if result.returncode not in (0, 2):
-                raise subprocess.CalledProcessError(
-                    result.returncode, build_cmd)
+                raise subprocess.CalledProcessError(result.returncode, result.cmd)
 
             return package
         except (subprocess.CalledProcessError, FileNotFoundError,
                 FileExistsError, IndexError, OSError):
             raise RebuilderExceptionBuild([dict(package)])
+        finally:
+            # workdir of an aborted build is not published
+            if tempdir and os.path.isdir(tempdir):
+                shutil.rmtree(tempdir, ignore_errors=True)
 
 
 class QubesRebuilderRPM(FedoraRebuilder):
@@ -27,8 +27,10 @@ from jinja2 import Template
 
 from app.config import Config
 from app.lib.exceptions import RebuilderException
-from app.lib.get import RebuilderDist, getPackage
-from app.lib.tool import get_rebuild_packages, get_celery_active_tasks
+from app.lib.get import RebuilderDist
+from app.lib.log import log
+from app.lib.tool import get_rebuild_packages, get_running_rebuild_logs, \
+    get_rebuild_queues_drain_estimate
 
 HTML_TEMPLATE = Template("""<!DOCTYPE html>
 <html xmlns="http://www.w3.org/1999/xhtml" lang="" xml:lang="">
@@ -132,10 +134,8 @@ def generate_plots(result, distribution, pkgset_name, arch, results_path):
 
 
 def generate_results(app, project):
-    rebuild_results = get_rebuild_packages(app)
-    running_rebuilds = [getPackage(p)
-                        for p in get_celery_active_tasks(app, "app.tasks.rebuilder.rebuild")
-                        if isinstance(p, dict)]
+    # logs of running rebuilds can be followed while building
+    running_rebuilds = get_running_rebuild_logs(app)
     try:
         results = {}
         results_path = f"/var/lib/rebuilder/rebuild/{project}/results"
@@ -145,13 +145,20 @@ def generate_results(app, project):
             results.setdefault(dist.distribution, {})
             results[dist.distribution].setdefault(dist.arch, {})
 
-            # Get BuildPackages that go into rebuild
-            dist.repo.get_packages()
+            rebuild_results = get_rebuild_packages(
+                app, distribution=dist.distribution,
+                fields=["status", "log", "diffoscope", "metadata", "buildinfos"])
+
+            # Get packages published by the last 'get' of this dist
+            snapshot = dist.repo.load_snapshot()
+            if snapshot is None:
+                log.error(f"No repository snapshot available for {dist}. Skipping.")
+                continue
 
             plots = {}
             # Filter results per status on every package sets
             for pkgset_name in dist.package_sets:
-                packages_to_rebuild = dist.repo.get_packages_to_rebuild(pkgset_name)
+                packages_to_rebuild = snapshot.get(pkgset_name, [])
 
                 # Prepare the result data
                 result = {
@@ -164,12 +171,12 @@ def generate_results(app, project):
                 }
                 for package in packages_to_rebuild:
                     if package in running_rebuilds:
-                        package["badge"] = BADGES["running"]
-                        result["running"].append(package.to_dict())
-                    elif rebuild_results.get(str(package), {}):
+                        result["running"].append(
+                            dict(package.to_dict(), badge=BADGES["running"],
+                                 log=running_rebuilds[package]))
+                    elif str(package) in rebuild_results:
                         pkg = rebuild_results[str(package)]
                         if pkg.status in ("reproducible", "unreproducible", "failure", "retry"):
-                            pkg["badge"] = BADGES[pkg.status]
                             # fixme: temporary fixup
                             if pkg.log:
                                 pkg.log = pkg.log.replace("/var/lib/rebuilder/rebuild/", "/")\
@@ -188,11 +195,11 @@ def generate_results(app, project):
                                     pkg.metadata["unreproducible"].replace(
                                     "/var/lib/rebuilder/rebuild/", "/").replace(
                                     "/rebuild/", "/")
-                            result[pkg.status].append(pkg.to_dict())
+                            result[pkg.status].append(
+                                dict(pkg.to_dict(), badge=BADGES[pkg.status]))
                     else:
-                        pkg = package
-                        pkg["badge"] = BADGES["pending"]
-                        result["pending"].append(pkg.to_dict())
+                        result["pending"].append(
+                            dict(package.to_dict(), badge=BADGES["pending"]))
 
                 generate_plots(result, dist.distribution, pkgset_name, dist.arch, results_path)
 
@@ -237,5 +244,9 @@ def generate_results(app, project):
         with open(f"{results_path}/{project}.json", "w") as fd:
             fd.write(json.dumps(results))
 
+        # expected time to rebuild queued packages
+        with open(f"{results_path}/queue.json", "w") as fd:
+            fd.write(json.dumps(get_rebuild_queues_drain_estimate(app)))
+
     except Exception as e:
         raise RebuilderException(f"Failed to generate status: {str(e)}")
@@ -0,0 +1,190 @@
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2021 Frédéric Pierret (fepitre) <frederic.pierret@qubes-os.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Build slots of a host: a build is started only if the CPUs, memory and
+# free disk space it needs are not reserved by running builds. Every
+# running build holds a lock on its reservation file in the artifacts
+# directory so that rebuilders of every container sharing it see the
+# reservation, and a reservation is released even if its holder died.
+#
+# The memory of a slot bounds a whole build through its number of parallel
+# jobs, each job being given a memory budget. RLIMIT_DATA only limits every
+# build process on its own: it stops a runaway process, not a build made of
+# too many processes.
+
+import contextlib
+import fcntl
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+from app.lib.exceptions import RebuilderExceptionBuild
+from app.lib.log import log
+
+# Seconds between two admission attempts
+SLOT_POLL_INTERVAL = 10
+# Free disk space in MiB needed by a build by default
+DEFAULT_BUILD_DISK = 10240
+# Memory in MiB needed by a parallel job of a build by default
+DEFAULT_BUILD_JOB_MEMORY = 2048
+# Seconds waited for a build slot by default
+DEFAULT_SLOT_TIMEOUT = 6 * 3600
+
+
+def get_total_memory():
+    with open("/proc/meminfo") as fd:
+        for line in fd:
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1]) * 1024
+    raise OSError("Cannot find total memory")
+
+
+class BuildSlot:
+    def __init__(self, cpus, memory, disk, jobs=None):
+        self.cpus = cpus
+        self.memory = memory
+        self.disk = disk
+        self.jobs = jobs or cpus
+
+    def to_dict(self):
+        return {"cpus": self.cpus, "memory": self.memory, "disk": self.disk, "jobs": self.jobs}
+
+
+class BuildSlots:
+    def __init__(self, artifacts_dir, slots, memory=None, disk=None, cpus=None,
+                 total_memory=None, job_memory=None, timeout=None):
+        self.artifacts_dir = artifacts_dir
+        self.slots_dir = f"{artifacts_dir}/.slots"
+        self.cpus = cpus or os.cpu_count() or 1
+        self.total_memory = total_memory or get_total_memory()
+        self.slots = max(slots, 1)
+        self.timeout = timeout or DEFAULT_SLOT_TIMEOUT
+        # every build gets an equal share of the host
+        slot_cpus = max(self.cpus // self.slots, 1)
+        slot_memory = memory * 1024 * 1024 if memory else self.total_memory // self.slots
+        job_memory = (job_memory or DEFAULT_BUILD_JOB_MEMORY) * 1024 * 1024
+        self.slot = BuildSlot(
+            cpus=slot_cpus,
+            memory=slot_memory,
+            disk=(disk or DEFAULT_BUILD_DISK) * 1024 * 1024,
+            # as many jobs as the memory of the slot allows
+            jobs=max(min(slot_cpus, slot_memory // job_memory), 1),
+        )
+        os.makedirs(self.slots_dir, exist_ok=True)
+
+    def check_capacity(self):
+        """
+        Raise RebuilderExceptionBuild if the host cannot run a build with
+        the resources of a slot, even with no other build running.
+        """
+        total_disk = shutil.disk_usage(self.artifacts_dir).total
+        if self.slot.memory > self.total_memory or self.slot.disk > total_disk:
+            raise RebuilderExceptionBuild(
+                f"Build slot {self.slot.to_dict()} exceeds host capacity: "
+                f"memory {self.total_memory}, disk {total_disk}")
+
+    def get_reservations(self):
+        """
+        Return reservations of running builds. Reservations not locked
+        anymore are removed.
+        """
+        reservations = []
+        for entry in os.scandir(self.slots_dir):
+            if not entry.name.endswith(".slot"):
+                continue
+            try:
+                with open(entry.path) as fd:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        reservations.append(json.loads(fd.read() or "{}"))
+                        continue
+                    # its build is not running anymore
+                    os.remove(entry.path)
+            except (FileNotFoundError, ValueError):
+                continue
+        return reservations
+
+    def is_available(self, reservations):
+        reserved = {
+            key: sum(r.get(key, 0) for r in reservations) for key in ("cpus", "memory", "disk")
+        }
+        free_disk = shutil.disk_usage(self.artifacts_dir).free
+        return len(reservations) < self.slots \
+            and reserved["cpus"] + self.slot.cpus <= self.cpus \
+            and reserved["memory"] + self.slot.memory <= self.total_memory \
+            and reserved["disk"] + self.slot.disk <= free_disk
+
+    def try_acquire(self):
+        """
+        Return the open and locked reservation file if the build is
+        admitted else None.
+        """
+        with open(f"{self.slots_dir}/.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not self.is_available(self.get_reservations()):
+                return None
+            fd, path = tempfile.mkstemp(dir=self.slots_dir, suffix=".slot")
+            os.close(fd)
+            reservation = open(path, "w")
+            fcntl.flock(reservation, fcntl.LOCK_EX)
+            reservation.write(json.dumps(self.slot.to_dict()))
+            reservation.flush()
+            return reservation
+
+    @contextlib.contextmanager
+    def acquire(self, poll_interval=SLOT_POLL_INTERVAL, timeout=None):
+        """
+        Wait for the resources of a build and reserve them while in context.
+        Raise TimeoutError if they are not free after timeout seconds.
+        """
+        self.check_capacity()
+        timeout = timeout or self.timeout
+        deadline = time.monotonic() + timeout
+        reservation = self.try_acquire()
+        if not reservation:
+            log.debug(f"Waiting for a build slot in {self.artifacts_dir}")
+        while not reservation:
+            if time.monotonic() >= deadline:
+                msg = f"No build slot free in {self.artifacts_dir} after {timeout} seconds"
+                log.error(msg)
+                raise TimeoutError(msg)
+            time.sleep(poll_interval)
+            reservation = self.try_acquire()
+        try:
+            yield self.slot
+        finally:
+            os.remove(reservation.name)
+            reservation.close()
+
+
+def set_memory_ceiling(limit):
+    """
+    Limit the data segment size of every process started from now on by the
+    current process, and of the current process itself. It is meant to be
+    called in a child process before exec, e.g. as subprocess preexec_fn.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_DATA)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_DATA, (limit, hard))
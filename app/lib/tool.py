@@ -2,17 +2,39 @@ import base64
 import glob
 import json
 import os
+import uuid
+
+import kombu.serialization
+import pymongo
 
 from app.lib.attest import BaseAttester
-from app.lib.common import DEBIAN, DEBIAN_ARCHES, parse_deb_buildinfo_fname
-from app.lib.get import getPackage
+from app.lib.common import DEBIAN, DEBIAN_ARCHES, parse_deb_buildinfo_fnames
+from app.lib.duration import REBUILD_QUEUES, DurationModel, get_build_durations
+from app.lib.exceptions import RebuilderExceptionGet
+from app.lib.get import getPackage, Package
+from app.lib.log import log
+from app.lib.priority import DEFAULT_PRIORITY, PRIORITY_SEP, clamp_priority, get_queue_lanes
 from app.lib.rebuild import getRebuilder
 
+# Redis set of keys of packages submitted for rebuild and not yet reported
+INFLIGHT_REBUILDS_KEY = "rebuilder:inflight"
+# Redis set of in-flight keys unknown to Celery at the last reconciliation
+INFLIGHT_STALE_KEY = "rebuilder:inflight:stale"
+# Tasks having a package in flight as first argument
+INFLIGHT_TASKS = ("app.tasks.rebuilder.rebuild", "app.tasks.rebuilder.attest",
+                  "app.tasks.rebuilder.report")
+# Custom state of rebuild tasks publishing the log of the running build
+BUILDING_STATE = "BUILDING"
+
+PACKAGES_COLLECTION = "packages"
+PACKAGES_COLLECTION_KEY = ("distribution", "name", "version", "arch")
+_packages_collection_indexed = False
+
 
 def metadata_to_db(app, dist, **kwargs):
     result = []
     # get previous triggered packages builds
-    stored_packages = get_rebuild_packages(app)
+    stored_packages = get_rebuild_packages(app, distribution=dist.distribution, fields=["status"])
 
     distribution = dist.distribution
     arch = dist.arch
@@ -27,17 +49,12 @@ def metadata_to_db(app, dist, **kwargs):
         return result
     rebuild_dir = kwargs.get("rebuild_dir", "/var/lib/rebuilder/rebuild")
     buildinfo_files = glob.glob(f"{rebuild_dir}/{dist.project}/buildinfos/*.buildinfo")
-    for buildinfo in buildinfo_files:
-        parsed_bn = parse_deb_buildinfo_fname(buildinfo)
-        name = parsed_bn["name"]
-        version = parsed_bn["version"]
-        epoch = parsed_bn['epoch']
-        if not parsed_bn:
-            continue
-        if len(parsed_bn['arch']) > 1:
-            continue
-        if parsed_bn['arch'][0] != arch:
+    for buildinfo, parsed_bn in parse_deb_buildinfo_fnames(buildinfo_files):
+        if parsed_bn.arch != (arch,):
             continue
+        name = parsed_bn.name
+        version = parsed_bn.version
+        epoch = parsed_bn.epoch
         # due partial metadata generation we need to check in unreproducible metadata
         # exists in order to know the global status of a given package
         metadata = glob.glob(f"{repr_basedir}/{name}/{version}/rebuild.*.{arch}.link")
@@ -71,7 +88,64 @@ def metadata_to_db(app, dist, **kwargs):
     return result
 
 
-def get_rebuild_packages(app, status=None, with_id=False):
+def get_packages_collection(app):
+    """
+    Collection of the latest report of every package, one document per
+    (distribution, name, version, arch).
+    """
+    global _packages_collection_indexed
+    col = app.backend.database[PACKAGES_COLLECTION]
+    if not _packages_collection_indexed:
+        col.create_index([(k, pymongo.ASCENDING) for k in PACKAGES_COLLECTION_KEY], unique=True)
+        col.create_index([("distribution", pymongo.ASCENDING), ("status", pymongo.ASCENDING)])
+        _packages_collection_indexed = True
+    return col
+
+
+def store_packages(app, packages):
+    requests = [
+        pymongo.UpdateOne(
+            {k: package[k] for k in PACKAGES_COLLECTION_KEY},
+            {"$set": {k: package[k] for k in Package.FIELDS}},
+            upsert=True
+        )
+        for package in packages
+    ]
+    if requests:
+        get_packages_collection(app).bulk_write(requests, ordered=False)
+
+
+def get_rebuild_packages(app, status=None, with_id=False, distribution=None, fields=None):
+    """
+    Return {str(package): package} of reported packages, optionally
+    filtered by status and distribution. Only given fields (and the
+    package identity) are loaded if fields is provided.
+    """
+    col = get_packages_collection(app)
+    if col.estimated_document_count() == 0:
+        # Populate from reports stored before the collection existed
+        store_packages(app, get_rebuild_packages_from_backend_tasks(app).values())
+
+    query = {}
+    if distribution:
+        query["distribution"] = distribution
+    if status:
+        query["status"] = {"$in": list(status)}
+    projection = None
+    if fields:
+        projection = dict.fromkeys(set(Package.IDENTITY_FIELDS) | set(fields), 1)
+    if not with_id:
+        projection = projection or {}
+        projection["_id"] = 0
+
+    rebuilt_packages = {}
+    for doc in col.find(query, projection):
+        package = getPackage(doc)
+        rebuilt_packages[str(package)] = package
+    return rebuilt_packages
+
+
+def get_rebuild_packages_from_backend_tasks(app, status=None, with_id=False):
     rebuilt_packages = {}
     failed_packages = {}
 
@@ -125,6 +199,7 @@ def get_latest_diffoscope_file(package):
 
 
 def get_celery_active_tasks(app, name=None):
+    names = (name,) if isinstance(name, str) else name
     inspect = app.control.inspect()
     tasks = []
     queues = []
@@ -134,13 +209,35 @@ def get_celery_active_tasks(app, name=None):
     for d in queues:
         for _, queue in d.items():
             for task in queue:
-                if name and task.get("name", None) != name:
+                if names and task.get("name", None) not in names:
                     continue
                 if task.get('args', None):
                     tasks.append(task['args'][0])
     return tasks
 
 
+def get_running_rebuild_logs(app):
+    """
+    Return {package: log path} for rebuilds in progress. The log path is
+    None for a rebuild not building yet, e.g. waiting for a build slot.
+    """
+    logs = {}
+    active = app.control.inspect().active() or {}
+    for tasks in active.values():
+        for task in tasks:
+            if task.get("name", None) != "app.tasks.rebuilder.rebuild" or not task.get("args"):
+                continue
+            try:
+                package = getPackage(task["args"][0])
+            except (RebuilderExceptionGet, TypeError):
+                continue
+            logs[package] = None
+            result = app.AsyncResult(task["id"])
+            if result.state == BUILDING_STATE and isinstance(result.info, dict):
+                logs[package] = result.info.get("log", None)
+    return logs
+
+
 def rebuild_task_parser(task):
     parsed_task = None
     task_status = task["status"].lower()
@@ -159,7 +256,10 @@ def rebuild_task_parser(task):
 
 def get_celery_queued_tasks(app, queue_name):
     with app.pool.acquire(block=True) as conn:
-        tasks = conn.default_channel.client.lrange(queue_name, 0, -1)
+        with conn.default_channel.client.pipeline(transaction=False) as pipe:
+            for lane in get_queue_lanes(queue_name):
+                pipe.lrange(lane, 0, -1)
+            tasks = [task for lane_tasks in pipe.execute() for task in lane_tasks]
 
     submitted_tasks = []
     for task in tasks:
@@ -185,6 +285,192 @@ def get_celery_unacked_tasks(app):
     return submitted_tasks
 
 
+def get_celery_tasks_packages(tasks):
+    packages = set()
+    for task in tasks:
+        # 'get' tasks have the dist as argument
+        if not isinstance(task, dict):
+            continue
+        try:
+            packages.add(getPackage(task))
+        except (RebuilderExceptionGet, TypeError):
+            continue
+    return packages
+
+
+def get_inflight_packages_from_celery(app):
+    """
+    Return packages queued, unacked or running for rebuild, attestation
+    or report.
+    """
+    packages = set()
+    for queue_name in REBUILD_QUEUES + ["attest", "report"]:
+        packages.update(get_celery_tasks_packages(get_celery_queued_tasks(app, queue_name)))
+    packages.update(get_celery_tasks_packages(get_celery_unacked_tasks(app)))
+    packages.update(get_celery_tasks_packages(get_celery_active_tasks(app, INFLIGHT_TASKS)))
+    return packages
+
+
+def add_inflight_packages(app, packages):
+    keys = [p.key for p in packages]
+    if not keys:
+        return
+    with app.pool.acquire(block=True) as conn:
+        conn.default_channel.client.sadd(INFLIGHT_REBUILDS_KEY, *keys)
+
+
+def remove_inflight_packages(app, packages):
+    keys = [p.key for p in packages]
+    if not keys:
+        return
+    with app.pool.acquire(block=True) as conn:
+        conn.default_channel.client.srem(INFLIGHT_REBUILDS_KEY, *keys)
+
+
+def get_redis_task_message(app, task_name, args, queue, priority):
+    """
+    Return the priority lane and the message of a task as the Celery Redis
+    transport stores them into a queue.
+    """
+    task_id = str(uuid.uuid4())
+    headers, properties, body, _ = app.amqp.create_task_message(
+        task_id, task_name, args, {}, root_id=task_id)
+    content_type, content_encoding, data = kombu.serialization.dumps(
+        body, serializer=app.conf.task_serializer)
+    if isinstance(data, str):
+        data = data.encode(content_encoding)
+    priority = clamp_priority(priority)
+    properties.update(
+        delivery_mode=2,
+        delivery_info={"exchange": queue, "routing_key": queue},
+        priority=priority,
+        body_encoding="base64",
+        delivery_tag=str(uuid.uuid4()),
+    )
+    message = {
+        "body": base64.b64encode(data).decode(),
+        "content-encoding": content_encoding,
+        "content-type": content_type,
+        "headers": headers,
+        "properties": properties,
+    }
+    lane = f"{queue}{PRIORITY_SEP}{priority}" if priority else queue
+    return lane, json.dumps(message)
+
+
+def publish_package_tasks(app, task_name, packages, priorities=None, queues=None,
+                          default_queue="rebuild"):
+    """
+    Publish a task for every package and add packages to the in-flight
+    index. With a Redis broker, everything is sent in a single MULTI/EXEC
+    transaction.
+    """
+    priorities = priorities or {}
+    queues = queues or {}
+    with app.pool.acquire(block=True) as conn:
+        if conn.transport.driver_type != "redis":
+            # publish messages one by one
+            for package in packages:
+                app.send_task(task_name, (dict(package),), connection=conn,
+                              priority=priorities.get(package, DEFAULT_PRIORITY),
+                              queue=queues.get(package, default_queue))
+            add_inflight_packages(app, packages)
+            return
+        with conn.default_channel.client.pipeline(transaction=True) as pipe:
+            for package in packages:
+                lane, message = get_redis_task_message(
+                    app, task_name, (dict(package),), queues.get(package, default_queue),
+                    priorities.get(package, DEFAULT_PRIORITY))
+                pipe.lpush(lane, message)
+            if packages:
+                pipe.sadd(INFLIGHT_REBUILDS_KEY, *[p.key for p in packages])
+            pipe.execute()
+
+
+def get_inflight_packages(app, packages):
+    """
+    Return the subset of packages which are queued, unacked, running or
+    waiting for their report. The index is rebuilt from Celery queues if
+    it does not exist, e.g. on first run or after a broker reset.
+    """
+    packages = list(packages)
+    with app.pool.acquire(block=True) as conn:
+        client = conn.default_channel.client
+        if not client.exists(INFLIGHT_REBUILDS_KEY):
+            inflight = get_inflight_packages_from_celery(app)
+            if inflight:
+                log.debug(f"Rebuilding in-flight index with {len(inflight)} packages")
+                client.sadd(INFLIGHT_REBUILDS_KEY, *[p.key for p in inflight])
+        with client.pipeline(transaction=False) as pipe:
+            for package in packages:
+                pipe.sismember(INFLIGHT_REBUILDS_KEY, package.key)
+            found = pipe.execute()
+    return {p for p, is_inflight in zip(packages, found) if is_inflight}
+
+
+def reconcile_inflight_packages(app):
+    """
+    Remove from the in-flight index packages unknown to Celery at two
+    successive reconciliations, e.g. whose worker was killed or whose queue
+    was purged. Return the removed keys.
+    """
+    known = {p.key for p in get_inflight_packages_from_celery(app)}
+    with app.pool.acquire(block=True) as conn:
+        client = conn.default_channel.client
+        members = {m.decode() if isinstance(m, bytes) else m
+                   for m in client.smembers(INFLIGHT_REBUILDS_KEY)}
+        previous = {m.decode() if isinstance(m, bytes) else m
+                    for m in client.smembers(INFLIGHT_STALE_KEY)}
+        unknown = members - known
+        # a package between two tasks is unknown only for a short while
+        stale = unknown & previous
+        with client.pipeline(transaction=True) as pipe:
+            if stale:
+                pipe.srem(INFLIGHT_REBUILDS_KEY, *stale)
+            pipe.delete(INFLIGHT_STALE_KEY)
+            if unknown - stale:
+                pipe.sadd(INFLIGHT_STALE_KEY, *(unknown - stale))
+            pipe.execute()
+    if stale:
+        log.debug(f"Removed {len(stale)} stale packages from in-flight index")
+    return stale
+
+
+def get_rebuild_workers_concurrency(app):
+    """
+    Return the number of rebuild workers and the number of rebuilds they
+    run at once, i.e. the sum of their pool sizes.
+    """
+    inspect = app.control.inspect()
+    active_queues = inspect.active_queues() or {}
+    workers = [worker for worker, queues in active_queues.items()
+               if any(q.get("name", None) in REBUILD_QUEUES for q in queues)]
+    stats = (inspect.stats() or {}) if workers else {}
+    concurrency = sum(
+        stats.get(worker, {}).get("pool", {}).get("max-concurrency", None) or 1
+        for worker in workers
+    )
+    return len(workers), concurrency
+
+
+def get_rebuild_queues_drain_estimate(app):
+    """
+    Estimate from the build duration model the time for rebuild workers
+    to process queued rebuilds.
+    """
+    packages = set()
+    for queue_name in REBUILD_QUEUES:
+        packages.update(get_celery_tasks_packages(get_celery_queued_tasks(app, queue_name)))
+    model = DurationModel(get_build_durations(app, {p.name for p in packages}))
+    workers, concurrency = get_rebuild_workers_concurrency(app)
+    return {
+        "queued": len(packages),
+        "workers": workers,
+        "concurrency": concurrency,
+        "drain_time": int(model.estimate_drain_time(packages, concurrency or 1)),
+    }
+
+
 def get_backend_tasks(app):
     backend = app.backend
     col = backend.collection.find()
@@ -0,0 +1,236 @@
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2021 Frédéric Pierret (fepitre) <frederic.pierret@qubes-os.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Every reported package only uploads the files it produced. Files waiting
+# for upload are stored per project in a Redis set and a single rsync
+# '--files-from' transfer is done for all the files gathered during
+# UPLOAD_COALESCE_DELAY. The whole project tree is only synchronized
+# periodically in order to reconcile the remote location.
+#
+# All the SSH connections to a remote host go through a persistent master
+# connection so that key exchange and authentication are done only once.
+
+import os
+import shlex
+import subprocess
+import tempfile
+
+from app.config import Config
+from app.lib.common import get_buildinfo_fields
+from app.lib.log import log
+
+UPLOAD_PENDING_KEY = "rebuilder:upload:{project}"
+UPLOAD_SCHEDULED_KEY = "rebuilder:upload:{project}:scheduled"
+# Seconds during which upload requests are gathered into a single transfer
+UPLOAD_COALESCE_DELAY = 30
+# Seconds before files which failed to be transferred are uploaded again
+UPLOAD_RETRY_DELAY = 600
+# Seconds the SSH master connection stays open once unused
+SSH_CONTROL_PERSIST = 600
+# rsync exit codes of a transfer where some files were not transferred
+RSYNC_PARTIAL_CODES = (23, 24)
+
+
+class Uploader:
+    def __init__(self, project, **kwargs):
+        self.project = project
+        # W: uploaded paths are relative to this directory on both sides
+        self.local_dir = kwargs.get("local_dir", "/var/lib/rebuilder")
+        self.ssh_dir = kwargs.get("ssh_dir", "/root/.ssh")
+        # '%C' is a hash of the connection parameters, one master per host
+        self.control_path = kwargs.get("control_path", "/tmp/rebuilder-ssh-%C")
+
+        options = Config["project"].get(project, {})
+        self.ssh_key = options.get("repo-ssh-key", Config["common"].get("repo-ssh-key", None))
+        self.remote_host = options.get(
+            "repo-remote-ssh-host", Config["common"].get("repo-remote-ssh-host", None))
+        self.remote_basedir = options.get(
+            "repo-remote-ssh-basedir", Config["common"].get("repo-remote-ssh-basedir", None))
+
+    def is_configured(self):
+        return bool(self.ssh_key and self.remote_host and self.remote_basedir)
+
+    def ssh_cmd(self):
+        return [
+            "ssh", "-i", f"{self.ssh_dir}/{self.ssh_key}", "-o", "StrictHostKeyChecking=no",
+            "-o", "BatchMode=yes", "-o", "ServerAliveInterval=60",
+            "-o", "ControlMaster=auto", "-o", f"ControlPath={self.control_path}",
+            "-o", f"ControlPersist={SSH_CONTROL_PERSIST}"
+        ]
+
+    def is_connected(self):
+        cmd = self.ssh_cmd() + ["-O", "check", self.remote_host]
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return result.returncode == 0
+
+    def connect(self):
+        """
+        Ensure that the SSH master connection to the remote host is alive.
+        """
+        if self.is_connected():
+            return
+        log.debug(f"{self.project}: opening SSH master connection to {self.remote_host}")
+        cmd = self.ssh_cmd() + ["-M", "-N", "-f", self.remote_host]
+        subprocess.run(cmd, check=True)
+
+    def relpath(self, path):
+        relpath = os.path.relpath(path, self.local_dir)
+        if relpath.startswith(".."):
+            raise ValueError(f"Cannot upload {path}: not in {self.local_dir}")
+        return relpath
+
+    def rsync(self, src, remote_dir, options=None, partial=False):
+        """
+        Run rsync and return its result. If partial is set, a transfer where
+        some files were not transferred does not fail and the output is
+        captured.
+        """
+        # remote directory is created by the same SSH session than the transfer
+        cmd = ["rsync", "-az", f"--rsync-path=mkdir -p {shlex.quote(remote_dir)} && rsync"]
+        cmd += (options or []) + ["-e", " ".join(self.ssh_cmd()),
+                                  src, f"{self.remote_host}:{remote_dir}"]
+        if not partial:
+            return subprocess.run(cmd, check=True)
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+        if result.returncode not in (0,) + RSYNC_PARTIAL_CODES:
+            raise subprocess.CalledProcessError(result.returncode, cmd)
+        return result
+
+    def upload_dir(self, local_dir):
+        # W: pay attention to latest "/", we use rsync!
+        # W: this is relative path to local_dir
+        remote_dir = f"{self.remote_basedir}/{local_dir}"
+        self.rsync(f"{self.local_dir}/{local_dir}", remote_dir)
+
+    def get_valid_paths(self, paths):
+        """
+        Return paths which can be uploaded. Paths removed meanwhile or not
+        in local directory would fail every transfer and are dropped.
+        """
+        valid_paths = []
+        for path in sorted(set(paths)):
+            if not os.path.lexists(path):
+                log.error(f"{self.project}: cannot upload {path}: file does not exist")
+                continue
+            try:
+                self.relpath(path)
+            except ValueError as e:
+                log.error(f"{self.project}: {str(e)}")
+                continue
+            valid_paths.append(path)
+        return valid_paths
+
+    def upload_files(self, paths):
+        """
+        Upload paths in a single transfer. Their parent directories are
+        created on the remote location. Return uploaded relative paths
+        and paths which were not transferred.
+        """
+        paths = {self.relpath(path): path for path in self.get_valid_paths(paths)}
+        relpaths = sorted(paths)
+        if not relpaths:
+            return [], []
+        with tempfile.NamedTemporaryFile("w", prefix="upload-", suffix=".list") as fd:
+            fd.write("\n".join(relpaths) + "\n")
+            fd.flush()
+            # every file is itemized, including unchanged ones
+            result = self.rsync(f"{self.local_dir}/", f"{self.remote_basedir}/",
+                                options=[f"--files-from={fd.name}", "-ii", "--out-format=%i %n"],
+                                partial=True)
+        if result.returncode == 0:
+            return relpaths, []
+        # e.g. '<f+++++++++ rebuild/debian/logs/bash-5.1-3+b1.amd64.log'
+        listed = {line.split(" ", 1)[1] for line in result.stdout.splitlines() if " " in line}
+        uploaded = [relpath for relpath in relpaths if relpath in listed]
+        failed = [paths[relpath] for relpath in relpaths if relpath not in listed]
+        return uploaded, failed
+
+
+def get_package_upload_paths(package):
+    """
+    Return the files produced for package: logs, diffoscope, buildinfo
+    and in-toto metadata with their symlinks.
+    """
+    paths = [package.log, package.diffoscope]
+    if package.log:
+        # compressed copy of the build log
+        paths.append(f"{package.log}.gz")
+    if package.buildinfos:
+        paths.append(package.buildinfos.get("new", None))
+
+    binaries = []
+    if package.buildinfos and package.buildinfos.get("new", None) \
+            and os.path.exists(package.buildinfos["new"]):
+        with open(package.buildinfos["new"], "rb") as fd:
+            binaries = get_buildinfo_fields(fd, ["Binary"]).get("Binary", "").split()
+
+    for link in (package.metadata or {}).values():
+        if not link:
+            continue
+        # in-toto links for every arch, merged link and 'metadata' symlink
+        metadata_dir = os.path.dirname(link)
+        if os.path.isdir(metadata_dir):
+            paths += [entry.path for entry in os.scandir(metadata_dir)]
+        # binary package names symlinks to source package directory
+        sources_dir = os.path.dirname(os.path.dirname(metadata_dir))
+        paths += [f"{sources_dir}/{binpkg}" for binpkg in binaries
+                  if os.path.islink(f"{sources_dir}/{binpkg}")]
+
+    return sorted({path for path in paths if path and os.path.lexists(path)})
+
+
+def queue_upload_paths(app, project, paths, delay=UPLOAD_COALESCE_DELAY):
+    """
+    Add paths to the files waiting for upload. Return True if no upload
+    of pending files is scheduled yet: the caller schedules one in delay
+    seconds.
+    """
+    if not paths:
+        return False
+    with app.pool.acquire(block=True) as conn:
+        client = conn.default_channel.client
+        client.sadd(UPLOAD_PENDING_KEY.format(project=project), *paths)
+        # the flag expires in case the scheduled upload is lost
+        return bool(client.set(UPLOAD_SCHEDULED_KEY.format(project=project), 1,
+                               nx=True, ex=delay * 10))
+
+
+def pop_upload_paths(app, project):
+    with app.pool.acquire(block=True) as conn:
+        client = conn.default_channel.client
+        # files queued from now on are uploaded by another transfer
+        client.delete(UPLOAD_SCHEDULED_KEY.format(project=project))
+        with client.pipeline(transaction=True) as pipe:
+            pipe.smembers(UPLOAD_PENDING_KEY.format(project=project))
+            pipe.delete(UPLOAD_PENDING_KEY.format(project=project))
+            paths, _ = pipe.execute()
+    return sorted(path.decode() if isinstance(path, bytes) else path for path in paths)
+
+
+def requeue_upload_paths(app, project, paths):
+    """
+    Add paths which failed to be uploaded back to the files waiting for
+    upload. Return True if no upload of pending files is scheduled yet:
+    the caller schedules one in UPLOAD_RETRY_DELAY seconds.
+    """
+    if not paths:
+        return False
+    log.debug(f"{project}: {len(paths)} files kept for next upload")
+    return queue_upload_paths(app, project, paths, delay=UPLOAD_RETRY_DELAY)
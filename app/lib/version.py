@@ -0,0 +1,129 @@
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2021 Frédéric Pierret (fepitre) <frederic.pierret@qubes-os.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Sort keys for Debian (dpkg) and RPM (rpmvercmp) versions. Comparing two
+# keys gives the same result as comparing the versions with the respective
+# package manager. Keys are cached per version string as the same versions
+# are seen many times when selecting latest packages of a repository.
+
+import functools
+import re
+
+DIGITS_RE = re.compile(r"(\d+)")
+RPM_SEGMENTS_RE = re.compile(r"(~|\^|[a-zA-Z]+|\d+)")
+
+# Empty non-digit part followed by an empty digit part: this is what dpkg
+# compares against when one of the versions has no remaining characters.
+DEB_EMPTY_PART = ((0,), 0)
+
+
+def _deb_char_order(c):
+    # Same ordering as dpkg: '~' sorts before anything, even the end of
+    # the part, then letters and then non letters.
+    if c == "~":
+        return -1
+    if c.isalpha():
+        return ord(c)
+    return ord(c) + 256
+
+
+@functools.lru_cache(maxsize=65536)
+def _deb_part_key(part):
+    # Alternate non-digit and digit parts: "1.2~rc1" -> "", 1, ".", 2, "~rc", 1
+    parts = DIGITS_RE.split(part)
+    key = []
+    for idx in range(0, len(parts), 2):
+        non_digit = tuple(_deb_char_order(c) for c in parts[idx]) + (0,)
+        digit = int(parts[idx + 1]) if idx + 1 < len(parts) else 0
+        key.append((non_digit, digit))
+    # Trailing empty parts do not change the comparison ("1.0" == "1.00")
+    # and only the first part can be empty otherwise. Then, comparing the
+    # terminating empty part with the remaining parts of a longer version
+    # behaves like dpkg.
+    while len(key) > 1 and key[-1] == DEB_EMPTY_PART:
+        key.pop()
+    key.append(DEB_EMPTY_PART)
+    return tuple(key)
+
+
+@functools.lru_cache(maxsize=65536)
+def debian_version_key(version):
+    """
+    Return a sort key for a Debian version [epoch:]upstream[-revision].
+    """
+    epoch = 0
+    if ":" in version:
+        epoch, version = version.split(":", 1)
+        epoch = int(epoch) if epoch.isdigit() else 0
+    upstream, sep, revision = version.rpartition("-")
+    if not sep:
+        upstream, revision = revision, ""
+    return epoch, _deb_part_key(upstream), _deb_part_key(revision)
+
+
+# Segment kinds for RPM, in increasing order
+RPM_TILDE = (0,)
+RPM_END = (1,)
+RPM_CARET = (2,)
+
+
+@functools.lru_cache(maxsize=65536)
+def _rpm_part_key(part):
+    key = []
+    for segment in RPM_SEGMENTS_RE.findall(part):
+        if segment == "~":
+            key.append(RPM_TILDE)
+        elif segment == "^":
+            key.append(RPM_CARET)
+        elif segment.isdigit():
+            # numeric segments are always newer than alpha ones
+            key.append((4, int(segment)))
+        else:
+            key.append((3, segment))
+    key.append(RPM_END)
+    return tuple(key)
+
+
+@functools.lru_cache(maxsize=65536)
+def rpm_version_key(version, epoch=None):
+    """
+    Return a sort key for a RPM version-release and its epoch.
+    """
+    version, sep, release = version.rpartition("-")
+    if not sep:
+        version, release = release, ""
+    epoch = int(epoch) if epoch else 0
+    return epoch, _rpm_part_key(version), _rpm_part_key(release)
+
+
+def get_latest_versions(items, key):
+    """
+    Return a dict {name: item} of the latest item per name. key(item)
+    returns a (name, version key) tuple.
+    """
+    latest = {}
+    latest_keys = {}
+    for item in items:
+        name, version_key = key(item)
+        current = latest_keys.get(name, None)
+        if current is None or version_key > current:
+            latest[name] = item
+            latest_keys[name] = version_key
+    return latest
@@ -31,15 +31,26 @@ from app.config import Config
 from app.lib.exceptions import RebuilderException, \
     RebuilderExceptionUpload, RebuilderExceptionBuild, RebuilderExceptionReport, \
     RebuilderExceptionDist, RebuilderExceptionAttest, RebuilderExceptionGet
-from app.lib.common import get_project
+from app.lib.common import get_project, move_path
 from app.lib.get import getPackage, RebuilderDist
-from app.lib.tool import metadata_to_db, get_rebuild_packages, get_celery_queued_tasks
+from app.lib.tool import metadata_to_db, get_rebuild_packages, get_celery_queued_tasks, \
+    get_inflight_packages, remove_inflight_packages, reconcile_inflight_packages, \
+    store_packages, publish_package_tasks, BUILDING_STATE
+from app.lib.duration import DurationModel, FAST_REBUILD_QUEUE, get_build_durations, \
+    record_build_duration
+from app.lib.priority import get_priority_weights, get_rebuild_priority, clamp_priority
 from app.lib.rebuild import getRebuilder
 from app.lib.attest import process_attestation
 from app.lib.report import generate_results
+from app.lib.upload import Uploader, UPLOAD_COALESCE_DELAY, UPLOAD_RETRY_DELAY, \
+    get_package_upload_paths, queue_upload_paths, pop_upload_paths, requeue_upload_paths
 
 
-# fixme: improve serialize/deserialize Package
+# Number of rebuild tasks published in a single broker transaction
+REBUILD_SUBMIT_CHUNK_SIZE = 500
+# Seconds between two reconciliations of the in-flight index with Celery
+INFLIGHT_RECONCILE_INTERVAL = 3600
+
 
 class BaseTask(celery.Task):
     autoretry_for = (RebuilderExceptionBuild, RebuilderExceptionReport, RebuilderExceptionAttest,)
@@ -51,6 +62,18 @@ class BaseTask(celery.Task):
 
 class RebuildTask(BaseTask):
 
+    def retry(self, *args, **kwargs):
+        # Retried rebuilds move to a lower (or higher) priority lane
+        priority = (self.request.delivery_info or {}).get("priority", None)
+        if priority is not None and "priority" not in kwargs:
+            try:
+                project = get_project(self.request.args[0]["distribution"])
+                weights = get_priority_weights(project)
+                kwargs["priority"] = clamp_priority(priority - weights["retry"])
+            except (IndexError, KeyError, TypeError):
+                pass
+        return super().retry(*args, **kwargs)
+
     def on_retry(self, exc, task_id, args, kwargs, einfo):
         results, = exc.args
         package = results[0]
@@ -60,15 +83,44 @@ class RebuildTask(BaseTask):
         report.delay(package)
 
     def on_failure(self, exc, task_id, args, kwargs, einfo):
-        results, = exc.args
-        package = results[0]
-        report.delay(package)
+        results = exc.args[0] if len(exc.args) == 1 else None
+        if not isinstance(results, list) or not results:
+            # no rebuild result, e.g. the worker was lost: report the failure
+            # so that the package is not forgotten
+            try:
+                package = getPackage(args[0])
+            except (RebuilderExceptionGet, TypeError, IndexError):
+                return
+            package.status = "failure"
+            package["retries"] = self.request.retries
+            report.delay(dict(package))
+            return
+        report.delay(results[0])
 
     def on_success(self, retval, task_id, args, kwargs):
         package = retval["rebuild"][0]
         attest.delay(package)
 
 
+class ReportingTask(BaseTask):
+    # Packages stay in the in-flight index until they are reported. A package
+    # which failed to be attested or reported is rebuilt by the next get.
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        try:
+            remove_inflight_packages(app, [getPackage(args[0])])
+        except (RebuilderExceptionGet, TypeError, IndexError):
+            pass
+
+
+class ReportTask(ReportingTask):
+
+    def on_success(self, retval, task_id, args, kwargs):
+        packages = [getPackage(p) for p in retval["report"]]
+        # a retried rebuild is queued again
+        remove_inflight_packages(app, [p for p in packages if p.status != "retry"])
+
+
 @app.task(base=BaseTask)
 def _generate_results(project):
     # generate plots from results
@@ -80,17 +132,27 @@ def _generate_results(project):
     upload.delay(project=project, upload_results=True)
 
 
+@app.task(base=BaseTask)
+def _reconcile_inflight():
+    try:
+        reconcile_inflight_packages(app)
+    except Exception as e:
+        log.error(f"Failed to reconcile in-flight packages: {str(e)}")
+
+
 @app.task(base=BaseTask)
 def _metadata_to_db(dist):
     try:
         dist = RebuilderDist(dist)
         log.debug(f"Provisionning DB for {dist} data)")
-        for p in metadata_to_db(app, dist):
+        packages = metadata_to_db(app, dist)
+        for p in packages:
             app.backend._store_result(
                 task_id=uuid.uuid4(),
                 result={"report": [p]},
                 state="SUCCESS"
             )
+        store_packages(app, [getPackage(p) for p in packages])
     except Exception as e:
         log.error(f"Failed to generate DB results: {str(e)}")
 
@@ -106,6 +168,73 @@ def setup_periodic_tasks(sender, **kwargs):
         schedule_generate_results = Config["project"][project]["schedule_generate_results"]
         sender.add_periodic_task(schedule_generate_results, _generate_results.s(project))
 
+        # only files of reported packages are uploaded, reconcile periodically
+        schedule_upload_all = Config["project"][project]["schedule_upload_all"]
+        sender.add_periodic_task(schedule_upload_all, upload.s(project=project, upload_all=True))
+
+    # packages whose rebuild report was lost would never be submitted again
+    sender.add_periodic_task(INFLIGHT_RECONCILE_INTERVAL, _reconcile_inflight.s())
+
+
+def submit_rebuilds(packages, priorities=None, queues=None,
+                    chunk_size=REBUILD_SUBMIT_CHUNK_SIZE):
+    priorities = priorities or {}
+    queues = queues or {}
+    for idx in range(0, len(packages), chunk_size):
+        chunk = packages[idx:idx + chunk_size]
+        publish_package_tasks(app, rebuild.name, chunk, priorities=priorities, queues=queues)
+        log.debug(f"{idx + len(chunk)}/{len(packages)} packages submitted for rebuild.")
+
+
+def get_rebuild_priorities(dist, packages):
+    weights = get_priority_weights(dist.project)
+    membership = dist.repo.get_package_sets_membership()
+    return {
+        package: get_rebuild_priority(
+            weights,
+            package_sets=membership.get(package, ()),
+            repository=dist.repo.get_package_repository(package),
+            buildinfo_age=dist.repo.get_buildinfo_age(package),
+        )
+        for package in packages
+    }
+
+
+def get_unfinished_packages(packages, stored_packages, exclude=()):
+    """
+    Return packages not excluded which have no final stored status.
+    Packages still in flight are filtered out by the caller.
+    """
+    exclude = set(exclude)
+    unfinished_packages = []
+    for package in packages or []:
+        if package in exclude:
+            continue
+        stored_package = stored_packages.get(str(package), None)
+        if stored_package and stored_package.status in \
+                ("reproducible", "unreproducible", "failure"):
+            continue
+        unfinished_packages.append(package)
+    return unfinished_packages
+
+
+def get_snapshot_groups(dist, packages, stored_packages):
+    """
+    Return {package: snapshot day} of packages whose build dependencies
+    most likely come from the snapshot of that day.
+    """
+    groups = {}
+    for package in packages:
+        # a previous build tells which snapshot timestamp is used the most
+        stored_package = stored_packages.get(str(package), None)
+        if stored_package and stored_package.timestamps:
+            groups[package] = stored_package.timestamps[0][:8]
+            continue
+        group = dist.repo.get_snapshot_group(package)
+        if group:
+            groups[package] = group
+    return groups
+
 
 @app.task(base=BaseTask)
 def get(dist, **kwargs):
@@ -114,22 +243,33 @@ def get(dist, **kwargs):
         log.debug(f"{dist}: already submitted. Skipping.")
     else:
         try:
-            dist = RebuilderDist(dist)
-            packages = dist.repo.get_packages_to_rebuild()
+            dist = RebuilderDist(dist, **kwargs)
+            # Only consider packages which changed since the last run unless we
+            # explicitly want to go through every package again.
+            full = kwargs.get("force_retry", None) or not kwargs.get("incremental", True)
+            packages = dist.repo.get_updated_packages_to_rebuild(full=full)
             if not packages:
-                log.debug(f"No packages found for {dist}")
+                log.debug(f"No new packages found for {dist}")
 
             # get previous triggered packages builds
-            stored_packages = get_rebuild_packages(app)
-
-            # queued packages to be rebuilt
-            rebuild_queued_tasks = get_celery_queued_tasks(app, "rebuild")
-
+            stored_packages = get_rebuild_packages(
+                app, distribution=dist.distribution, fields=["status", "timestamps"])
+
+            if not full:
+                # Packages processed by a previous run but never reported,
+                # e.g. whose task was lost, are found again
+                unfinished_packages = get_unfinished_packages(
+                    dist.repo.packages_to_rebuild, stored_packages, exclude=packages)
+                if unfinished_packages:
+                    log.debug(f"{dist}: {len(unfinished_packages)} unfinished packages found")
+                packages = packages + unfinished_packages
+
+            candidates = []
             for package in packages:
                 # check if package has already been triggered for build
                 stored_package = stored_packages.get(str(package), None)
                 if stored_package and stored_package.status in \
-                        ("reproducible", "unreproducible", "failure", "retry"):
+                        ("reproducible", "unreproducible", "failure"):
                     if stored_package.status in ("reproducible", "unreproducible"):
                         log.debug(f"{package}: already built ({stored_package.status}). Skipping")
                         continue
@@ -137,18 +277,40 @@ def get(dist, **kwargs):
                         if not kwargs.get("force_retry", None):
                             log.debug(f"{package}: already built ({stored_package.status}). Skipping")
                             continue
-                    if stored_package.status == "retry":
-                        log.debug(f"{package}: already submitted. Skipping.")
-                        continue
-
-                if dict(package) not in rebuild_queued_tasks:
-                    log.debug(f"{package}: submitted for rebuild.")
-                    # Add rebuild task
-                    rebuild.delay(package)
-                    # For debug purposes
-                    result.setdefault("get", []).append(dict(package))
-                else:
-                    log.debug(f"{package}: already submitted. Skipping.")
+                candidates.append(package)
+
+            # packages queued, running, waiting to be retried or reported
+            inflight_packages = get_inflight_packages(app, candidates)
+
+            packages_to_submit = [p for p in candidates if p not in inflight_packages]
+            if inflight_packages:
+                log.debug(f"{dist}: {len(inflight_packages)} packages already submitted. Skipping.")
+            # needed for buildinfo age priority and snapshot groups
+            dist.repo.fetch_buildinfo_dates(packages_to_submit)
+            priorities = get_rebuild_priorities(dist, packages_to_submit)
+            # builds needing the same snapshot run one after the other
+            groups = get_snapshot_groups(dist, packages_to_submit, stored_packages)
+            # most important packages are submitted first then the longest ones
+            model = DurationModel(get_build_durations(app, {p.name for p in packages_to_submit}))
+            packages_to_submit = model.sort_longest_first(packages_to_submit, priorities, groups)
+            # known short rebuilds don't wait behind long ones
+            threshold = Config["project"].get(dist.project, {}).get(
+                "fast-lane-threshold", Config["common"]["fast-lane-threshold"])
+            queues = {p: FAST_REBUILD_QUEUE for p in packages_to_submit
+                      if model.is_fast(p, threshold)}
+            submit_rebuilds(packages_to_submit, priorities, queues)
+            if packages_to_submit:
+                log.debug(f"{dist}: {len(packages_to_submit)} packages submitted "
+                          f"({len(queues)} in fast lane) for an expected build time of "
+                          f"{int(model.estimate_drain_time(packages_to_submit))}s")
+            if packages_to_submit:
+                # For debug purposes
+                result["get"] = [dict(p) for p in packages_to_submit]
+
+            # Record processed packages for next incremental run
+            dist.repo.save_snapshot()
+            # Share repository packages with the reporter
+            dist.repo.publish_snapshot()
         except RebuilderExceptionDist:
             log.error(f"Cannot parse dist: {dist}.")
         except RebuilderExceptionGet as e:
@@ -164,12 +326,18 @@ def rebuild(package, **kwargs):
         log.error("Failed to parse package.")
         raise RebuilderExceptionBuild from e
     builder = getRebuilder(package.distribution, **kwargs)
-    package = builder.run(package=package)
+
+    def publish_log(logfile):
+        # the log of a running build can be tailed (see get_running_rebuild_logs)
+        if rebuild.request.id:
+            rebuild.update_state(state=BUILDING_STATE, meta={"package": dict(package), "log": logfile})
+
+    package = builder.run(package=package, log_callback=publish_log)
     result = {"rebuild": [dict(package)]}
     return result
 
 
-@app.task(base=BaseTask)
+@app.task(base=ReportingTask)
 def attest(package, **kwargs):
     try:
         package = getPackage(package)
@@ -215,12 +383,12 @@ def attest(package, **kwargs):
         log.info(f"Unable to sign in-toto reproducible/unreproducible metadata: "
                  f"no GPG keyid provided for project '{project}.")
 
-    report.delay(package)
+    report.delay(dict(package))
     result = {"attest": [dict(package)]}
     return result
 
 
-@app.task(base=BaseTask)
+@app.task(base=ReportTask)
 def report(package, **kwargs):
     try:
         package = getPackage(package)
@@ -241,7 +409,9 @@ def report(package, **kwargs):
     log_file = os.path.basename(package.log)
     dst_log = f"{log_dir}/{log_file}"
     if not os.path.exists(dst_log):
-        shutil.move(src_log, dst_log)
+        move_path(src_log, dst_log)
+    if os.path.exists(f"{src_log}.gz") and not os.path.exists(f"{dst_log}.gz"):
+        move_path(f"{src_log}.gz", f"{dst_log}.gz")
 
     # store new log location
     package.log = dst_log
@@ -256,7 +426,7 @@ def report(package, **kwargs):
         if not os.path.exists(src_buildinfo):
             raise RebuilderExceptionReport(f"Cannot find buildinfo file {src_buildinfo}")
         if not os.path.exists(dst_buildinfo):
-            shutil.move(src_buildinfo, dst_buildinfo)
+            move_path(src_buildinfo, dst_buildinfo)
 
         # store new buildinfo location
         package.buildinfos["new"] = dst_buildinfo
@@ -266,7 +436,7 @@ def report(package, **kwargs):
     if package.status == "unreproducible" and os.path.exists(diffoscope_src_log):
         diffoscope_dst_log = f"{log_dir}/{os.path.splitext(log_file)[0]}.diffoscope.log"
         if not os.path.exists(diffoscope_dst_log):
-            shutil.move(diffoscope_src_log, diffoscope_dst_log)
+            move_path(diffoscope_src_log, diffoscope_dst_log)
         if not os.path.exists(diffoscope_dst_log):
             raise RebuilderExceptionReport(
                 f"Cannot find build diffoscope log file {diffoscope_dst_log}")
@@ -278,8 +448,12 @@ def report(package, **kwargs):
     else:
         log.error(f"Cannot find package artifacts for cleaning {package}")
 
+    # keep track of the latest status of every package
+    store_packages(app, [package])
+    record_build_duration(app, package)
+
     result = {"report": [dict(package)]}
-    upload.delay(package)
+    upload.delay(dict(package))
     return result
 
 
@@ -291,78 +465,51 @@ def upload(package=None, project=None, upload_results=False, upload_all=False):
         log.error("Failed to parse package.")
         raise RebuilderExceptionUpload from e
 
-    ssh_key = Config["common"].get("repo-ssh-key", None)
-    remote_ssh_host = Config["common"].get("repo-remote-ssh-host", None)
-    remote_ssh_basedir = Config["common"].get("repo-remote-ssh-basedir", None)
-
     if package:
         project = get_project(package.distribution)
 
     if not project:
         raise RebuilderExceptionUpload(f"Cannot determine underlying project for {package}")
 
-    ssh_key = Config["project"][project].get(
-        "repo-ssh-key", ssh_key)
-    remote_ssh_host = Config["project"][project].get(
-        "repo-remote-ssh-host", remote_ssh_host)
-    remote_ssh_basedir = Config["project"][project].get(
-        "repo-remote-ssh-basedir", remote_ssh_basedir)
-
+    uploader = Uploader(project)
     try:
-        if ssh_key and remote_ssh_host and remote_ssh_basedir:
-            # W: pay attention to latest "/", we use rsync!
-            # W: this is relative path to /var/lib/rebuilder
-            dir_to_upload = [
-                f"rebuild/{project}/"
-            ]
-            # dir_to_upload = [
-            #     f"rebuild/{project}/logs/",
-            #     f"rebuild/{project}/buildinfos/",
-            #     f"rebuild/{project}/sources/",
-            #     f"rebuild/{project}/unreproducible/sources/",
-            # ]
-            # if upload_all:
-            #     dir_to_upload += [
-            #         f"rebuild/{project}/",
-            #     ]
-            # if package and package.status in ("reproducible", "unreproducible"):
-            #     if package.metadata.get("reproducible"):
-            #         metadata_path = get_intoto_metadata_package(
-            #             package, unreproducible=False
-            #         )
-            #         dir_to_upload.append(f"{metadata_path}/")
-            #     if package.metadata.get("unreproducible"):
-            #         metadata_path_unrepr = get_intoto_metadata_package(
-            #             package, unreproducible=True
-            #         )
-            #         dir_to_upload.append(f"{metadata_path_unrepr}/")
-            # if upload_results:
-            #     dir_to_upload.append(f"rebuild/{project}/results/")
-            for local_dir in dir_to_upload:
-                # fixme: maybe ssh keyword is useless: someone could
-                #  serve a local mirror directly
-                remote_host = remote_ssh_host
-                remote_basedir = remote_ssh_basedir
-                remote_dir = f"{remote_basedir}/{local_dir}"
-                remote_path = f"{remote_host}:{remote_dir}"
-
-                createfolder_cmd = [
-                    "ssh", "-i", f"/root/.ssh/{ssh_key}",
-                    "-o", "StrictHostKeyChecking=no", remote_host,
-                    "mkdir", "-p", remote_dir
-                ]
-                subprocess.run(createfolder_cmd, check=True)
-
-                cmd = [
-                    "rsync", "-av", "--progress", "-e",
-                    f"ssh -i /root/.ssh/{ssh_key} -o StrictHostKeyChecking=no",
-                    f"/var/lib/rebuilder/{local_dir}", remote_path
-                ]
-                subprocess.run(cmd, check=True)
-        else:
+        if not uploader.is_configured():
             raise FileNotFoundError("Missing SSH key or SSH remote destination")
+        if package:
+            # files of packages reported meanwhile are uploaded together
+            paths = get_package_upload_paths(package)
+            if queue_upload_paths(app, project, paths):
+                _upload_pending.apply_async((project,), countdown=UPLOAD_COALESCE_DELAY)
+        if upload_results or upload_all:
+            uploader.connect()
+        if upload_results:
+            uploader.upload_dir(f"rebuild/{project}/results/")
+        if upload_all:
+            # reconcile the whole project tree
+            uploader.upload_dir(f"rebuild/{project}/")
     except (subprocess.CalledProcessError, FileNotFoundError, ValueError) as e:
         log.error(str(e))
         raise RebuilderExceptionUpload("Failed to upload")
     result = {"upload": [dict(package)] if package else []}
     return result
+
+
+@app.task(base=BaseTask)
+def _upload_pending(project):
+    uploader = Uploader(project)
+    paths = uploader.get_valid_paths(pop_upload_paths(app, project))
+    try:
+        if paths:
+            uploader.connect()
+        uploaded, failed = uploader.upload_files(paths)
+    except (subprocess.CalledProcessError, FileNotFoundError, ValueError) as e:
+        log.error(str(e))
+        if requeue_upload_paths(app, project, paths):
+            _upload_pending.apply_async((project,), countdown=UPLOAD_RETRY_DELAY)
+        raise RebuilderExceptionUpload("Failed to upload")
+    log.debug(f"{project}: {len(uploaded)} files uploaded")
+    # only files which were not transferred are uploaded again, even if no
+    # package is reported anymore
+    if requeue_upload_paths(app, project, failed):
+        _upload_pending.apply_async((project,), countdown=UPLOAD_RETRY_DELAY)
+    return {"upload": uploaded}
@@ -0,0 +1,56 @@
+import os
+import tempfile
+import time
+
+from unittest.mock import patch
+
+from app.lib.cache import LRUStore
+
+
+def _put(store, key, size):
+    src = f"{os.path.dirname(store.path)}/{key}"
+    with open(src, "wb") as fd:
+        fd.write(b"0" * size)
+    return store.put(key, src)
+
+
+def test_lru_store():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = LRUStore(f"{tmpdir}/store", budget=250)
+        _put(store, "aa01", 100)
+        _put(store, "bb02", 100)
+        assert store.get("aa01") == f"{tmpdir}/store/aa/aa01"
+        assert store.get("cc03") is None
+
+        # 'bb02' is the least recently used entry
+        os.utime(f"{tmpdir}/store/bb/bb02", (time.time() - 60, time.time() - 60))
+        _put(store, "cc03", 100)
+        assert store.get("bb02") is None
+        assert store.get("aa01") and store.get("cc03")
+
+        assert store.stats() == {"hits": 3, "misses": 2, "entries": 2, "size": 200}
+
+
+def test_lru_store_scans():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = LRUStore(f"{tmpdir}/store", budget=1000)
+        with patch.object(store, "entries", wraps=store.entries) as entries:
+            for idx in range(5):
+                _put(store, f"aa0{idx}", 100)
+            # size of the store is known from then on
+            assert entries.call_count == 1
+            # over budget
+            _put(store, "bb01", 550)
+            assert entries.call_count == 2
+            assert store.stats()["size"] <= 1000
+
+            # shared by another instance
+            other = LRUStore(f"{tmpdir}/store", budget=1000)
+            with patch.object(other, "entries", wraps=other.entries) as other_entries:
+                _put(other, "cc01", 10)
+                assert other_entries.call_count == 0
+
+            # outdated size
+            with patch("app.lib.cache.LRU_RESCAN_INTERVAL", -1):
+                _put(store, "dd01", 10)
+            assert entries.call_count == 4
@@ -0,0 +1,124 @@
+import errno
+import os
+import tempfile
+
+from unittest.mock import patch
+
+import debian.deb822
+import pytest
+
+from app.lib.common import get_buildinfo_fields, parse_deb_buildinfo_fname, \
+    parse_deb_buildinfo_fnames, parse_rpm_buildinfo_fname, parse_rpm_buildinfo_fnames, \
+    move_path
+
+TEST_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)))
+
+
+@pytest.mark.parametrize("buildinfo", [
+    "bash_5.1-3+b1_amd64.buildinfo",
+    "fake_bash_5.1-2+b3_amd64.buildinfo",
+])
+def test_get_buildinfo_fields(buildinfo):
+    with open(f"{TEST_DIR}/data/{buildinfo}", "rb") as fd:
+        content = fd.read()
+    expected = debian.deb822.BuildInfo(content)
+    fields = ["Binary", "Architecture", "Version", "Binary-Only-Changes"]
+
+    with open(f"{TEST_DIR}/data/{buildinfo}", "rb") as fd:
+        for data in (content, content.decode("utf8"), fd):
+            parsed = get_buildinfo_fields(data, fields)
+            for field in fields:
+                if field in expected:
+                    assert parsed[field].split() == expected[field].split()
+                else:
+                    assert field not in parsed
+
+
+def test_get_buildinfo_fields_stops_early():
+    lines = iter([
+        b"Format: 1.0\n",
+        b"Source: bash (5.1-2)\n",
+        b"Binary: bash bash-static\n",
+        b"Architecture: amd64\n",
+        b"Version: 5.1-2+b3\n",
+    ])
+    assert get_buildinfo_fields(lines, ["binary"]) == {"binary": "bash bash-static"}
+    # reading stopped at the field following Binary
+    assert next(lines) == b"Version: 5.1-2+b3\n"
+
+
+def test_parse_deb_buildinfo_fnames():
+    with open(f"{TEST_DIR}/data/buildinfo-pool_unstable_amd64.list") as fd:
+        buildinfos = [f"https://buildinfos.debian.net{line.strip()}" for line in fd]
+    parsed = list(parse_deb_buildinfo_fnames(buildinfos))
+    assert [buildinfo for buildinfo, _ in parsed] == buildinfos
+    for buildinfo, parsed_bn in parsed:
+        name, version, arch = buildinfo.rsplit('/', 1)[-1].replace('.buildinfo', '').split('_')
+        assert parsed_bn.name == name
+        assert parsed_bn.version == version
+        assert parsed_bn.arch == tuple(arch.split('-'))
+
+    assert parse_deb_buildinfo_fname("/pool/f/foo/foo_1:2.0-1_amd64-source.buildinfo") == {
+        "name": "foo", "epoch": "1", "version": "1:2.0-1", "arch": ["amd64", "source"]
+    }
+    assert parse_deb_buildinfo_fname("foo_2.0-1_all.buildinfo")["epoch"] is None
+    assert not parse_deb_buildinfo_fname("foo__amd64.buildinfo")
+    assert not parse_deb_buildinfo_fname("foo_1.0_bar_amd64.buildinfo")
+    assert list(parse_deb_buildinfo_fnames(["foo.buildinfo"])) == []
+
+
+def test_parse_rpm_buildinfo_fnames():
+    assert parse_rpm_buildinfo_fname(
+        "https://yum.qubes-os.org/r4.1/current/vm/fc32/rpm/"
+        "qubes-core-agent-4.1.20-1.fc32.x86_64.buildinfo") == {
+        "name": "qubes-core-agent", "epoch": "", "version": "4.1.20-1.fc32", "arch": "x86_64",
+        "release": "1.fc32"
+    }
+    parsed = dict(parse_rpm_buildinfo_fnames([
+        "1:foo-bar-1.0-2.fc32.noarch-buildinfo", "foo.buildinfo"
+    ]))
+    assert list(parsed) == ["1:foo-bar-1.0-2.fc32.noarch-buildinfo"]
+    parsed_bn = parsed["1:foo-bar-1.0-2.fc32.noarch-buildinfo"]
+    assert (parsed_bn.name, parsed_bn.epoch, parsed_bn.version, parsed_bn.arch) == \
+        ("foo-bar", "1", "1.0-2.fc32", "noarch")
+
+
+def test_move_path():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.makedirs(f"{tmpdir}/build")
+        with open(f"{tmpdir}/build/bash_5.1-2+b3_amd64.deb", "w") as fd:
+            fd.write("deb")
+        inode = os.stat(f"{tmpdir}/build/bash_5.1-2+b3_amd64.deb").st_ino
+        assert move_path(f"{tmpdir}/build", f"{tmpdir}/artifacts")
+        assert not os.path.exists(f"{tmpdir}/build")
+        # no copy
+        assert os.stat(f"{tmpdir}/artifacts/bash_5.1-2+b3_amd64.deb").st_ino == inode
+
+
+def test_move_path_cross_device():
+    rename = os.rename
+
+    def cross_device_rename(src, dst):
+        # only temporary copies can be renamed
+        if not os.path.basename(src).startswith("."):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        return rename(src, dst)
+
+    with tempfile.TemporaryDirectory() as tmpdir, \
+            patch("app.lib.common.os.rename", side_effect=cross_device_rename):
+        os.makedirs(f"{tmpdir}/build")
+        with open(f"{tmpdir}/build/bash_5.1-2+b3_amd64.deb", "w") as fd:
+            fd.write("deb")
+        os.symlink("bash_5.1-2+b3_amd64.deb", f"{tmpdir}/build/bash.deb")
+        assert not move_path(f"{tmpdir}/build", f"{tmpdir}/artifacts")
+        assert not os.path.exists(f"{tmpdir}/build")
+        assert os.path.islink(f"{tmpdir}/artifacts/bash.deb")
+        with open(f"{tmpdir}/artifacts/bash_5.1-2+b3_amd64.deb") as fd:
+            assert fd.read() == "deb"
+
+        with open(f"{tmpdir}/build.log", "w") as fd:
+            fd.write("log")
+        assert not move_path(f"{tmpdir}/build.log", f"{tmpdir}/artifacts/build.log")
+        assert not os.path.exists(f"{tmpdir}/build.log")
+        assert sorted(os.listdir(f"{tmpdir}/artifacts")) == \
+            ["bash.deb", "bash_5.1-2+b3_amd64.deb", "build.log"]
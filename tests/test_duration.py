@@ -0,0 +1,82 @@
+import os
+
+from unittest.mock import MagicMock, patch
+
+from app.lib.duration import DurationModel, DEFAULT_BUILD_DURATION
+from app.lib.get import getPackage
+from app.lib.tool import get_rebuild_queues_drain_estimate
+
+TEST_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)))
+os.environ["PACKAGE_REBUILDER_CONF"] = f"{TEST_DIR}/rebuilder.conf"
+
+
+def get_package(name):
+    return getPackage({
+        "name": name, "epoch": None, "version": "1.0-1", "arch": "amd64",
+        "distribution": "unstable"
+    })
+
+
+def test_duration_model():
+    model = DurationModel({"libreoffice": 20000, "bash": 300, "hello": 30})
+    assert model.estimate(get_package("bash")) == 300
+    # unknown packages are expected to take the median duration
+    assert model.estimate(get_package("coreutils")) == 300
+    assert DurationModel({}).estimate(get_package("coreutils")) == DEFAULT_BUILD_DURATION
+
+    assert model.is_fast(get_package("hello"), 60)
+    assert not model.is_fast(get_package("hello"), 0)
+    assert not model.is_fast(get_package("bash"), 60)
+    assert not model.is_fast(get_package("coreutils"), 1000)
+
+
+def test_duration_model_longest_first():
+    model = DurationModel({"libreoffice": 20000, "bash": 300, "hello": 30})
+    packages = [get_package(name) for name in ("hello", "bash", "libreoffice")]
+    assert [p.name for p in model.sort_longest_first(packages)] == \
+           ["libreoffice", "bash", "hello"]
+    # priority comes first
+    priorities = {packages[0]: 0, packages[1]: 5, packages[2]: 5}
+    assert [p.name for p in model.sort_longest_first(packages, priorities)] == \
+           ["hello", "libreoffice", "bash"]
+
+
+def test_duration_model_drain_time():
+    model = DurationModel({"a": 10, "b": 7, "c": 5, "d": 4, "e": 3})
+    packages = [get_package(name) for name in "abcde"]
+    assert model.estimate_drain_time(packages) == 29
+    # LPT: [10, 4] and [7, 5, 3]
+    assert model.estimate_drain_time(packages, workers=2) == 15
+    assert model.estimate_drain_time(packages, workers=10) == 10
+    assert model.estimate_drain_time([], workers=2) == 0
+
+
+def test_duration_model_groups():
+    model = DurationModel({"libreoffice": 20000, "bash": 300, "hello": 30, "gcc-10": 10000})
+    packages = [get_package(name) for name in ("hello", "bash", "libreoffice", "gcc-10")]
+    # 'hello' needs the same snapshot timestamp than 'libreoffice'
+    groups = {packages[0]: "20210615T000000Z", packages[2]: "20210615T000000Z"}
+    assert [p.name for p in model.sort_longest_first(packages, groups=groups)] == \
+           ["libreoffice", "hello", "gcc-10", "bash"]
+
+
+def test_rebuild_queues_drain_estimate():
+    app = MagicMock()
+    app.control.inspect.return_value.active_queues.return_value = {
+        "rebuilder1": [{"name": "rebuild"}, {"name": "rebuild-fast"}],
+        "rebuilder2": [{"name": "rebuild"}],
+        "reporter": [{"name": "report"}],
+    }
+    app.control.inspect.return_value.stats.return_value = {
+        "rebuilder1": {"pool": {"max-concurrency": 2}},
+        "rebuilder2": {"pool": {"max-concurrency": 1}},
+        "reporter": {"pool": {"max-concurrency": 4}},
+    }
+    tasks = {"rebuild": [dict(get_package(name)) for name in "abcde"]}
+    with patch("app.lib.tool.get_celery_queued_tasks",
+               side_effect=lambda app, queue_name: tasks.get(queue_name, [])), \
+            patch("app.lib.tool.get_build_durations",
+                  return_value={"a": 10, "b": 7, "c": 5, "d": 4, "e": 3}):
+        estimate = get_rebuild_queues_drain_estimate(app)
+    # LPT on 3 rebuilds at once: [10], [7, 3] and [5, 4]
+    assert estimate == {"queued": 5, "workers": 2, "concurrency": 3, "drain_time": 10}
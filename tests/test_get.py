@@ -1,13 +1,16 @@
 import os
+import re
+import tempfile
 import pytest
 import pytest_mock
 import requests_mock
 import requests
 from unittest.mock import MagicMock, patch
 
+from app.lib.cache import HTTPCache
 from app.lib.exceptions import RebuilderExceptionDist
-from app.lib.get import RebuilderDist, DebianRepository, QubesRepository, \
-    DebianPackage, QubesPackage, getPackage
+from app.lib.get import RebuilderDist, BaseRepository, DebianRepository, QubesRepository, \
+    DebianPackage, QubesPackage, getPackage, fetch_urls
 
 TEST_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)))
 
@@ -106,16 +109,17 @@ def test_repo_debian(requests_mock):
     assert packages_in_test == expected_packages_in_test
 
 
-@patch("app.lib.get.subprocess.run")
-def test_repo_qubesos_rsync(mock_run):
-    mock_stdout = MagicMock()
+@patch("app.lib.get.subprocess.Popen")
+def test_repo_qubesos_rsync(mock_popen):
+    mock_proc = MagicMock()
     with open(f"{TEST_DIR}/data/rsync_result.txt", "r") as fd:
-        mock_stdout.configure_mock(
+        mock_proc.configure_mock(
             **{
-                "stdout.decode.return_value": fd.read()
+                "stdout": fd.readlines(),
+                "returncode": 0
             }
         )
-    mock_run.return_value = mock_stdout
+    mock_popen.return_value.__enter__.return_value = mock_proc
 
     dist = RebuilderDist("qubes-4.1-vm-bullseye.amd64")
     buildinfos = dist.repo.get_rsync_files("rsync://ftp.qubes-os.org/qubes-mirror/repo/deb")
@@ -129,39 +133,302 @@ def test_repo_qubesos_rsync(mock_run):
     assert set(buildinfos) == set(expected_buildinfos)
 
 
-def test_repo_qubesos():
-    buildinfos = [
-        'pool/main/d/dnf/dnf_4.5.2-1+deb11u1_amd64.buildinfo',
-        'pool/main/q/qubes-artwork/qubes-artwork_4.1.10-1+deb11u1_amd64.buildinfo',
-        'pool/main/q/qubes-core-agent/qubes-core-agent_4.1.7-1+deb11u1_amd64.buildinfo',
-        'pool/main/q/qubes-core-qrexec/qubes-core-qrexec_4.1.9-1+deb11u1_amd64.buildinfo',
-        'pool/main/q/qubes-desktop-linux-common/qubes-desktop-linux-common_4.0.18-1+deb11u1_amd64.buildinfo'
-    ]
+def qubes_buildinfo_callback(request, context):
+    # Minimal buildinfo content: dnf is the only arch independent package
+    name, version, _ = os.path.basename(request.path).split('_')
+    architecture = "all source" if name == "dnf" else "amd64 source"
+    return f"Format: 1.0\nSource: {name}\nBinary: {name}\n" \
+           f"Architecture: {architecture}\nVersion: {requests.utils.unquote(version)}\n"
+
+
+def test_repo_qubesos(requests_mock):
+    buildinfos_mock = requests_mock.get(re.compile("https://deb.qubes-os.org/"),
+                                        text=qubes_buildinfo_callback)
+    buildinfos = {
+        'pool/main/d/dnf/dnf_4.5.2-1+deb11u1_amd64.buildinfo':
+            (11392, '2020/12/23 14:57:05'),
+        'pool/main/q/qubes-artwork/qubes-artwork_4.1.10-1+deb11u1_amd64.buildinfo':
+            (11687, '2021/05/18 04:12:09'),
+        'pool/main/q/qubes-core-agent/qubes-core-agent_4.1.7-1+deb11u1_amd64.buildinfo':
+            (10705, '2020/01/17 05:51:06'),
+        'pool/main/q/qubes-core-qrexec/qubes-core-qrexec_4.1.9-1+deb11u1_amd64.buildinfo':
+            (8554, '2020/10/10 06:06:02'),
+        'pool/main/q/qubes-desktop-linux-common/qubes-desktop-linux-common_4.0.18-1+deb11u1_amd64.buildinfo':
+            (9654, '2021/08/19 16:38:11')
+    }
 
-    def get_rsync_files(*args, **kwargs):
+    def get_rsync_listing(*args, **kwargs):
         return buildinfos
 
-    QubesRepository.get_rsync_files = get_rsync_files
+    with tempfile.TemporaryDirectory() as cache_dir, \
+            patch.object(QubesRepository, "get_rsync_listing", get_rsync_listing):
+        dist = RebuilderDist("qubes-4.1-vm-bullseye.amd64", cache_dir=cache_dir)
+        expected_packages_in_test = [
+            QubesPackage(name="qubes-artwork", version="4.1.10-1+deb11u1", arch="amd64", epoch=None,
+                         distribution="qubes-4.1-vm-bullseye", buildinfos={"old": ""}),
+            QubesPackage(name="qubes-core-agent", version="4.1.7-1+deb11u1", arch="amd64", epoch=None,
+                         distribution="qubes-4.1-vm-bullseye", buildinfos={"old": ""}),
+            QubesPackage(name="qubes-core-qrexec", version="4.1.9-1+deb11u1", arch="amd64", epoch=None,
+                         distribution="qubes-4.1-vm-bullseye", buildinfos={"old": ""}),
+            QubesPackage(name="qubes-desktop-linux-common", version="4.0.18-1+deb11u1", arch="amd64",
+                         epoch=None,
+                         distribution="qubes-4.1-vm-bullseye", buildinfos={"old": ""})
+        ]
+        packages_in_test = sorted(dist.repo.get_packages_to_rebuild(), key=lambda x: x.name)
+        assert packages_in_test == expected_packages_in_test
+        assert buildinfos_mock.call_count == 5
 
-    dist = RebuilderDist("qubes-4.1-vm-bullseye.amd64")
-    expected_packages_in_test = [
-        QubesPackage(name="qubes-artwork", version="4.1.10-1+deb11u1", arch="amd64", epoch=None,
-                     distribution="qubes-4.1-vm-bullseye", buildinfos={"old": ""}),
-        QubesPackage(name="qubes-core-agent", version="4.1.7-1+deb11u1", arch="amd64", epoch=None,
-                     distribution="qubes-4.1-vm-bullseye", buildinfos={"old": ""}),
-        QubesPackage(name="qubes-core-qrexec", version="4.1.9-1+deb11u1", arch="amd64", epoch=None,
-                     distribution="qubes-4.1-vm-bullseye", buildinfos={"old": ""}),
-        QubesPackage(name="qubes-desktop-linux-common", version="4.0.18-1+deb11u1", arch="amd64",
-                     epoch=None,
-                     distribution="qubes-4.1-vm-bullseye", buildinfos={"old": ""})
+        # every buildinfo is now indexed
+        dist = RebuilderDist("qubes-4.1-vm-bullseye.all", cache_dir=cache_dir)
+        expected_packages_in_test = [
+            QubesPackage(name="dnf", version="4.5.2-1+deb11u1", arch="all", epoch=None,
+                         distribution="qubes-4.1-vm-bullseye", buildinfos={"old": ""}),
+        ]
+        packages_in_test = sorted(dist.repo.get_packages_to_rebuild(), key=lambda x: x.name)
+        assert packages_in_test == expected_packages_in_test
+        assert buildinfos_mock.call_count == 5
+
+        # changed buildinfo is downloaded again
+        buildinfos['pool/main/d/dnf/dnf_4.5.2-1+deb11u1_amd64.buildinfo'] = \
+            (11393, '2021/12/23 14:57:05')
+        dist = RebuilderDist("qubes-4.1-vm-bullseye.all", cache_dir=cache_dir)
+        assert len(dist.repo.get_packages_to_rebuild()) == 1
+        assert buildinfos_mock.call_count == 6
+
+
+def test_http_cache(requests_mock):
+    url = "https://buildinfos.debian.net/buildinfo-pool_unstable_amd64.list"
+    content = "/buildinfo-pool/b/bash/bash_5.1-2+b3_amd64.buildinfo\n"
+
+    def callback(request, context):
+        if request.headers.get("If-None-Match", None) == '"v1"':
+            context.status_code = 304
+            return ""
+        context.status_code = 200
+        context.headers["ETag"] = '"v1"'
+        return content
+
+    requests_mock.get(url, text=callback)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        parser = MagicMock(side_effect=lambda text: text.split())
+        cache = HTTPCache(cache_dir)
+        assert cache.get(url, parser=parser) == content.split()
+        assert requests_mock.last_request.headers.get("If-None-Match", None) is None
+
+        # unchanged content is neither downloaded nor parsed again
+        cache = HTTPCache(cache_dir)
+        assert cache.get(url, parser=parser) == content.split()
+        assert requests_mock.last_request.headers["If-None-Match"] == '"v1"'
+        assert parser.call_count == 1
+
+        # cached copy is used when remote is not reachable
+        HTTPCache._parsed.clear()
+        requests_mock.get(url, exc=requests.exceptions.ConnectionError)
+        assert cache.get(url, parser=parser) == content.split()
+        requests_mock.get(url, exc=requests.exceptions.ReadTimeout)
+        assert cache.get(url, parser=parser) == content.split()
+        # and when remote fails
+        for status_code in (500, 503, 429):
+            requests_mock.get(url, status_code=status_code)
+            assert cache.get(url, parser=parser) == content.split()
+
+        # cached copy is dropped when remote resource is gone
+        requests_mock.get(url, status_code=404)
+        assert cache.get(url, parser=parser) is None
+        requests_mock.get(url, status_code=500)
+        assert cache.get(url, parser=parser) is None
+
+
+def test_repo_debian_timeout(requests_mock):
+    url = "https://buildinfos.debian.net/buildinfo-pool_unstable_amd64.list"
+    requests_mock.get(url, exc=requests.exceptions.ReadTimeout)
+    requests_mock.get("https://jenkins.debian.net/userContent/reproducible/debian/pkg-sets/"
+                      "unstable/essential.pkgset", exc=requests.exceptions.ReadTimeout)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        dist = RebuilderDist("unstable.amd64", cache_dir=cache_dir)
+        assert dist.repo.get_buildinfo_files() == []
+        assert dist.repo.get_package_names_in_debian_set("essential") == []
+
+
+def test_repo_debian_updated_packages(requests_mock):
+    url = "https://buildinfos.debian.net/buildinfo-pool_unstable_amd64.list"
+    pool = [
+        "/buildinfo-pool/a/apt/apt_2.3.8_amd64.buildinfo",
+        "/buildinfo-pool/b/bash/bash_5.1_amd64.buildinfo",
     ]
-    packages_in_test = sorted(dist.repo.get_packages_to_rebuild(), key=lambda x: x.name)
-    assert packages_in_test == expected_packages_in_test
+    with tempfile.TemporaryDirectory() as cache_dir:
+        requests_mock.get(url, text="\n".join(pool))
+        dist = RebuilderDist("unstable.amd64", cache_dir=cache_dir)
+        packages = dist.repo.get_updated_packages_to_rebuild()
+        assert sorted(p.name for p in packages) == ["apt", "bash"]
+        dist.repo.save_snapshot()
 
-    dist = RebuilderDist("qubes-4.1-vm-bullseye.all")
-    expected_packages_in_test = [
-        QubesPackage(name="dnf", version="4.5.2-1+deb11u1", arch="all", epoch=None,
-                     distribution="qubes-4.1-vm-bullseye", buildinfos={"old": ""}),
+        # new version of apt and new package coreutils
+        pool += [
+            "/buildinfo-pool/a/apt/apt_2.3.9_amd64.buildinfo",
+            "/buildinfo-pool/c/coreutils/coreutils_8.32_amd64.buildinfo",
+        ]
+        requests_mock.get(url, text="\n".join(pool))
+        dist = RebuilderDist("unstable.amd64", cache_dir=cache_dir)
+        packages = dist.repo.get_updated_packages_to_rebuild()
+        assert sorted(str(p) for p in packages) == ["apt-2.3.9.amd64", "coreutils-8.32.amd64"]
+
+        dist = RebuilderDist("unstable.amd64", cache_dir=cache_dir)
+        packages = dist.repo.get_updated_packages_to_rebuild(full=True)
+        assert len(packages) == 3
+
+
+def test_repo_debian_package_sets(requests_mock):
+    pool = [
+        "/buildinfo-pool/a/apt/apt_2.3.9_amd64.buildinfo",
+        "/buildinfo-pool/b/bash/bash_5.1-2+b3_amd64.buildinfo",
+        "/buildinfo-pool/c/coreutils/coreutils_8.32-4+b1_amd64.buildinfo",
     ]
-    packages_in_test = sorted(dist.repo.get_packages_to_rebuild(), key=lambda x: x.name)
-    assert packages_in_test == expected_packages_in_test
+    requests_mock.get("https://buildinfos.debian.net/buildinfo-pool_unstable_amd64.list",
+                      text="\n".join(pool))
+    pkgset_baseurl = "https://jenkins.debian.net/userContent/reproducible/debian/pkg-sets/unstable"
+    essential = requests_mock.get(f"{pkgset_baseurl}/essential.pkgset", text="bash\ncoreutils\n")
+    required = requests_mock.get(f"{pkgset_baseurl}/required.pkgset", text="apt\nbash\nlibc6\n")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        dist = RebuilderDist("unstable+essential+required.amd64", cache_dir=cache_dir)
+        assert [p.name for p in dist.repo.get_packages_to_rebuild("essential")] == \
+               ["bash", "coreutils"]
+        assert [p.name for p in dist.repo.get_packages_to_rebuild("required")] == \
+               ["apt", "bash"]
+        assert [p.name for p in dist.repo.get_packages_to_rebuild()] == \
+               ["apt", "bash", "coreutils"]
+        assert essential.call_count == 1
+        assert required.call_count == 1
+
+
+def test_repo_debian_snapshot(requests_mock):
+    pool = [
+        "/buildinfo-pool/a/apt/apt_2.3.9_amd64.buildinfo",
+        "/buildinfo-pool/b/bash/bash_5.1-2+b3_amd64.buildinfo",
+        "/buildinfo-pool/c/coreutils/coreutils_8.32-4+b1_amd64.buildinfo",
+        "/buildinfo-pool/s/shadow/shadow_1:4.8.1-1_amd64.buildinfo",
+    ]
+    requests_mock.get("https://buildinfos.debian.net/buildinfo-pool_unstable_amd64.list",
+                      text="\n".join(pool))
+    pkgset_baseurl = "https://jenkins.debian.net/userContent/reproducible/debian/pkg-sets/unstable"
+    requests_mock.get(f"{pkgset_baseurl}/essential.pkgset", text="bash\ncoreutils\nshadow\n")
+    requests_mock.get(f"{pkgset_baseurl}/required.pkgset", text="apt\nbash\nlibc6\n")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        dist = RebuilderDist("unstable+essential+required.amd64", cache_dir=cache_dir)
+        assert dist.repo.load_snapshot() is None
+        dist.repo.get_updated_packages_to_rebuild()
+        dist.repo.publish_snapshot()
+        dist.repo.publish_snapshot()
+        assert dist.repo.repository_snapshot.get_generation() == 2
+        expected = {
+            "essential": dist.repo.get_packages_to_rebuild("essential"),
+            "required": dist.repo.get_packages_to_rebuild("required"),
+        }
+
+        # loading the snapshot never hits the network
+        requests_mock.reset_mock()
+        dist = RebuilderDist("unstable+essential+required.amd64", cache_dir=cache_dir)
+        snapshot = dist.repo.load_snapshot()
+        assert requests_mock.call_count == 0
+        assert snapshot == expected
+        for package_set, packages in snapshot.items():
+            assert [dict(p) for p in packages] == [dict(p) for p in expected[package_set]]
+        assert snapshot["essential"][2].epoch == "1"
+
+
+def test_fetch_urls(requests_mock):
+    urls = [f"https://deb.qubes-os.org/{idx}.buildinfo" for idx in range(20)]
+    for idx, url in enumerate(urls):
+        if idx == 3:
+            requests_mock.get(url, exc=requests.exceptions.ConnectionError)
+        else:
+            requests_mock.get(url, text=str(idx))
+    results = dict(fetch_urls(urls, max_workers=4))
+    assert set(results.keys()) == set(urls)
+    assert results[urls[3]] is None
+    assert all(results[url].text == str(idx) for idx, url in enumerate(urls) if idx != 3)
+
+
+def test_repo_qubesos_rsync_changes():
+    url = "rsync://ftp.qubes-os.org/qubes-mirror/repo/deb/r4.1/vm/"
+    listing = {
+        'pool/main/d/dnf/dnf_4.5.2-1+deb11u1_amd64.buildinfo': (11392, '2020/12/23 14:57:05'),
+        'pool/main/q/qubes-artwork/qubes-artwork_4.1.10-1+deb11u1_amd64.buildinfo':
+            (11687, '2021/05/18 04:12:09'),
+    }
+
+    def get_rsync_listing(*args, **kwargs):
+        return dict(listing)
+
+    with tempfile.TemporaryDirectory() as cache_dir, \
+            patch.object(QubesRepository, "get_rsync_listing", get_rsync_listing):
+        dist = RebuilderDist("qubes-4.1-vm-bullseye.amd64", cache_dir=cache_dir)
+        _, added, removed = dist.repo.get_rsync_listings([url])[url]
+        assert added == set(listing.keys())
+        assert not removed
+        # listing is only saved once processed
+        _, added, removed = dist.repo.get_rsync_listings([url])[url]
+        assert added == set(listing.keys())
+        dist.repo.save_listings()
+
+        # other archs have their own listing
+        other = RebuilderDist("qubes-4.1-vm-bullseye.all", cache_dir=cache_dir)
+        _, added, removed = other.repo.get_rsync_listings([url])[url]
+        assert added == set(listing.keys())
+
+        del listing['pool/main/d/dnf/dnf_4.5.2-1+deb11u1_amd64.buildinfo']
+        listing['pool/main/d/dnf/dnf_4.5.2-2+deb11u1_amd64.buildinfo'] = \
+            (11392, '2021/12/23 14:57:05')
+        _, added, removed = dist.repo.get_rsync_listings([url])[url]
+        assert added == {'pool/main/d/dnf/dnf_4.5.2-2+deb11u1_amd64.buildinfo'}
+        assert removed == {'pool/main/d/dnf/dnf_4.5.2-1+deb11u1_amd64.buildinfo'}
+
+
+def test_package_identity():
+    p = {
+        'name': 'bash',
+        'epoch': None,
+        'version': '5.1-3+b1',
+        'arch': 'amd64',
+        'distribution': 'bullseye',
+        'buildinfos': {
+            "old": 'https://buildinfos.debian.net/buildinfo-pool'
+                   '/b/bash/bash_5.1-3+b1_amd64.buildinfo'
+        }
+    }
+    package = getPackage(p)
+    retried = getPackage(dict(p, status="retry", retries=2))
+    assert package == retried
+    assert len({package, retried}) == 1
+    assert {package: "queued"}[retried] == "queued"
+    assert package != getPackage(dict(p, version="5.1-4"))
+    assert package != getPackage(dict(p, distribution="unstable"))
+    assert str(package) == "bash-5.1-3+b1.amd64"
+    assert repr(retried) == "bash-5.1-3+b1.amd64=retry"
+
+    # identity is immutable, other fields are not
+    with pytest.raises(AttributeError):
+        package.version = "5.1-4"
+    # unknown attributes are not silently dropped from records
+    assert not hasattr(package, "__dict__")
+    with pytest.raises(AttributeError):
+        package.badge = "reproducible"
+    qubes_package = getPackage(dict(p, distribution="qubes-4.1-vm-bullseye"))
+    assert not hasattr(qubes_package, "__dict__")
+    package["status"] = "reproducible"
+    assert package.status == "reproducible"
+
+    # round trip for Celery
+    d = dict(package)
+    assert d["status"] == "reproducible" and d["buildinfos"] == p["buildinfos"]
+    assert getPackage(d) == package
+    assert "retries" not in package.to_dict()
+
+
+def test_repo_incomplete():
+    class IncompleteRepository(BaseRepository):
+        def get_packages_to_rebuild(self, package_set=None):
+            return []
+
+    with pytest.raises(TypeError):
+        IncompleteRepository()
@@ -0,0 +1,154 @@
+import json
+import os
+import tempfile
+
+from app.config import parse_weights
+from app.lib.get import RebuilderDist, getPackage
+from app.lib.priority import get_rebuild_priority, get_queue_lanes, DEFAULT_PRIORITY, \
+    MIN_PRIORITY, MAX_PRIORITY
+
+TEST_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)))
+os.environ["PACKAGE_REBUILDER_CONF"] = f"{TEST_DIR}/rebuilder.conf"
+
+WEIGHTS = {
+    "package-sets": parse_weights("essential:4 required:3 build-essential:3"),
+    "repositories": parse_weights("security-testing:4 current-testing:1"),
+    "buildinfo-age": {7: 2, 30: 1},
+    "retry": -1,
+}
+
+
+def test_parse_weights():
+    assert parse_weights("essential:4\nbuild-essential:-1") == \
+           {"essential": 4, "build-essential": -1}
+
+
+def test_rebuild_priority():
+    assert get_rebuild_priority(WEIGHTS) == DEFAULT_PRIORITY
+    # only the most important package set counts
+    assert get_rebuild_priority(WEIGHTS, package_sets=["required", "essential"]) == \
+           DEFAULT_PRIORITY - 4
+    assert get_rebuild_priority(WEIGHTS, repository="current-testing") == DEFAULT_PRIORITY - 1
+    assert get_rebuild_priority(WEIGHTS, buildinfo_age=3) == DEFAULT_PRIORITY - 2
+    assert get_rebuild_priority(WEIGHTS, buildinfo_age=10) == DEFAULT_PRIORITY - 1
+    assert get_rebuild_priority(WEIGHTS, buildinfo_age=100) == DEFAULT_PRIORITY
+    assert get_rebuild_priority(WEIGHTS, retries=2) == DEFAULT_PRIORITY + 2
+    # priority is bounded to existing lanes
+    assert get_rebuild_priority(
+        WEIGHTS, package_sets=["essential"], repository="security-testing", buildinfo_age=0
+    ) == MIN_PRIORITY
+    assert get_rebuild_priority(WEIGHTS, retries=10) == MAX_PRIORITY
+
+
+def test_queue_lanes():
+    assert get_queue_lanes("rebuild") == ["rebuild"] + [f"rebuild:{i}" for i in range(1, 10)]
+
+
+def test_repo_qubesos_priority_inputs():
+    dist = RebuilderDist("qubes-4.1-vm-bullseye.amd64")
+    package = getPackage({
+        "name": "qubes-gpg-split", "epoch": None, "version": "2.0.53-1+deb11u1", "arch": "amd64",
+        "distribution": "qubes-4.1-vm-bullseye",
+        "buildinfos": {"old": "https://deb.qubes-os.org/r4.1/vm/pool/main/q/qubes-gpg-split/"
+                              "qubes-gpg-split_2.0.53-1+deb11u1_amd64.buildinfo"}
+    })
+    assert dist.repo.get_package_repository(package) is None
+    fedora_package = getPackage({
+        "name": "qubes-core-agent", "epoch": None, "version": "4.1.20-1.fc32", "arch": "noarch",
+        "distribution": "qubes-4.1-vm-fc32",
+        "buildinfos": {"old": "https://yum.qubes-os.org/r4.1/security-testing/vm/fc32/rpm/"
+                              "qubes-core-agent-4.1.20-1.fc32.x86_64.buildinfo"}
+    })
+    assert dist.repo.get_package_repository(fedora_package) == "security-testing"
+    assert dist.repo.get_buildinfo_age(package) is None
+    dist.repo.buildinfo_stats[package.buildinfos["old"]] = (1024, "2021/05/18 04:12:09")
+    assert dist.repo.get_buildinfo_age(package) > 30
+
+
+def test_repo_debian_buildinfo_age(requests_mock):
+    buildinfo = "https://buildinfos.debian.net/buildinfo-pool/b/bash/bash_5.1-2+b3_amd64.buildinfo"
+    package = getPackage({
+        "name": "bash", "epoch": None, "version": "5.1-2+b3", "arch": "amd64",
+        "distribution": "unstable", "buildinfos": {"old": buildinfo}
+    })
+    requests_mock.head(buildinfo, headers={"Last-Modified": "Tue, 18 May 2021 04:12:09 GMT"})
+    with tempfile.TemporaryDirectory() as cache_dir:
+        dist = RebuilderDist("unstable.amd64", cache_dir=cache_dir)
+        assert dist.repo.get_buildinfo_age(package) is None
+        dist.repo.fetch_buildinfo_dates([package])
+        assert dist.repo.get_buildinfo_age(package) > 30
+
+        # dates are kept in buildinfo index
+        requests_mock.reset_mock()
+        dist = RebuilderDist("unstable.amd64", cache_dir=cache_dir)
+        dist.repo.fetch_buildinfo_dates([package])
+        assert requests_mock.call_count == 0
+        assert dist.repo.get_buildinfo_age(package) > 30
+
+
+def test_snapshot_groups(requests_mock):
+    from app.tasks.rebuilder import get_snapshot_groups
+
+    packages = {}
+    for name, version, date in [
+        ("bash", "5.1-2+b3", "Tue, 15 Jun 2021 04:12:09 GMT"),
+        ("dash", "0.5.11", "Tue, 15 Jun 2021 22:02:00 GMT"),
+        ("coreutils", "8.32", "Wed, 16 Jun 2021 10:00:00 GMT"),
+        ("hello", "2.10", None),
+    ]:
+        buildinfo = f"https://buildinfos.debian.net/buildinfo-pool/{name[0]}/{name}/" \
+                    f"{name}_{version}_amd64.buildinfo"
+        packages[name] = getPackage({
+            "name": name, "epoch": None, "version": version, "arch": "amd64",
+            "distribution": "unstable", "buildinfos": {"old": buildinfo}
+        })
+        requests_mock.head(buildinfo, headers={"Last-Modified": date} if date else {})
+    with tempfile.TemporaryDirectory() as cache_dir:
+        dist = RebuilderDist("unstable.amd64", cache_dir=cache_dir)
+        dist.repo.fetch_buildinfo_dates(packages.values())
+        # no previous build: packages built the same day use the same snapshot
+        groups = get_snapshot_groups(dist, packages.values(), {})
+        assert groups == {
+            packages["bash"]: "20210615",
+            packages["dash"]: "20210615",
+            packages["coreutils"]: "20210616",
+        }
+        # the snapshot a previous build used the most comes first
+        stored_coreutils = getPackage(dict(packages["coreutils"],
+                                           timestamps=["20210615T000000Z"]))
+        groups = get_snapshot_groups(dist, packages.values(),
+                                     {str(packages["coreutils"]): stored_coreutils})
+        assert groups[packages["coreutils"]] == "20210615"
+
+
+def test_redis_task_message():
+    import celery
+    from app.lib.tool import get_redis_task_message
+
+    app = celery.Celery("test", broker="memory://")
+    package = {"name": "bash", "version": "5.1-2+b3", "distribution": "unstable"}
+    lane, message = get_redis_task_message(
+        app, "app.tasks.rebuilder.rebuild", (package,), "rebuild", 3)
+    assert lane == "rebuild:3"
+    assert get_redis_task_message(app, "app.tasks.rebuilder.rebuild", (package,),
+                                  "rebuild", -1)[0] == "rebuild"
+    message = json.loads(message)
+
+    with app.connection_for_write() as conn:
+        # same message layout as the one published by kombu
+        queue = conn.SimpleQueue("rebuild")
+        app.send_task("app.tasks.rebuilder.rebuild", (package,), connection=conn,
+                      priority=3, queue="rebuild")
+        expected = conn.default_channel._get("rebuild")
+        assert message.keys() == expected.keys()
+        assert message["headers"].keys() == expected["headers"].keys()
+        assert message["properties"].keys() == expected["properties"].keys()
+
+        # kombu consumes it
+        conn.default_channel._put("rebuild", message)
+        received = queue.get(timeout=1)
+        assert received.headers["task"] == "app.tasks.rebuilder.rebuild"
+        assert received.payload[0] == [package]
+        assert received.properties["priority"] == 3
+        received.ack()
+        queue.close()
@@ -0,0 +1,212 @@
+import functools
+import gzip
+import hashlib
+import http.client
+import http.server
+import lzma
+import os
+import shutil
+import tempfile
+import threading
+
+import pytest
+import requests
+
+from app.lib.proxy import DebCacheProxy, parse_packages_index, parse_snapshot_query
+from app.lib.rebuild import DebianRebuilder
+
+TEST_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)))
+os.environ["PACKAGE_REBUILDER_CONF"] = f"{TEST_DIR}/rebuilder.conf"
+
+
+INDEX = "/archive/debian/20210615T000000Z/dists/bullseye/main/binary-amd64/Packages.xz"
+PACKAGES_INDEX = b"""Package: bash
+Version: 5.1-2+b3
+Architecture: amd64
+Filename: pool/main/b/bash/bash_5.1-2+b3_amd64.deb
+SHA256: b7feb754854a0188b703e200b4dcb502acffcc42d601948972944bb7e8ca05cf
+
+Package: coreutils
+Filename: pool/main/c/coreutils/coreutils_8.32-4+b1_amd64.deb
+SHA256: 0000000000000000000000000000000000000000000000000000000000000000
+"""
+
+
+class RecordingHandler(http.server.SimpleHTTPRequestHandler):
+    requests = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        super().do_GET()
+
+
+@pytest.fixture
+def mirror():
+    # local file server standing for snapshot mirror
+    with tempfile.TemporaryDirectory() as mirror_dir:
+        for f in ("bash_5.1-2+b3_amd64.deb", "bash-static_5.1-2+b3_amd64.deb",
+                  "fake_bash_5.1-2+b3_amd64.buildinfo"):
+            shutil.copy2(f"{TEST_DIR}/data/{f}", mirror_dir)
+        index_dir = f"{mirror_dir}/archive/debian/20210615T000000Z/dists/bullseye/main/binary-amd64"
+        os.makedirs(index_dir)
+        with open(f"{index_dir}/Packages.xz", "wb") as fd:
+            fd.write(lzma.compress(PACKAGES_INDEX))
+        os.makedirs(f"{mirror_dir}/mr/binary/bash/5.1-2+b3")
+        with open(f"{mirror_dir}/mr/binary/bash/5.1-2+b3/binfiles", "w") as fd:
+            fd.write('{"result": [{"architecture": "amd64"}]}')
+        RecordingHandler.requests = []
+        server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0), functools.partial(RecordingHandler, directory=mirror_dir))
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield mirror_dir, f"http://127.0.0.1:{server.server_address[1]}"
+        server.shutdown()
+        server.server_close()
+
+
+def test_deb_cache_proxy(mirror):
+    mirror_dir, mirror_url = mirror
+    with open(f"{TEST_DIR}/data/bash_5.1-2+b3_amd64.deb", "rb") as fd:
+        content = fd.read()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        with DebCacheProxy(cache_dir) as proxy:
+            proxies = {"http": proxy.url}
+            # packages of the snapshot index can be verified
+            assert requests.get(f"{mirror_url}{INDEX}", proxies=proxies).status_code == 200
+            for _ in range(2):
+                resp = requests.get(f"{mirror_url}/bash_5.1-2+b3_amd64.deb", proxies=proxies)
+                assert resp.status_code == 200
+                assert resp.content == content
+            # downloaded once
+            assert RecordingHandler.requests == [INDEX, "/bash_5.1-2+b3_amd64.deb"]
+            assert proxy.cache.stats()["entries"] == 1
+            sha256 = hashlib.sha256(content).hexdigest()
+            assert os.path.exists(f"{cache_dir}/debs/blobs/{sha256[:2]}/{sha256}")
+
+            resp = requests.get(f"{mirror_url}/missing_1.0_amd64.deb", proxies=proxies)
+            assert resp.status_code == 404
+
+        # shared with another rebuilder
+        with DebCacheProxy(cache_dir) as proxy:
+            resp = requests.get(f"{mirror_url}/bash_5.1-2+b3_amd64.deb",
+                                proxies={"http": proxy.url})
+            assert resp.content == content
+            assert proxy.cache.stats()["hits"] == 1
+            assert len(RecordingHandler.requests) == 3
+
+            # files which cannot be verified are served but not shared
+            for _ in range(2):
+                resp = requests.get(f"{mirror_url}/bash-static_5.1-2+b3_amd64.deb",
+                                    proxies={"http": proxy.url})
+                assert resp.status_code == 200
+            assert len(RecordingHandler.requests) == 5
+            assert proxy.cache.stats()["entries"] == 1
+
+
+def test_parse_packages_index():
+    assert list(parse_packages_index(lzma.compress(PACKAGES_INDEX))) == [
+        ("bash_5.1-2+b3_amd64.deb",
+         "b7feb754854a0188b703e200b4dcb502acffcc42d601948972944bb7e8ca05cf"),
+        ("coreutils_8.32-4+b1_amd64.deb", "0" * 64),
+    ]
+    assert list(parse_packages_index(gzip.compress(PACKAGES_INDEX))) == \
+        list(parse_packages_index(PACKAGES_INDEX))
+    assert list(parse_packages_index(b"Origin: Debian\n")) == []
+    assert list(parse_packages_index(b"\xfd7zXZ\x00corrupted")) == []
+
+
+def test_deb_cache_proxy_checksums(mirror):
+    mirror_dir, mirror_url = mirror
+    with tempfile.TemporaryDirectory() as cache_dir:
+        with DebCacheProxy(cache_dir) as proxy:
+            proxies = {"http": proxy.url}
+            # checksums of the buildinfo being rebuilt verify original binaries
+            DebianRebuilder.add_buildinfo_checksums(
+                proxy, f"{mirror_dir}/fake_bash_5.1-2+b3_amd64.buildinfo")
+            assert "bash-static_5.1-2+b3_amd64.deb" in proxy.cache.checksums
+
+            # corrupted file on the mirror
+            with open(f"{mirror_dir}/bash-static_5.1-2+b3_amd64.deb", "ab") as fd:
+                fd.write(b"corrupted")
+            resp = requests.get(f"{mirror_url}/bash-static_5.1-2+b3_amd64.deb", proxies=proxies)
+            assert resp.status_code == 502
+            assert proxy.cache.stats()["entries"] == 0
+
+            shutil.copy2(f"{TEST_DIR}/data/bash-static_5.1-2+b3_amd64.deb", mirror_dir)
+            resp = requests.get(f"{mirror_url}/bash-static_5.1-2+b3_amd64.deb", proxies=proxies)
+            assert resp.status_code == 200
+            assert proxy.cache.stats()["entries"] == 1
+
+
+def test_parse_snapshot_query():
+    assert parse_snapshot_query("http://snapshot.notset.fr/mr/binary/bash/5.1-2%2Bb3/binfiles") == \
+        ("bash", "5.1-2+b3", None)
+    assert parse_snapshot_query("http://snapshot.notset.fr/api?pkg=bash&ver=5.1-2%2Bb3&arch=amd64") == \
+        ("bash", "5.1-2+b3", "amd64")
+    assert parse_snapshot_query("http://snapshot.notset.fr/mr/package/") is None
+    # metasnap query used by debrebuild '--use-metasnap'
+    assert parse_snapshot_query("http://metasnap.debian.net/cgi-bin/api?archive=debian"
+                                "&pkg=bash&arch=amd64&ver=5.1-2%2Bb3") == ("bash", "5.1-2+b3", "amd64")
+
+
+def test_snapshot_cache_proxy(mirror):
+    mirror_dir, mirror_url = mirror
+    index = INDEX
+    query = "/mr/binary/bash/5.1-2+b3/binfiles"
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for _ in range(2):
+            with DebCacheProxy(cache_dir, resolver_urls=[mirror_url]) as proxy:
+                proxies = {"http": proxy.url}
+                resp = requests.get(f"{mirror_url}{index}", proxies=proxies)
+                assert lzma.decompress(resp.content) == PACKAGES_INDEX
+                resp = requests.get(f"{mirror_url}{query}", proxies=proxies)
+                assert resp.json() == {"result": [{"architecture": "amd64"}]}
+                assert proxy.cache.get_timestamps() == ["20210615T000000Z"]
+        # index and resolver query are shared by builds
+        assert RecordingHandler.requests == [index, query]
+
+
+def test_deb_cache_proxy_timestamps(mirror):
+    mirror_dir, mirror_url = mirror
+    debs_dir = f"{mirror_dir}/archive/debian/20210701T000000Z/pool/main/b/bash"
+    os.makedirs(debs_dir)
+    for f in ("bash_5.1-2+b3_amd64.deb", "bash-static_5.1-2+b3_amd64.deb"):
+        shutil.copy2(f"{TEST_DIR}/data/{f}", debs_dir)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        with DebCacheProxy(cache_dir) as proxy:
+            proxies = {"http": proxy.url}
+            requests.get(f"{mirror_url}{INDEX}", proxies=proxies)
+            for f in ("bash_5.1-2+b3_amd64.deb", "bash-static_5.1-2+b3_amd64.deb"):
+                requests.get(f"{mirror_url}/archive/debian/20210701T000000Z/pool/main/b/bash/{f}",
+                             proxies=proxies)
+            # most used timestamp first, not the oldest
+            assert proxy.cache.get_timestamps() == ["20210701T000000Z", "20210615T000000Z"]
+
+
+def test_deb_cache_budget():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        proxy = DebCacheProxy(cache_dir, budget=1000)
+        # a single budget for .deb and index files
+        assert proxy.cache.store.budget + proxy.cache.indexes.budget == 1000
+        proxy.server.server_close()
+        proxy.cache.close()
+
+
+def test_deb_cache_proxy_https_tunnel(mirror):
+    mirror_dir, mirror_url = mirror
+    with tempfile.TemporaryDirectory() as cache_dir:
+        with DebCacheProxy(cache_dir) as proxy:
+            host, port = proxy.server.server_address[:2]
+            conn = http.client.HTTPConnection(host, port, timeout=10)
+            conn.set_tunnel("127.0.0.1", int(mirror_url.rsplit(":", 1)[1]))
+            conn.request("GET", "/bash_5.1-2+b3_amd64.deb")
+            resp = conn.getresponse()
+            assert resp.status == 200
+            with open(f"{TEST_DIR}/data/bash_5.1-2+b3_amd64.deb", "rb") as fd:
+                assert resp.read() == fd.read()
+            conn.close()
+            # tunneled content is not cached
+            assert proxy.cache.stats()["entries"] == 0
@@ -1,5 +1,10 @@
+import gzip
+import logging
 import os
+import resource
 import shutil
+import subprocess
+import sys
 import tempfile
 
 from unittest.mock import MagicMock, patch
@@ -8,9 +13,13 @@ import pytest
 
 from app.lib.exceptions import RebuilderExceptionBuild
 from app.lib.get import getPackage
-from app.lib.rebuild import BaseRebuilder, DebianRebuilder, QubesRebuilderDEB, getRebuilder
+from app.lib.log import log
+from app.lib.rebuild import BaseRebuilder, DebianRebuilder, QubesRebuilderDEB, \
+    getRebuilder, load_debrebuild
 
 TEST_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)))
+# tests replace it with a fixed build directory
+gen_temp_dir = BaseRebuilder.gen_temp_dir
 
 
 def test_rebuild_debian():
@@ -24,14 +33,18 @@ def test_rebuild_qubes_deb():
 
 
 def _create_rebuild(mock_run, basedir, package, return_code, stdout):
-    mock_stdout = MagicMock()
-    mock_stdout.configure_mock(
+    mock_result = MagicMock()
+    mock_result.configure_mock(
         **{
-            "stdout": stdout,
             "returncode": return_code
         }
     )
-    mock_run.return_value = mock_stdout
+
+    # build output is written directly to the log file
+    def run(cmd, **kwargs):
+        kwargs["stdout"].write(stdout)
+        return mock_result
+    mock_run.side_effect = run
 
     # fake tempdir generated for build
     def gen_temp_dir(*args, **lwargs):
@@ -65,6 +78,10 @@ def test_rebuild_debian_reproducible(mock_run):
         package = _create_rebuild(mock_run, basedir, package, 0, stdout)
 
         assert package.status == "reproducible"
+        assert package.duration is not None
+        # debrebuild is not available: fallback to subprocess
+        assert not package["rebuild"]["in_process"]
+        assert package["rebuild"]["files"]["0xffff_0.8-1+b1_amd64.buildinfo"] is None
         assert package.log is not None
         with open(package.log, "rb") as fd:
             assert fd.read() == stdout
@@ -119,3 +136,282 @@ def test_rebuild_debian_failure(mock_run):
             with open(package.log, "rb") as fd:
                 assert fd.read() == stdout
             assert package.buildinfos.get("new", None) is None
+
+
+def test_rebuild_log_compressed():
+    rebuilder = BaseRebuilder(compress_log=True)
+    # more output than a single chunk
+    cmd = [sys.executable, "-c", "import sys; sys.stdout.write('build output\\n' * 100000)"]
+    with tempfile.TemporaryDirectory() as basedir:
+        logfile = f"{basedir}/bash-5.1-2+b3.amd64.log"
+        result = rebuilder.run_logged(cmd, logfile)
+        assert result.returncode == 0
+        with open(logfile, "rb") as fd:
+            assert fd.read() == b"build output\n" * 100000
+        with gzip.open(f"{logfile}.gz", "rb") as fd:
+            assert fd.read() == b"build output\n" * 100000
+
+
+FAKE_DEBREBUILD = """
+import os
+import resource
+import subprocess
+import sys
+
+
+def main():
+    output = [arg.split("=", 1)[1] for arg in sys.argv if arg.startswith("--output=")][0]
+    with open(os.path.join(output, "bash_5.1-2+b3_amd64.deb"), "w") as fd:
+        fd.write("deb")
+    print("Build is unreproducible!")
+    # output of build processes
+    subprocess.run(["echo", "dpkg-buildpackage"], check=True)
+    sys.exit(2)
+"""
+
+
+def test_rebuild_debian_in_process():
+    package = getPackage({
+        'name': 'bash',
+        'epoch': None,
+        'version': '5.1-2+b3',
+        'arch': 'amd64',
+        'distribution': 'bullseye',
+        'buildinfos': {
+            "old": 'https://buildinfos.debian.net/buildinfo-pool'
+                   '/b/bash/fake_bash_5.1-2+b3_amd64.buildinfo'
+        }
+    })
+    with tempfile.TemporaryDirectory() as basedir:
+        debrebuild_path = f"{basedir}/debrebuild.py"
+        with open(debrebuild_path, "w") as fd:
+            fd.write(FAKE_DEBREBUILD)
+
+        def gen_temp_dir(*args, **lwargs):
+            return f"{basedir}/build"
+        os.makedirs(f"{basedir}/build")
+        shutil.copy2(f"{TEST_DIR}/data/fake_bash_5.1-2+b3_amd64.buildinfo",
+                     f"{basedir}/build/bash_5.1-2+b3_amd64.buildinfo")
+        BaseRebuilder.gen_temp_dir = gen_temp_dir
+
+        rebuilder = getRebuilder(package.distribution, artifacts_dir=f"{basedir}/artifacts",
+                                 debrebuild_path=debrebuild_path)
+        with patch("app.lib.rebuild.subprocess.run", wraps=subprocess.run) as mock_run:
+            package = rebuilder.run(package)
+            # no new interpreter, the build runs in a child of the worker
+            mock_run.assert_not_called()
+
+        assert package.status == "unreproducible"
+        assert package["rebuild"]["in_process"]
+        assert package["rebuild"]["returncode"] == 2
+        assert set(package["rebuild"]["timings"]) == {"build", "publish", "collect"}
+        # hashes come from the new buildinfo
+        assert package["rebuild"]["files"] == {
+            "bash_5.1-2+b3_amd64.buildinfo": None,
+            "bash_5.1-2+b3_amd64.deb":
+                "b7feb754854a0188b703e200b4dcb502acffcc42d601948972944bb7e8ca05cf",
+        }
+        with open(package.log) as fd:
+            assert fd.read() == "Build is unreproducible!\ndpkg-buildpackage\n"
+        assert package.buildinfos["new"] == f"{package.artifacts}/bash_5.1-2+b3_amd64.buildinfo"
+
+
+FAKE_DEBREBUILD_LOGGING = """
+import logging
+import sys
+
+logger = logging.getLogger("debrebuild")
+logger.setLevel(logging.DEBUG)
+
+
+def main():
+    logger.info("Rebuilding bash")
+    # logging of the worker, e.g. of the proxy thread
+    logging.getLogger("PackageRebuilder").debug("proxy request")
+    sys.exit(0)
+"""
+
+
+def test_rebuild_in_process_logging(capfd):
+    with tempfile.TemporaryDirectory() as basedir:
+        debrebuild_path = f"{basedir}/debrebuild.py"
+        with open(debrebuild_path, "w") as fd:
+            fd.write(FAKE_DEBREBUILD_LOGGING)
+        module = load_debrebuild(debrebuild_path)
+        worker_handler = logging.StreamHandler(open(2, "w", closefd=False))
+        log.addHandler(worker_handler)
+        try:
+            logfile = f"{basedir}/bash.log"
+            assert DebianRebuilder.run_in_process(module, [], logfile) == 0
+        finally:
+            log.removeHandler(worker_handler)
+        assert worker_handler.stream.fileno() == 2
+
+        # only debrebuild logging, once
+        with open(logfile) as fd:
+            assert fd.read() == "Rebuilding bash\n"
+        assert "proxy request\n" in capfd.readouterr().err
+
+
+FAKE_DEBREBUILD_ENVIRON = """
+import os
+
+
+def main():
+    print(os.environ["DEB_BUILD_OPTIONS"])
+    os.environ["DEBREBUILD_STATE"] = "building"
+    os.chdir("/")
+    raise RuntimeError("mmdebstrap failed")
+"""
+
+
+def test_rebuild_in_process_environ():
+    with tempfile.TemporaryDirectory() as basedir:
+        debrebuild_path = f"{basedir}/debrebuild.py"
+        with open(debrebuild_path, "w") as fd:
+            fd.write(FAKE_DEBREBUILD_ENVIRON)
+        module = load_debrebuild(debrebuild_path)
+        environ, cwd = os.environ.copy(), os.getcwd()
+        env = dict(environ, DEB_BUILD_OPTIONS="parallel=8")
+        logfile = f"{basedir}/bash.log"
+        assert DebianRebuilder.run_in_process(module, [], logfile, env=env) == 1
+
+        # the build environment is not set in the worker, even on failure
+        assert os.environ == environ
+        assert os.getcwd() == cwd
+        with open(logfile) as fd:
+            content = fd.read()
+        assert content.startswith("parallel=8\n")
+        assert "RuntimeError: mmdebstrap failed" in content
+
+
+FAKE_DEBREBUILD_RLIMIT = """
+import resource
+import subprocess
+import sys
+
+
+def main():
+    print(resource.getrlimit(resource.RLIMIT_DATA)[0])
+    # inherited by the build processes
+    subprocess.run([sys.executable, "-c", "import resource; "
+                    "print(resource.getrlimit(resource.RLIMIT_DATA)[0])"], check=True)
+"""
+
+
+def test_rebuild_in_process_memory_ceiling():
+    with tempfile.TemporaryDirectory() as basedir:
+        debrebuild_path = f"{basedir}/debrebuild.py"
+        with open(debrebuild_path, "w") as fd:
+            fd.write(FAKE_DEBREBUILD_RLIMIT)
+        module = load_debrebuild(debrebuild_path)
+        rlimit = resource.getrlimit(resource.RLIMIT_DATA)
+        memory_limit = 4096 * 1024 * 1024
+        if rlimit[1] != resource.RLIM_INFINITY:
+            memory_limit = min(memory_limit, rlimit[1])
+        logfile = f"{basedir}/bash.log"
+        assert DebianRebuilder.run_in_process(module, [], logfile, memory_limit=memory_limit) == 0
+
+        with open(logfile) as fd:
+            assert fd.read() == f"{memory_limit}\n{memory_limit}\n"
+        # not in the worker
+        assert resource.getrlimit(resource.RLIMIT_DATA) == rlimit
+
+
+@patch("app.lib.rebuild.subprocess.run")
+def test_rebuild_debian_build_slots(mock_run):
+    package = getPackage({
+        'name': 'bash',
+        'epoch': None,
+        'version': '5.1-2+b3',
+        'arch': 'amd64',
+        'distribution': 'bullseye',
+        'buildinfos': {
+            "old": 'https://buildinfos.debian.net/buildinfo-pool'
+                   '/b/bash/fake_bash_5.1-2+b3_amd64.buildinfo'
+        }
+    })
+    build = {}
+
+    def run(cmd, **kwargs):
+        build["env"] = kwargs["env"]
+        build["preexec_fn"] = kwargs["preexec_fn"]
+        build["rlimit"] = resource.getrlimit(resource.RLIMIT_DATA)
+        build["slots"] = os.listdir(f"{basedir}/artifacts/.slots")
+        kwargs["stdout"].write(b"Build is unreproducible!")
+        return MagicMock(returncode=2)
+    mock_run.side_effect = run
+
+    rlimit = resource.getrlimit(resource.RLIMIT_DATA)
+    with tempfile.TemporaryDirectory() as basedir:
+        os.makedirs(f"{basedir}/build")
+        shutil.copy2(f"{TEST_DIR}/data/fake_bash_5.1-2+b3_amd64.buildinfo",
+                     f"{basedir}/build/bash_5.1-2+b3_amd64.buildinfo")
+        BaseRebuilder.gen_temp_dir = lambda *args, **kwargs: f"{basedir}/build"
+        rebuilder = DebianRebuilder(artifacts_dir=f"{basedir}/artifacts", in_process=False,
+                                    build_slots=4, build_memory=4096, build_disk=1,
+                                    build_job_memory=512)
+        rebuilder.build_slots.cpus = 64
+        rebuilder.build_slots.total_memory = 64 * 1024 ** 3
+        rebuilder.build_slots.slot.cpus = 16
+        rebuilder.build_slots.slot.jobs = 8
+        with patch.dict(os.environ, {"DEB_BUILD_OPTIONS": "nostrip parallel=2"}):
+            package = rebuilder.run(package)
+
+        # memory-scaled build parallelism
+        assert build["env"]["DEB_BUILD_OPTIONS"] == "nostrip parallel=8"
+        # the memory ceiling is set in the build process, not in the worker
+        assert build["preexec_fn"].args == (4096 * 1024 * 1024,)
+        assert build["rlimit"] == rlimit
+        assert resource.getrlimit(resource.RLIMIT_DATA) == rlimit
+        # the slot is reserved while building only
+        assert len([f for f in build["slots"] if f.endswith(".slot")]) == 1
+        assert not [f for f in os.listdir(f"{basedir}/artifacts/.slots") if f.endswith(".slot")]
+        assert package.status == "unreproducible"
+        assert package["slot"] == {"cpus": 16, "memory": 4096 * 1024 * 1024,
+                                   "disk": 1024 * 1024, "jobs": 8}
+
+
+def test_rebuild_debian_build_slot_timeout():
+    package = getPackage({
+        'name': 'bash',
+        'epoch': None,
+        'version': '5.1-2+b3',
+        'arch': 'amd64',
+        'distribution': 'bullseye',
+        'buildinfos': {
+            "old": 'https://buildinfos.debian.net/buildinfo-pool'
+                   '/b/bash/fake_bash_5.1-2+b3_amd64.buildinfo'
+        }
+    })
+    with tempfile.TemporaryDirectory() as basedir, \
+            patch.object(BaseRebuilder, "gen_temp_dir", gen_temp_dir):
+        rebuilder = DebianRebuilder(artifacts_dir=f"{basedir}/artifacts", build_slots=1,
+                                    build_memory=1, build_disk=1, build_slot_timeout=1)
+        with rebuilder.build_slots.acquire(), patch("app.lib.slots.time.sleep"):
+            # retried later
+            with pytest.raises(RebuilderExceptionBuild) as e:
+                rebuilder.run(package)
+        assert e.value.args[0][0]["name"] == "bash"
+
+
+def test_rebuild_debian_aborted():
+    package = getPackage({
+        'name': 'bash',
+        'epoch': None,
+        'version': '5.1-2+b3',
+        'arch': 'amd64',
+        'distribution': 'bullseye',
+        'buildinfos': {
+            "old": 'https://buildinfos.debian.net/buildinfo-pool'
+                   '/b/bash/fake_bash_5.1-2+b3_amd64.buildinfo'
+        }
+    })
+    with tempfile.TemporaryDirectory() as basedir, \
+            patch.object(BaseRebuilder, "gen_temp_dir", gen_temp_dir), \
+            patch.object(DebianRebuilder, "debrebuild", side_effect=OSError("aborted")):
+        rebuilder = DebianRebuilder(artifacts_dir=f"{basedir}/artifacts")
+        with pytest.raises(RebuilderExceptionBuild):
+            rebuilder.run(package)
+        # workdir is removed
+        assert os.listdir(f"{basedir}/artifacts/.build") == []
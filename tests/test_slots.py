@@ -0,0 +1,105 @@
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+
+import pytest
+
+from app.lib.exceptions import RebuilderExceptionBuild
+from app.lib.slots import BuildSlots, set_memory_ceiling
+
+
+def test_build_slots_admission():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        slots = BuildSlots(tmpdir, 3, cpus=64, total_memory=3 * 1024 ** 3, disk=1)
+        assert slots.slot.cpus == 21
+        assert slots.slot.memory == 1024 ** 3
+        # a 2 GiB job does not fit in the slot memory
+        assert slots.slot.jobs == 1
+
+        held = [slots.try_acquire() for _ in range(3)]
+        assert all(held)
+        assert len(slots.get_reservations()) == 3
+        # every slot is used
+        assert slots.try_acquire() is None
+
+        # a reservation is released once its holder does not lock it anymore
+        held[0].close()
+        reservation = slots.try_acquire()
+        assert reservation
+        assert not os.path.exists(held[0].name)
+        for fd in held[1:] + [reservation]:
+            fd.close()
+
+
+def test_build_slots_resources():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # not enough memory for a second build
+        slots = BuildSlots(tmpdir, 4, memory=1024, cpus=64, total_memory=1536 * 1024 ** 2,
+                           disk=1)
+        with slots.acquire() as slot:
+            assert slot.cpus == 16
+            assert slots.try_acquire() is None
+        # not enough free disk space
+        slots = BuildSlots(tmpdir, 4, cpus=64, total_memory=1024 ** 3, disk=1024 ** 4)
+        assert slots.try_acquire() is None
+
+
+def test_build_slots_wait():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        slots = BuildSlots(tmpdir, 1, cpus=4, total_memory=1024 ** 3, disk=1)
+        admitted = threading.Event()
+
+        def build():
+            with slots.acquire(poll_interval=0.01):
+                admitted.set()
+
+        with slots.acquire():
+            thread = threading.Thread(target=build)
+            thread.start()
+            assert not admitted.wait(0.2)
+        thread.join(5)
+        assert admitted.is_set()
+
+
+def test_build_slots_jobs():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        slots = BuildSlots(tmpdir, 2, cpus=64, total_memory=32 * 1024 ** 3, disk=1,
+                           job_memory=4096)
+        # limited by memory rather than by CPUs
+        assert slots.slot.cpus == 32
+        assert slots.slot.jobs == 4
+
+
+def test_build_slots_exceeds_host():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        slots = BuildSlots(tmpdir, 1, memory=2048, cpus=4, total_memory=1024 ** 3, disk=1)
+        with pytest.raises(RebuilderExceptionBuild):
+            with slots.acquire(poll_interval=0.01):
+                pass
+
+
+def test_build_slots_timeout():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        slots = BuildSlots(tmpdir, 1, cpus=4, total_memory=1024 ** 3, disk=1)
+        with slots.acquire():
+            with pytest.raises(TimeoutError):
+                with slots.acquire(poll_interval=0.01, timeout=0.05):
+                    pass
+        assert slots.get_reservations() == []
+
+
+def test_set_memory_ceiling():
+    rlimit = resource.getrlimit(resource.RLIMIT_DATA)
+    cmd = [sys.executable, "-c",
+           "import resource; print(resource.getrlimit(resource.RLIMIT_DATA)[0])"]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, check=True,
+                            preexec_fn=lambda: set_memory_ceiling(4096 * 1024 ** 2))
+    limit = 4096 * 1024 ** 2
+    if rlimit[1] != resource.RLIM_INFINITY:
+        limit = min(limit, rlimit[1])
+    assert int(result.stdout) == limit
+    # only the build process is limited
+    assert resource.getrlimit(resource.RLIMIT_DATA) == rlimit
@@ -8,8 +8,13 @@ import pytest
 from unittest.mock import patch, MagicMock
 
 from app.celery import app
-from app.tasks.rebuilder import get, rebuild, attest, report
+from app.tasks.rebuilder import get, rebuild, attest, report, get_unfinished_packages
+from app.lib.duration import REBUILD_QUEUES
+from app.lib.priority import get_queue_lanes
 from app.lib.rebuild import BaseRebuilder
+from app.lib.get import getPackage
+from app.lib.tool import INFLIGHT_REBUILDS_KEY, BUILDING_STATE, get_rebuild_packages, \
+    reconcile_inflight_packages, get_running_rebuild_logs
 
 TEST_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)))
 os.environ["PACKAGE_REBUILDER_CONF"] = f"{TEST_DIR}/rebuilder.conf"
@@ -20,7 +25,10 @@ global tmpdir, rootdir, artifacts_dir, rebuild_dir, package
 
 def setup_module(module):
     with app.pool.acquire(block=True) as conn:
-        del conn.default_channel.client["rebuild"]
+        for queue_name in REBUILD_QUEUES:
+            for lane in get_queue_lanes(queue_name):
+                del conn.default_channel.client[lane]
+        del conn.default_channel.client[INFLIGHT_REBUILDS_KEY]
     global tmpdir, rootdir, artifacts_dir, rebuild_dir, package
     tmpdir = tempfile.TemporaryDirectory()
     rootdir = tmpdir.name
@@ -54,10 +62,14 @@ def test_tasks_get(requests_mock):
     with open(f"{TEST_DIR}/data/single.pkgset", "r") as fd:
         requests_mock.get("https://jenkins.debian.net/userContent/reproducible/debian/pkg-sets/"
                           "unstable/single.pkgset", text=fd.read())
-    result = get("unstable+single.amd64")
+    result = get("unstable+single.amd64", cache_dir=f"{rootdir}/cache")
     global package
     assert result == {"get": [package]}
 
+    # already queued packages are not submitted again
+    result = get("unstable+single.amd64", cache_dir=f"{rootdir}/cache", incremental=False)
+    assert result == {}
+
 
 @patch("app.lib.rebuild.subprocess.run")
 def test_tasks_rebuild(mock_run, requests_mock):
@@ -74,14 +86,18 @@ def test_tasks_rebuild(mock_run, requests_mock):
     os.makedirs(f"{rootdir}/build")
     BaseRebuilder.gen_temp_dir = gen_temp_dir
 
-    mock_stdout = MagicMock()
-    mock_stdout.configure_mock(
+    mock_result = MagicMock()
+    mock_result.configure_mock(
         **{
-            "stdout": b"Build is unreproducible!",
             "returncode": 2
         }
     )
-    mock_run.return_value = mock_stdout
+
+    # build output is written directly to the log file
+    def run(cmd, **kwargs):
+        kwargs["stdout"].write(b"Build is unreproducible!")
+        return mock_result
+    mock_run.side_effect = run
     shutil.copy2(f"{TEST_DIR}/data/bash_5.1-2+b3_amd64.deb", f"{rootdir}/build")
     shutil.copy2(f"{TEST_DIR}/data/bash-static_5.1-2+b3_amd64.deb", f"{rootdir}/build")
     shutil.copy2(f"{TEST_DIR}/data/bash-amd64-summary.out", f"{rootdir}/build/summary.out")
@@ -143,3 +159,75 @@ def test_tasks_report():
 
     assert package["buildinfos"]["new"] == f"{rebuild_dir}/debian/buildinfos/bash_5.1-2+b3_amd64.buildinfo"
     assert os.path.exists(package["buildinfos"]["new"])
+
+    # latest status is stored in packages collection
+    stored_packages = get_rebuild_packages(app, distribution="unstable", fields=["status", "log"])
+    assert stored_packages["bash-5.1-2+b3.amd64"].status == "unreproducible"
+    assert stored_packages["bash-5.1-2+b3.amd64"].log == package["log"]
+
+
+def test_tasks_reconcile_inflight():
+    lost = getPackage(dict(package, version="5.1-2+b4"))
+    with app.pool.acquire(block=True) as conn:
+        conn.default_channel.client.sadd(INFLIGHT_REBUILDS_KEY, lost.key)
+    # unknown to Celery once: it may be between two tasks
+    assert reconcile_inflight_packages(app) == set()
+    assert reconcile_inflight_packages(app) == {lost.key}
+    with app.pool.acquire(block=True) as conn:
+        assert not conn.default_channel.client.sismember(INFLIGHT_REBUILDS_KEY, lost.key)
+
+
+def test_tasks_get_unfinished():
+    bash = getPackage(package)
+    dash = getPackage(dict(package, name="dash", version="0.5.11"))
+    coreutils = getPackage(dict(package, name="coreutils", version="8.32"))
+    stored_packages = {
+        str(bash): getPackage(dict(package, status="unreproducible")),
+        str(dash): getPackage(dict(package, name="dash", version="0.5.11", status="retry")),
+    }
+    assert get_unfinished_packages([bash, dash, coreutils], stored_packages) == [dash, coreutils]
+    assert get_unfinished_packages([bash, dash, coreutils], stored_packages,
+                                   exclude=[coreutils]) == [dash]
+
+
+def test_tasks_get_lost_inflight(requests_mock):
+    with open(f"{TEST_DIR}/data/buildinfo-pool_unstable_amd64.list", "r") as fd:
+        requests_mock.get("https://buildinfos.debian.net/"
+                          "buildinfo-pool_unstable_amd64.list", text=fd.read())
+    requests_mock.get("https://jenkins.debian.net/userContent/reproducible/debian/pkg-sets/"
+                      "unstable/lost.pkgset", text="bash\ndash\n")
+    # bash is already reported
+    result = get("unstable+lost.amd64", cache_dir=f"{rootdir}/cache-lost")
+    assert [p["name"] for p in result["get"]] == ["dash"]
+    assert get("unstable+lost.amd64", cache_dir=f"{rootdir}/cache-lost") == {}
+
+    # the queued rebuild is lost, e.g. its queue was purged
+    with app.pool.acquire(block=True) as conn:
+        for queue_name in REBUILD_QUEUES:
+            for lane in get_queue_lanes(queue_name):
+                del conn.default_channel.client[lane]
+    dash = getPackage(result["get"][0])
+    assert reconcile_inflight_packages(app) == set()
+    assert dash.key in reconcile_inflight_packages(app)
+
+    # next incremental get submits it again
+    result = get("unstable+lost.amd64", cache_dir=f"{rootdir}/cache-lost")
+    assert [p["name"] for p in result["get"]] == ["dash"]
+
+
+def test_tasks_running_rebuild_logs():
+    waiting = getPackage(dict(package, name="dash", version="0.5.11"))
+    mock_app = MagicMock()
+    mock_app.control.inspect.return_value.active.return_value = {
+        "rebuilder": [
+            {"id": "1", "name": "app.tasks.rebuilder.rebuild", "args": [package]},
+            {"id": "2", "name": "app.tasks.rebuilder.rebuild", "args": [dict(waiting)]},
+            {"id": "3", "name": "app.tasks.rebuilder.report", "args": [package]},
+        ]
+    }
+    results = {
+        "1": MagicMock(state=BUILDING_STATE, info={"package": package, "log": "/bash.log"}),
+        "2": MagicMock(state="STARTED", info=None),
+    }
+    mock_app.AsyncResult.side_effect = lambda task_id: results[task_id]
+    assert get_running_rebuild_logs(mock_app) == {getPackage(package): "/bash.log", waiting: None}
@@ -0,0 +1,159 @@
+import os
+import shutil
+import subprocess
+import tempfile
+
+import pytest
+
+from unittest.mock import patch
+
+from app.lib.get import getPackage
+from app.lib.upload import Uploader, UPLOAD_RETRY_DELAY, get_package_upload_paths
+from app.tasks.rebuilder import _upload_pending
+
+TEST_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)))
+os.environ["PACKAGE_REBUILDER_CONF"] = f"{TEST_DIR}/rebuilder.conf"
+
+
+def create_reported_package(local_dir):
+    output_dir = f"{local_dir}/rebuild/debian"
+    metadata_dir = f"{output_dir}/sources/bash/5.1-3+b1"
+    os.makedirs(f"{output_dir}/logs")
+    os.makedirs(f"{output_dir}/buildinfos")
+    os.makedirs(metadata_dir)
+    log = f"{output_dir}/logs/bash-5.1-3+b1.amd64.log"
+    open(log, "w").close()
+    buildinfo = f"{output_dir}/buildinfos/bash_5.1-3+b1_amd64.buildinfo"
+    shutil.copy2(f"{TEST_DIR}/data/bash_5.1-3+b1_amd64.buildinfo", buildinfo)
+    link = f"{metadata_dir}/rebuild.632f8c69.amd64.link"
+    open(link, "w").close()
+    open(f"{metadata_dir}/rebuild.632f8c69.link", "w").close()
+    os.symlink("rebuild.632f8c69.link", f"{metadata_dir}/metadata")
+    os.symlink("bash", f"{output_dir}/sources/bash-static")
+    # files of other packages are not uploaded
+    open(f"{output_dir}/logs/coreutils-8.32-4.amd64.log", "w").close()
+    return getPackage({
+        "name": "bash", "epoch": None, "version": "5.1-3+b1", "arch": "amd64",
+        "distribution": "bullseye", "status": "reproducible", "log": log,
+        "buildinfos": {"new": buildinfo}, "metadata": {"reproducible": link}
+    })
+
+
+def test_package_upload_paths():
+    with tempfile.TemporaryDirectory() as local_dir:
+        package = create_reported_package(local_dir)
+        paths = [os.path.relpath(path, local_dir) for path in get_package_upload_paths(package)]
+        assert paths == [
+            "rebuild/debian/buildinfos/bash_5.1-3+b1_amd64.buildinfo",
+            "rebuild/debian/logs/bash-5.1-3+b1.amd64.log",
+            "rebuild/debian/sources/bash-static",
+            "rebuild/debian/sources/bash/5.1-3+b1/metadata",
+            "rebuild/debian/sources/bash/5.1-3+b1/rebuild.632f8c69.amd64.link",
+            "rebuild/debian/sources/bash/5.1-3+b1/rebuild.632f8c69.link",
+        ]
+
+
+@patch("subprocess.run")
+def test_upload_files(mock_run):
+    files_from = []
+
+    def run(cmd, **kwargs):
+        for arg in cmd:
+            if arg.startswith("--files-from="):
+                with open(arg.split("=", 1)[1]) as fd:
+                    files_from.extend(fd.read().splitlines())
+        return subprocess.CompletedProcess(cmd, 0, stdout="")
+
+    mock_run.side_effect = run
+    with tempfile.TemporaryDirectory() as local_dir:
+        package = create_reported_package(local_dir)
+        uploader = Uploader("debian", local_dir=local_dir)
+        uploader.ssh_key = "id_rsa"
+        uploader.remote_host = "rebuilder@localhost"
+        uploader.remote_basedir = "/data/rebuilder"
+        paths = get_package_upload_paths(package)
+        assert uploader.upload_files(paths + paths) == (files_from, [])
+        assert len(files_from) == len(paths)
+
+        # a single transfer for every file
+        rsync_calls = [c for c in mock_run.call_args_list if c.args[0][0] == "rsync"]
+        assert len(rsync_calls) == 1
+        assert rsync_calls[0].args[0][-2:] == [f"{local_dir}/", "rebuilder@localhost:/data/rebuilder/"]
+        # no separate SSH session for creating remote directory
+        assert len(mock_run.call_args_list) == 1
+        assert "--rsync-path=mkdir -p /data/rebuilder/ && rsync" in rsync_calls[0].args[0]
+        assert "ControlMaster=auto" in rsync_calls[0].args[0][rsync_calls[0].args[0].index("-e") + 1]
+
+        assert uploader.upload_files([]) == ([], [])
+
+
+@patch("subprocess.run")
+def test_upload_files_partial(mock_run):
+    with tempfile.TemporaryDirectory() as local_dir:
+        package = create_reported_package(local_dir)
+        uploader = Uploader("debian", local_dir=local_dir)
+        uploader.ssh_key = "id_rsa"
+        uploader.remote_host = "rebuilder@localhost"
+        uploader.remote_basedir = "/data/rebuilder"
+        paths = get_package_upload_paths(package)
+
+        # removed files and files not in local directory are dropped
+        valid_paths = uploader.get_valid_paths(
+            paths + [f"{local_dir}/rebuild/debian/logs/removed.log", "/etc/passwd"])
+        assert valid_paths == paths
+
+        # some files vanished or could not be transferred
+        transferred = [os.path.relpath(path, local_dir) for path in paths[1:]]
+        mock_run.return_value = subprocess.CompletedProcess(
+            [], 23, stdout="".join(f"<f+++++++++ {f}\n" for f in ["rebuild/"] + transferred))
+        assert uploader.upload_files(paths) == (transferred, paths[:1])
+
+        mock_run.return_value = subprocess.CompletedProcess([], 12, stdout="")
+        with pytest.raises(subprocess.CalledProcessError):
+            uploader.upload_files(paths)
+
+
+@patch("subprocess.run")
+def test_uploader_connect(mock_run):
+    uploader = Uploader("debian", control_path="/tmp/test-%C")
+    uploader.ssh_key = "id_rsa"
+    uploader.remote_host = "rebuilder@localhost"
+    uploader.remote_basedir = "/data/rebuilder"
+
+    # master connection is alive
+    mock_run.return_value.returncode = 0
+    uploader.connect()
+    assert len(mock_run.call_args_list) == 1
+    assert mock_run.call_args.args[0][-3:] == ["-O", "check", "rebuilder@localhost"]
+    assert "ControlPath=/tmp/test-%C" in mock_run.call_args.args[0]
+
+    # master connection is (re)started
+    mock_run.reset_mock()
+    mock_run.return_value.returncode = 255
+    uploader.connect()
+    assert len(mock_run.call_args_list) == 2
+    assert mock_run.call_args.args[0][-4:] == ["-M", "-N", "-f", "rebuilder@localhost"]
+
+
+@patch("app.tasks.rebuilder.Uploader")
+@patch("app.tasks.rebuilder.pop_upload_paths")
+@patch("app.tasks.rebuilder.requeue_upload_paths")
+def test_upload_pending_requeue(mock_requeue, mock_pop, mock_uploader):
+    paths = ["/var/lib/rebuilder/rebuild/debian/logs/bash.log",
+             "/var/lib/rebuilder/rebuild/debian/logs/dash.log"]
+    mock_pop.return_value = paths
+    mock_uploader.return_value.get_valid_paths.side_effect = lambda p: p
+    mock_uploader.return_value.upload_files.return_value = (
+        ["rebuild/debian/logs/bash.log"], paths[1:])
+    mock_requeue.return_value = True
+    with patch.object(_upload_pending, "apply_async") as mock_apply:
+        assert _upload_pending("debian") == {"upload": ["rebuild/debian/logs/bash.log"]}
+        # files not transferred are uploaded again later
+        assert mock_requeue.call_args.args[1:] == ("debian", paths[1:])
+        mock_apply.assert_called_once_with(("debian",), countdown=UPLOAD_RETRY_DELAY)
+
+        # an upload is already scheduled
+        mock_apply.reset_mock()
+        mock_requeue.return_value = False
+        _upload_pending("debian")
+        mock_apply.assert_not_called()
@@ -0,0 +1,47 @@
+import pytest
+
+from app.lib.version import debian_version_key, rpm_version_key, get_latest_versions
+
+
+@pytest.mark.parametrize("lower,higher", [
+    ("1.0", "1.0.1"),
+    ("1.0~rc1", "1.0"),
+    ("1.0~~", "1.0~"),
+    ("1.0", "1.0a"),
+    ("1.0a", "1.0+"),
+    ("1.0-1", "1.0-1+b1"),
+    ("2.3~rc1+dfsg-1+b2", "2.3-1"),
+    ("9.9-9", "1:0.1-1"),
+    ("1:2.3~rc1+dfsg-1+b2", "1:2.3~rc1+dfsg-1+b3"),
+    ("5.1-2+b3", "5.1-3+b1"),
+])
+def test_debian_version_key(lower, higher):
+    assert debian_version_key(lower) < debian_version_key(higher)
+
+
+@pytest.mark.parametrize("version,other", [
+    ("1.0", "1.00"),
+    ("1.0", "1.0-0"),
+    ("0:1.0-1", "1.0-1"),
+])
+def test_debian_version_key_equal(version, other):
+    assert debian_version_key(version) == debian_version_key(other)
+
+
+@pytest.mark.parametrize("lower,higher", [
+    ("1.0-1.fc32", "1.0-2.fc32"),
+    ("1.0~rc1-1", "1.0-1"),
+    ("1.0-1", "1.0^git1-1"),
+    ("1.0^git1-1", "1.0.1-1"),
+    ("1.a-1", "1.1-1"),
+    ("2.0-1", "10.0-1"),
+])
+def test_rpm_version_key(lower, higher):
+    assert rpm_version_key(lower) < rpm_version_key(higher)
+    assert rpm_version_key(higher) < rpm_version_key(lower, epoch="1")
+
+
+def test_get_latest_versions():
+    versions = [("bash", "5.1-2"), ("apt", "2.3.9"), ("bash", "5.1-3+b1"), ("bash", "5.1~rc1-1")]
+    latest = get_latest_versions(versions, key=lambda v: (v[0], debian_version_key(v[1])))
+    assert latest == {"bash": ("bash", "5.1-3+b1"), "apt": ("apt", "2.3.9")}